@@ -0,0 +1,108 @@
+import numpy as np
+
+
+class PartitionedBlockFilter:
+    """分割ブロック周波数領域NLMS(PBFDAF)によるエコー経路の推定と除去
+
+    参照信号(スピーカーから再生される受信音声)からエコーを予測し,
+    マイク信号から差し引く. オーバーラップセーブ方式で, フィルタ長は
+    block_size * num_partitions サンプル.
+    channels > 1 なら複数のマイクのエコー経路を1つの配列にまとめて持ち, 参照のスペクトルは共有して
+    全チャンネルの予測と更新を1回の配列演算で行う(マイク信号と誤差は (channels, block_size) の配列).
+    """
+
+    def __init__(self, block_size=256, num_partitions=16, step_size=0.5,
+                 smoothing=0.9, regularization=1e-6, channels=1):
+        self.block_size = block_size
+        self.num_partitions = num_partitions
+        self.step_size = step_size
+        self.smoothing = smoothing
+        self.channels = channels
+        self.fft_size = 2 * block_size
+        # 無音時に発散しないための正則化項(1サンプルあたりのパワー)
+        self.regularization = regularization * self.fft_size
+
+        bins = block_size + 1
+        # チャンネルの次元(モノラルなら付けない)
+        shape = (channels,) if channels > 1 else ()
+        # 過去の参照スペクトル(先頭が最新のブロック)
+        self.reference_spectra = np.zeros((num_partitions, bins), dtype=np.complex128)
+        # 各チャンネル, 各パーティションのフィルタ係数(周波数領域)
+        self.weights = np.zeros(shape + (num_partitions, bins), dtype=np.complex128)
+        # 参照信号の平滑化パワー(NLMSの正規化用)と, その指数平均に入った重みの合計(立ち上がりの補正用)
+        self.power = np.zeros(bins)
+        self.power_weight = 0.0
+
+        self.reference_frame = np.zeros(self.fft_size)
+        self.error_frame = np.zeros(shape + (self.fft_size,))
+
+        # Falseの間は係数を更新しない(ダブルトーク時など). 複数チャンネルならチャンネルごとのbool配列でもよい
+        self.adapt = True
+
+    def reset(self, keep_power=False):
+        """学習済みのエコー経路を破棄する
+
+        参照をずらして学習し直すだけなら, keep_power=True で参照信号のパワーの推定を残す
+        (遠端の声の大きさは変わらないので, 0から溜め直して立ち上がりのステップを荒らさない).
+        """
+        self.reference_spectra[:] = 0
+        self.weights[:] = 0
+        self.reference_frame[:] = 0
+        if not keep_power:
+            self.power[:] = 0
+            self.power_weight = 0.0
+
+    def process(self, reference, captured):
+        """1ブロック分の参照信号とマイク信号から, エコー除去後の信号を返す
+
+        Args:
+            reference (np.ndarray): 参照信号 (block_size サンプル, -1〜1)
+            captured (np.ndarray): マイク信号 (block_size サンプル, 複数チャンネルなら (channels, block_size), -1〜1)
+
+        Returns:
+            np.ndarray: エコー除去後の信号 (captured と同じ形)
+        """
+        error = captured - self.predict(reference)
+        if np.any(self.adapt):
+            self.update(error)
+        return error
+
+    def predict(self, reference):
+        """1ブロック分の参照信号を取り込み, そのブロックのエコー推定値を返す"""
+        block_size = self.block_size
+
+        # 参照フレームを1ブロックずらし, 最新のスペクトルを先頭に積む
+        self.reference_frame[:block_size] = self.reference_frame[block_size:]
+        self.reference_frame[block_size:] = reference
+        self.reference_spectra[1:] = self.reference_spectra[:-1]
+        self.reference_spectra[0] = np.fft.rfft(self.reference_frame)
+
+        # 全チャンネル, 全パーティションの畳み込みを一度に計算し, 後半ブロックをエコー推定値とする
+        echo_spectrum = np.einsum('pk,...pk->...k', self.reference_spectra, self.weights)
+        return np.fft.irfft(echo_spectrum, self.fft_size)[..., block_size:]
+
+    def update(self, error):
+        """直前にpredictしたブロックの誤差信号から係数を更新する(勾配拘束付き)"""
+        block_size = self.block_size
+
+        self.error_frame[..., block_size:] = error
+        error_spectrum = np.fft.rfft(self.error_frame)
+
+        spectra = self.reference_spectra
+        energy = (spectra.real ** 2 + spectra.imag ** 2).sum(axis=0)
+        self.power *= self.smoothing
+        self.power += (1 - self.smoothing) * energy
+        self.power_weight = self.smoothing * self.power_weight + (1 - self.smoothing)
+
+        # 0から始めた指数平均は立ち上がりで小さく出てステップが大きくなりすぎるので, 重みの合計で割って補正する.
+        # 数ブロック分の推定はビンごとのばらつきが大きいので, 平均が溜まるまでは全ビンの平均で下支えする
+        power = self.power / self.power_weight
+        power = np.maximum(power, (1 - self.power_weight) * power.mean())
+        normalized_error = self.step_size * error_spectrum / (power + self.regularization)
+        if np.ndim(self.adapt):
+            # 適応を止めたチャンネルは誤差を0にして係数を動かさない
+            normalized_error *= np.reshape(self.adapt, (-1, 1))
+        gradient = np.fft.irfft(spectra.conj() * normalized_error[..., None, :], self.fft_size)
+        # 巡回畳み込み成分を除くため, 時間領域で後半を0にする
+        gradient[..., block_size:] = 0
+        self.weights += np.fft.rfft(gradient)
@@ -0,0 +1,226 @@
+"""transport.pyのasyncio版
+
+1本のイベントループで多数の接続を扱うためのメディアチャネル. ハンドシェイクの内容と
+パケットの形式は transport.py と同じなので, スレッド版の e.py クライアントとそのままつながる.
+符号化・復号は1フレーム数十〜百数十usと短く, executorに回すほうが切り替えの分だけ遅いので
+ループ上で行う. ミックスなどの重い処理は呼び出し側がexecutorで行い, send_payload()で送る.
+"""
+import asyncio
+import json
+import random
+
+from codec import get_codec
+from transport import (MediaFrame, choose_channels, choose_media, make_hello, media_parameters, pack_rtp,
+                       parse_rtp)
+
+
+async def send_message(writer, message):
+    """制御チャネルにJSONを1行送る"""
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+
+async def recv_message(reader):
+    """制御チャネルからJSONを1行受け取る"""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("ハンドシェイク中に接続が切れました")
+    return json.loads(line)
+
+
+class AsyncChannel:
+    """非同期チャネルの共通部分"""
+
+    def __init__(self, frame_samples, sample_rate, codec_name, peer_channels=1):
+        self.frame_samples = frame_samples
+        self.sample_rate = sample_rate
+        self.channels = 1
+        self.peer_channels = peer_channels
+        self.encoder = get_codec(codec_name)
+        self.decoder = get_codec(codec_name, peer_channels)
+
+    async def send(self, data):
+        """16bit PCMを符号化して送る"""
+        self.send_payload(self.encoder.encode(data))
+        await self.drain()
+
+    async def recv(self):
+        """1フレームを受け取り, 復号したMediaFrameを返す(切断したらNone)"""
+        frame = await self.recv_payload()
+        if frame is None:
+            return None
+        return frame._replace(payload=self.decoder.decode(frame.payload))
+
+    async def drain(self):
+        pass
+
+    def backlog(self):
+        """送信待ちのバイト数"""
+        return 0
+
+
+class AsyncStreamChannel(AsyncChannel):
+    """TCPストリームで固定長のフレームを送受信する"""
+
+    def __init__(self, reader, writer, frame_samples, sample_rate, codec_name='pcm', peer_channels=1):
+        super().__init__(frame_samples, sample_rate, codec_name, peer_channels)
+        self.reader = reader
+        self.writer = writer
+        self.frame_size = self.decoder.encoded_size(frame_samples * peer_channels)
+        self.sequence = 0
+        self.timestamp = 0
+
+    def send_payload(self, payload):
+        """符号化済みのフレームを送る(書き込みバッファに積むだけで待たない)"""
+        if not self.writer.is_closing():
+            self.writer.write(payload)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def backlog(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    async def recv_payload(self):
+        try:
+            data = await self.reader.readexactly(self.frame_size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        frame = MediaFrame(self.sequence, self.timestamp, data)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.timestamp = (self.timestamp + self.frame_samples) & 0xFFFFFFFF
+        return frame
+
+    def close(self):
+        self.writer.close()
+
+
+class MediaProtocol(asyncio.DatagramProtocol):
+    """受信したデータグラムをキューに入れる(読み手が遅れたら新しいものを捨てる)"""
+
+    def __init__(self, max_queued=64):
+        self.packets = asyncio.Queue(maxsize=max_queued)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        try:
+            self.packets.put_nowait(data)
+        except asyncio.QueueFull:
+            pass
+
+
+class AsyncDatagramChannel(AsyncChannel):
+    """RTP形式のヘッダを付けたUDPデータグラムで送受信する. 制御用のTCPストリームも保持する"""
+
+    def __init__(self, writer, protocol, peer, ssrc, peer_ssrc, frame_samples, sample_rate, codec_name='pcm',
+                 timeout=3.0, peer_channels=1, reader=None):
+        super().__init__(frame_samples, sample_rate, codec_name, peer_channels)
+        self.writer = writer
+        self.protocol = protocol
+        self.peer = peer
+        self.ssrc = ssrc
+        self.peer_ssrc = peer_ssrc
+        self.timeout = timeout
+        self.sequence = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+        # 制御チャネルで相手の終了(bye)を待ち, 受信を止める
+        self.peer_left = False
+        self.watcher = asyncio.ensure_future(self._watch_control(reader)) if reader is not None else None
+
+    async def _watch_control(self, reader):
+        """相手が bye を送るか制御チャネルを切るまで待ち, peer_left にする"""
+        while True:
+            try:
+                line = await reader.readline()
+            except ConnectionError:
+                line = b''
+            if not line:
+                break
+            try:
+                if json.loads(line).get('type') == 'bye':
+                    break
+            except ValueError:
+                pass
+        self.peer_left = True
+        # 受信を待っているところへ終わりを知らせる(キューが一杯なら, 次の受信で peer_left を見る)
+        try:
+            self.protocol.packets.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    def send_payload(self, payload, sample_count=None):
+        if self.protocol.transport.is_closing():
+            return
+        if sample_count is None:
+            sample_count = self.frame_samples
+        packet = pack_rtp(self.encoder.payload_type, self.sequence, self.timestamp, self.ssrc, payload)
+        self.protocol.transport.sendto(packet, self.peer)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.timestamp = (self.timestamp + sample_count) & 0xFFFFFFFF
+
+    async def recv_payload(self):
+        while not self.peer_left:
+            try:
+                packet = await asyncio.wait_for(self.protocol.packets.get(), self.timeout)
+            except asyncio.TimeoutError:
+                return None
+            if packet is None:
+                return None
+            frame = parse_rtp(packet, self.peer_ssrc, self.decoder.payload_type)
+            if frame is not None:
+                return frame
+        return None
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+        try:
+            self.writer.write(json.dumps({'type': 'bye'}).encode() + b'\n')
+        except (ConnectionError, RuntimeError):
+            pass
+        self.protocol.transport.close()
+        self.writer.close()
+
+
+async def open_channel(reader, writer, is_server, options, frame_samples, sample_rate):
+    """制御チャネルでハンドシェイクし, 音声用の非同期チャネルを返す(手順は transport.open_channel と同じ)
+
+    サーバー側はミックスするので, 伝送路のレートは自分のレートに固定し(相手が変換する),
+    相手のチャンネル数に関わらずモノラルで送ってもらう. こちらからは常にモノラルで送る.
+    """
+    loop = asyncio.get_running_loop()
+    local_host = writer.get_extra_info('sockname')[0]
+    _, protocol = await loop.create_datagram_endpoint(MediaProtocol, local_addr=(local_host, 0))
+    ssrc = random.getrandbits(32)
+    hello = make_hello(protocol.transport.get_extra_info('sockname')[1], ssrc, sample_rate)
+
+    try:
+        if is_server:
+            request = await recv_message(reader)
+            transport, codec_name = choose_media(request)
+            wire_rate, wire_frames = sample_rate, frame_samples
+            peer_channels = choose_channels(request, max_channels=1)
+            await send_message(writer, dict(hello, transport=transport, codec=codec_name, wire_rate=wire_rate,
+                                            frame_samples=wire_frames, accepted_channels=peer_channels))
+            reply = request
+        else:
+            await send_message(writer, dict(hello, transport=options.transport, codec=options.codec))
+            reply = await recv_message(reader)
+            transport = reply['transport']
+            codec_name = reply.get('codec', 'pcm')
+            wire_rate, wire_frames = media_parameters(reply, sample_rate, frame_samples)
+            peer_channels = reply.get('channels', 1)
+    except (ConnectionError, ValueError):
+        protocol.transport.close()
+        raise
+
+    if transport == 'tcp':
+        protocol.transport.close()
+        return AsyncStreamChannel(reader, writer, wire_frames, wire_rate, codec_name, peer_channels)
+
+    peer = (writer.get_extra_info('peername')[0], reply['udp_port'])
+    return AsyncDatagramChannel(writer, protocol, peer, ssrc, reply['ssrc'], wire_frames, wire_rate, codec_name,
+                                peer_channels=peer_channels, reader=reader)
@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class AmplitudeRecorder:
+    """受信音声のRMS振幅を, 長い通話でも一定のメモリで記録する
+
+    段0には1パケットごとの値を, 段kには factor**k パケットごとの(最小, 最大, 平均)を
+    それぞれ容量 capacity のリングバッファに入れる. 古い細かい値は消えても,
+    粗い段に通話全体の概形が残る(既定では 4096パケット x 16倍 x 4段 で約1日分).
+    """
+
+    def __init__(self, capacity=4096, factor=16, levels=4):
+        self.capacity = capacity
+        self.factor = factor
+        self.levels = levels
+        # 段ごとの [時刻, 最小, 最大, 平均] と書き込み数
+        self.history = [np.zeros((4, capacity)) for _ in range(levels)]
+        self.counts = [0] * levels
+        # 上の段へ渡す前に集計中のバケット [開始時刻, 最小, 最大, 合計, 個数]
+        self.pending = [None] * levels
+        self.total = 0.0
+        self.count = 0
+        self.last = 0.0
+
+    def record(self, audio_data, timestamp):
+        """16bit PCMのRMS振幅を計算して記録し, その値を返す"""
+        samples = np.frombuffer(audio_data, dtype='<i2').astype(np.float32)
+        rms = float(np.sqrt(np.dot(samples, samples) / len(samples))) if len(samples) else 0.0
+        self.total += rms
+        self.count += 1
+        self.last = rms
+        self._push(0, timestamp, rms, rms, rms)
+        return rms
+
+    def _push(self, level, timestamp, low, high, mean):
+        index = self.counts[level] % self.capacity
+        column = self.history[level][:, index]
+        column[0], column[1], column[2], column[3] = timestamp, low, high, mean
+        self.counts[level] += 1
+
+        if level + 1 >= self.levels:
+            return
+        bucket = self.pending[level]
+        if bucket is None:
+            self.pending[level] = [timestamp, low, high, mean, 1]
+            return
+        bucket[1] = min(bucket[1], low)
+        bucket[2] = max(bucket[2], high)
+        bucket[3] += mean
+        bucket[4] += 1
+        if bucket[4] == self.factor:
+            self.pending[level] = None
+            self._push(level + 1, bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4])
+
+    def mean(self):
+        """通話全体の平均RMS振幅"""
+        return self.total / self.count if self.count else 0.0
+
+    def _pending_bucket(self, level):
+        """段 level にまだ入っていない最近の値(下の段で集計中のバケット)を1つの (時刻, 最小, 最大, 平均) にまとめる"""
+        buckets = [(self.factor ** k, self.pending[k]) for k in range(level) if self.pending[k] is not None]
+        if not buckets:
+            return None
+        # 上の段のバケットほど古くから集計しているので, 開始時刻は最も上の段のもの
+        start = buckets[-1][1][0]
+        low = min(bucket[1] for _, bucket in buckets)
+        high = max(bucket[2] for _, bucket in buckets)
+        # 段kの値は factor**k パケット分の平均なので, パケット数で重みをつける
+        mean = (sum(weight * bucket[3] for weight, bucket in buckets)
+                / sum(weight * bucket[4] for weight, bucket in buckets))
+        return start, low, high, mean
+
+    def series(self, max_points=2000):
+        """通話全体を覆う最も細かい段を (時刻, 最小, 最大, 平均) の配列で返す(max_points以下に間引く)
+
+        最後には, まだその段に入っていない集計中のバケットを個数で平均した値を足す.
+        """
+        level = 0
+        while level + 1 < self.levels and self.counts[level] > self.capacity:
+            level += 1
+        count = min(self.counts[level], self.capacity)
+        start = self.counts[level] - count
+        order = (np.arange(count) + start) % self.capacity
+        times, lows, highs, means = self.history[level][:, order]
+        tail = self._pending_bucket(level)
+        if tail is not None:
+            times, lows, highs, means = (np.append(values, value) for values, value in zip(
+                (times, lows, highs, means), tail))
+            count += 1
+
+        # 表示用にさらに間引く(最小・最大は保ったまま. 最後の半端なグループも残す)
+        step = -(-count // max_points) if count > max_points else 1
+        if step > 1:
+            groups = np.arange(0, count, step)
+            sizes = np.diff(np.append(groups, count))
+            times = times[groups]
+            lows = np.minimum.reduceat(lows, groups)
+            highs = np.maximum.reduceat(highs, groups)
+            means = np.add.reduceat(means, groups) / sizes
+        return times, lows, highs, means
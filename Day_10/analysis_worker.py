@@ -0,0 +1,38 @@
+import threading
+from collections import namedtuple
+
+# 遅延推定の結果. 音声スレッドはこのタプルへの参照を1回読むだけなので,
+# 解析スレッドが差し替えても常に一貫した組を見る
+DelayEstimate = namedtuple('DelayEstimate', ['delay_samples', 'correlation', 'gain', 'confidence', 'timestamp'])
+
+INITIAL_ESTIMATE = DelayEstimate(delay_samples=0, correlation=0.0, gain=1.0, confidence=0.0, timestamp=0.0)
+
+
+class AnalysisWorker(threading.Thread):
+    """遅延推定などの重い解析を音声スレッドの外で実行するワーカー
+
+    音声スレッドは request.set() で解析を依頼するだけで, FFTの完了を待たない.
+    依頼が溜まっても解析は最新のスナップショットに対して1回だけ行う.
+    """
+
+    def __init__(self, task, request):
+        super().__init__(daemon=True)
+        self.task = task        # 依頼ごとに呼ぶ関数(スナップショット取得から結果の公開まで)
+        self.request = request  # 音声スレッドと共有するthreading.Event
+        self.running = True
+
+    def run(self):
+        while True:
+            self.request.wait()
+            self.request.clear()
+            if not self.running:
+                break
+            try:
+                self.task()
+            except Exception as e:
+                print(f"解析ワーカーでエラー: {e}")
+
+    def stop(self):
+        """ワーカーを終了させる"""
+        self.running = False
+        self.request.set()
@@ -0,0 +1,352 @@
+"""音声の入出力(マイク/スピーカー)を差し替えられるようにするバックエンド
+
+send_audioはAudioSource.read()で録音データを読み, recv_audioはAudioSink.write()で再生する.
+- sox:      rec/playをサブプロセスで起動しパイプでやり取りする(従来どおり)
+- file:     ファイルから読み, ファイルへ書く(入力は実時間のペースで読む)
+- loopback: 再生した音声を遅延させてマイク入力に戻す仮想デバイス(サウンドカード不要)
+- callback: PortAudio(sounddevice)のコールバックで, 小さなバッファを明示して入出力する
+マイクは --channels で複数チャンネル(インターリーブした16bit PCM)にでき, 再生はモノラル.
+"""
+import argparse
+import queue
+import subprocess
+import threading
+import time
+import wave
+
+import numpy as np
+
+BACKENDS = ('sox', 'file', 'loopback', 'callback')
+
+
+class AudioSource:
+    """録音側の共通インターフェース"""
+
+    def read(self, size):
+        """sizeバイトの16bit PCMを返す(終了時は空のbytes)"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class AudioSink:
+    """再生側の共通インターフェース"""
+
+    def write(self, data):
+        """16bit PCMを再生する"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class Pacer:
+    """サンプル数に合わせて実時間のペースで待つ"""
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.start = None
+        self.samples = 0
+
+    def wait(self, sample_count):
+        if self.start is None:
+            self.start = time.monotonic()
+        self.samples += sample_count
+        delay = self.start + self.samples / self.sample_rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SoxSource(AudioSource):
+    """recコマンドからパイプで録音データを読む"""
+
+    def __init__(self, audio_format):
+        self.process = subprocess.Popen(['rec'] + audio_format, stdout=subprocess.PIPE)
+
+    def read(self, size):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        self.process.terminate()
+
+
+class SoxSink(AudioSink):
+    """playコマンドへパイプで再生データを書く"""
+
+    def __init__(self, audio_format):
+        self.process = subprocess.Popen(['play'] + audio_format, stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.terminate()
+
+
+class FileSource(AudioSource):
+    """WAV(16bit)またはrawファイルから読む. realtime=Trueなら実時間のペースで返す"""
+
+    def __init__(self, path, sample_rate, channels=1, realtime=True):
+        if path.lower().endswith('.wav'):
+            with wave.open(path, 'rb') as f:
+                if f.getsampwidth() != 2 or f.getframerate() != sample_rate or f.getnchannels() != channels:
+                    raise ValueError(f"{path}: {sample_rate}Hz, {channels}ch, 16bitのWAVのみ対応しています")
+                self.data = f.readframes(f.getnframes())
+        else:
+            with open(path, 'rb') as f:
+                self.data = f.read()
+        self.position = 0
+        self.frame_bytes = 2 * channels
+        self.pacer = Pacer(sample_rate) if realtime else None
+
+    def read(self, size):
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        if chunk and self.pacer is not None:
+            self.pacer.wait(len(chunk) // self.frame_bytes)
+        return chunk
+
+
+class FileSink(AudioSink):
+    """WAVまたはrawファイルに書く"""
+
+    def __init__(self, path, sample_rate, channels=1):
+        if path.lower().endswith('.wav'):
+            self.file = wave.open(path, 'wb')
+            self.file.setnchannels(channels)
+            self.file.setsampwidth(2)
+            self.file.setframerate(sample_rate)
+            self.write_bytes = self.file.writeframes
+        else:
+            self.file = open(path, 'wb')
+            self.write_bytes = self.file.write
+
+    def write(self, data):
+        self.write_bytes(data)
+
+    def close(self):
+        self.file.close()
+
+
+class Loopback:
+    """再生した音声をdelay_s遅らせ, gain倍してマイク入力に戻す仮想デバイス
+
+    source.read()は実時間のペースで返り, 再生データが足りない間は無音を返す.
+    マイクが複数チャンネルなら, 再生音声をモノラルにしてから各チャンネルに戻す
+    (スピーカーからの距離の違いの代わりに, 後のチャンネルほど小さくする).
+    """
+
+    def __init__(self, sample_rate, delay_s=0.1, gain=0.5, channels=1, playback_channels=1):
+        self.sample_rate = sample_rate
+        self.gain = gain
+        self.gains = gain * np.linspace(1.0, 0.6, channels)
+        self.playback_channels = playback_channels
+        self.frame_bytes = 2 * channels
+        self.lock = threading.Lock()
+        # 遅延分の無音を先に詰めておく
+        self.pending = bytearray(int(delay_s * sample_rate) * self.frame_bytes)
+        self.closed = False
+        self.source = LoopbackSource(self)
+        self.sink = LoopbackSink(self)
+
+
+class LoopbackSource(AudioSource):
+    def __init__(self, loopback):
+        self.loopback = loopback
+        self.pacer = Pacer(loopback.sample_rate)
+
+    def read(self, size):
+        loopback = self.loopback
+        if loopback.closed:
+            return b''
+        self.pacer.wait(size // loopback.frame_bytes)
+        with loopback.lock:
+            chunk = bytes(loopback.pending[:size])
+            del loopback.pending[:size]
+        return chunk + bytes(size - len(chunk))
+
+    def close(self):
+        self.loopback.closed = True
+
+
+class LoopbackSink(AudioSink):
+    def __init__(self, loopback):
+        self.loopback = loopback
+
+    def write(self, data):
+        loopback = self.loopback
+        samples = np.frombuffer(data, dtype='<i2', count=len(data) // 2).reshape(-1, loopback.playback_channels)
+        samples = samples.mean(axis=1, keepdims=True) * loopback.gains
+        echoed = np.clip(samples, -32768, 32767).astype('<i2').tobytes()
+        with loopback.lock:
+            loopback.pending += echoed
+
+    def close(self):
+        self.loopback.closed = True
+
+
+def import_sounddevice():
+    """callbackバックエンド用にsounddeviceを読み込む(未インストールならわかるように失敗する)"""
+    try:
+        import sounddevice
+    except ImportError as e:
+        raise RuntimeError("callbackバックエンドには sounddevice が必要です (pip install sounddevice)") from e
+    return sounddevice
+
+
+class CallbackSource(AudioSource):
+    """PortAudioの入力コールバックで受け取ったブロックをキューから読む
+
+    close()の後は, 待っているread()も含めて空のbytesを返す(キューに終わりの印を入れ, 入れられなくても
+    poll_s ごとに閉じたかを確かめる).
+    """
+
+    def __init__(self, sample_rate, block_size, channels=1, latency='low', max_blocks=64, poll_s=0.1):
+        sounddevice = import_sounddevice()
+        self.blocks = queue.Queue(maxsize=max_blocks)
+        self.remainder = bytearray()
+        self.poll_s = poll_s
+        self.closed = False
+        self.stream = sounddevice.RawInputStream(
+            samplerate=sample_rate, blocksize=block_size, channels=channels,
+            dtype='int16', latency=latency, callback=self._callback)
+        self.stream.start()
+
+    def _callback(self, indata, frames, time_info, status):
+        try:
+            self.blocks.put_nowait(bytes(indata))
+        except queue.Full:
+            pass  # 読み手が遅れている間は新しいブロックを捨てる
+
+    def read(self, size):
+        # 足りない分を bytearray に継ぎ足し, 余りは次の read に回す
+        data = self.remainder
+        while len(data) < size:
+            if self.closed:
+                return b''
+            try:
+                block = self.blocks.get(timeout=self.poll_s)
+            except queue.Empty:
+                continue
+            if block is None:
+                return b''
+            data += block
+        chunk = bytes(data[:size])
+        del data[:size]
+        return chunk
+
+    def close(self):
+        self.closed = True
+        try:
+            self.blocks.put_nowait(None)
+        except queue.Full:
+            pass  # read()は poll_s 以内に closed に気づく
+        self.stream.stop()
+        self.stream.close()
+
+
+class CallbackSink(AudioSink):
+    """書き込まれたデータを溜め, PortAudioの出力コールバックで取り出す(足りなければ無音)
+
+    溜まったデータが max_blocks ブロックを超えたら古い方から捨て, 再生の遅れが際限なく伸びないようにする.
+    """
+
+    def __init__(self, sample_rate, block_size, channels=1, latency='low', max_blocks=64):
+        sounddevice = import_sounddevice()
+        self.lock = threading.Lock()
+        self.pending = bytearray()
+        self.frame_bytes = 2 * channels
+        self.max_pending = max_blocks * block_size * self.frame_bytes
+        self.dropped_bytes = 0
+        self.stream = sounddevice.RawOutputStream(
+            samplerate=sample_rate, blocksize=block_size, channels=channels,
+            dtype='int16', latency=latency, callback=self._callback)
+        self.stream.start()
+
+    def _callback(self, outdata, frames, time_info, status):
+        size = len(outdata)
+        with self.lock:
+            chunk = self.pending[:size]
+            del self.pending[:size]
+        outdata[:len(chunk)] = chunk
+        outdata[len(chunk):] = bytes(size - len(chunk))
+
+    def write(self, data):
+        with self.lock:
+            self.pending += data
+            excess = len(self.pending) - self.max_pending
+            if excess > 0:
+                # フレームの途中で切らないよう, フレーム単位で古い方から捨てる
+                excess += -excess % self.frame_bytes
+                del self.pending[:excess]
+                self.dropped_bytes += excess
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+
+def deinterleave(data, channels):
+    """インターリーブした16bit PCMを (channels, サンプル数) のビューにする(コピーしない)
+
+    各行はチャンネルごとの飛び飛びの(strided)ビューになる. モノラルなら1次元のまま返す.
+    """
+    samples = np.frombuffer(data, dtype='<i2', count=len(data) // 2)
+    if channels == 1:
+        return samples
+    return samples.reshape(-1, channels).T
+
+
+def downmix(data, channels):
+    """インターリーブした16bit PCMをチャンネルの平均でモノラルにする"""
+    if channels == 1:
+        return data
+    mixed = deinterleave(data, channels).mean(axis=0)
+    return np.rint(mixed).astype('<i2').tobytes()
+
+
+def with_channels(audio_format, channels):
+    """SoXのオーディオ設定のチャンネル数(-c)を差し替えたコピーを返す"""
+    audio_format = list(audio_format)
+    audio_format[audio_format.index('-c') + 1] = str(channels)
+    return audio_format
+
+
+def parse_audio_options(argv):
+    """コマンドライン引数から音声バックエンドのオプションを取り出し, (残りの引数, オプション)を返す"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--backend', choices=BACKENDS, default='sox')
+    parser.add_argument('--input', help="fileバックエンドの入力ファイル")
+    parser.add_argument('--output', help="fileバックエンドの出力ファイル")
+    parser.add_argument('--loopback-delay', type=float, default=0.1, help="loopbackの遅延(秒)")
+    parser.add_argument('--loopback-gain', type=float, default=0.5, help="loopbackの音量")
+    parser.add_argument('--latency', default='low', help="callbackバックエンドのレイテンシ(秒または'low')")
+    parser.add_argument('--channels', type=int, default=1, help="マイクのチャンネル数")
+    options, rest = parser.parse_known_args(argv)
+    if options.latency != 'low':
+        options.latency = float(options.latency)
+    if options.channels < 1:
+        raise ValueError(f"チャンネル数は1以上にしてください: {options.channels}")
+    return rest, options
+
+
+def open_audio(options, audio_format, sample_rate, block_size, channels=1, playback_channels=1):
+    """オプションで選ばれたバックエンドの(AudioSource, AudioSink)を作る
+
+    channels はマイク, playback_channels はスピーカーのチャンネル数(SoXの -c は差し替える).
+    """
+    if options.backend == 'sox':
+        return SoxSource(with_channels(audio_format, channels)), SoxSink(with_channels(audio_format, playback_channels))
+    if options.backend == 'file':
+        if not options.input or not options.output:
+            raise ValueError("fileバックエンドには --input と --output が必要です")
+        return (FileSource(options.input, sample_rate, channels),
+                FileSink(options.output, sample_rate, playback_channels))
+    if options.backend == 'loopback':
+        loopback = Loopback(sample_rate, options.loopback_delay, options.loopback_gain, channels, playback_channels)
+        return loopback.source, loopback.sink
+    if options.backend == 'callback':
+        return (CallbackSource(sample_rate, block_size, channels, options.latency),
+                CallbackSink(sample_rate, block_size, playback_channels, options.latency))
+    raise ValueError(f"不明なバックエンド: {options.backend}")
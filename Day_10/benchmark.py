@@ -0,0 +1,246 @@
+"""パケットごとの処理にかかる時間を測るベンチマーク
+
+使い方:
+    python benchmark.py [--buffer-sizes 256 512 1024] [--iterations 2000] [--compare 前回.json]
+
+d.py(44.1kHz)とe.py(48kHz)の各処理を, BUFFER_SIZEごとに1パケットずつ繰り返し実行し,
+p50/p99と実時間の予算(1パケット分の再生時間)に対する比を表示する.
+結果は benchmarks/<コミット>.json に保存し, --compare で前回の結果と比べて
+p99の比が閾値以上悪化した項目があれば終了コード1を返す.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import d
+import e
+from amplitude_recorder import AmplitudeRecorder
+from codec import get_codec
+from gain_stage import GainStage
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+
+def make_packets(buffer_size, count, seed=0):
+    """受信音声と, それを遅らせて混ぜたマイク音声のパケット列を作る"""
+    rng = np.random.default_rng(seed)
+    sample_count = buffer_size // 2
+    far = (rng.standard_normal(sample_count * count) * 3000).astype('<i2')
+    mic = np.zeros_like(far)
+    mic[1000:] = far[:-1000] // 2
+    mic += (rng.standard_normal(len(mic)) * 300).astype('<i2')
+    split = lambda x: [x[i:i + sample_count].tobytes() for i in range(0, len(x), sample_count)]
+    return split(far), split(mic)
+
+
+def time_stage(function, packets, warmup=100):
+    """packetsを1つずつfunctionに渡し, 1回ごとの処理時間(秒)を返す"""
+    for packet in packets[:warmup]:
+        function(packet)
+    times = np.empty(len(packets) - warmup)
+    for i, packet in enumerate(packets[warmup:]):
+        begin = time.perf_counter_ns()
+        function(packet)
+        times[i] = time.perf_counter_ns() - begin
+    return times / 1e9
+
+
+def rms_bookkeeping():
+    """play_audioでのRMS計算と記録"""
+    recorder = AmplitudeRecorder()
+
+    def record(packet):
+        recorder.record(packet, time.time())
+    return record
+
+
+def benchmark_d(buffer_size, iterations):
+    """d.py(エコーキャンセルなし, 44.1kHz)の各処理"""
+    far, mic = make_packets(buffer_size, iterations)
+    block_size = buffer_size // 2
+
+    canceller = d.EchoCanceller(sample_rate=44100, block_size=block_size)
+    canceller.add_sent_audio(mic[0])
+    results = {
+        'add_sent_audio': time_stage(canceller.add_sent_audio, mic),
+        'process_received_audio': time_stage(canceller.process_received_audio, far),
+        'rms': time_stage(rms_bookkeeping(), far),
+    }
+    results['analyze'] = time_analysis(d.EchoCanceller(sample_rate=44100, block_size=block_size), far, mic)
+
+    # 1パケットあたりの送受信の処理全体
+    canceller = d.EchoCanceller(sample_rate=44100, block_size=block_size)
+    record = rms_bookkeeping()
+
+    def packet_path(index):
+        canceller.add_sent_audio(mic[index])
+        record(canceller.process_received_audio(far[index]))
+    results['packet_total'] = time_stage(packet_path, list(range(len(far))))
+    return 44100, block_size, results
+
+
+def benchmark_e(buffer_size, iterations):
+    """e.py(エコーキャンセルあり, 48kHz)の各処理"""
+    far, mic = make_packets(buffer_size, iterations)
+    block_size = buffer_size // 2
+
+    canceller = e.EchoCanceller(sample_rate=48000, block_size=block_size, verbose=False)
+    stage = GainStage(volume=e.OUTPUT_VOLUME, block_size=block_size)
+    for packet in far:
+        canceller.process_received_audio(packet)
+    results = {
+        'add_sent_audio': time_stage(canceller.add_sent_audio, mic),
+        'cancel_echo': time_stage(canceller.cancel_echo, mic),
+        'gain_stage': time_stage(lambda packet: stage.process(packet, 1.0), mic),
+        'process_received_audio': time_stage(canceller.process_received_audio, far),
+        'rms': time_stage(rms_bookkeeping(), far),
+    }
+    for name in ('ulaw', 'adpcm'):
+        encoder, decoder = get_codec(name), get_codec(name)
+        results[f'{name}_encode'] = time_stage(encoder.encode, mic)
+        results[f'{name}_decode'] = time_stage(decoder.decode, [encoder.encode(packet) for packet in far])
+    results['analyze'] = time_analysis(e.EchoCanceller(sample_rate=48000, block_size=block_size, verbose=False),
+                                       far, mic)
+
+    # 1パケットあたりの送受信の処理全体
+    canceller = e.EchoCanceller(sample_rate=48000, block_size=block_size, verbose=False)
+    stage = GainStage(volume=e.OUTPUT_VOLUME, block_size=block_size)
+    record = rms_bookkeeping()
+
+    def packet_path(index):
+        record(canceller.process_received_audio(far[index]))
+        e.process_captured_audio(mic[index], canceller, stage)
+    results['packet_total'] = time_stage(packet_path, list(range(len(far))))
+    return 48000, block_size, results
+
+
+def time_analysis(canceller, far, mic, interval=e.ANALYSIS_INTERVAL):
+    """解析ワーカーがANALYSIS_INTERVALパケットごとに行う遅延推定の1回あたりの時間"""
+    times = []
+    for i, (far_packet, mic_packet) in enumerate(zip(far, mic)):
+        canceller.add_sent_audio(mic_packet)
+        canceller.process_received_audio(far_packet)
+        if (i + 1) % interval == 0:
+            begin = time.perf_counter_ns()
+            canceller.analyze()
+            times.append(time.perf_counter_ns() - begin)
+    return np.array(times) / 1e9
+
+
+def summarize(sample_rate, block_size, stage_times, interval=e.ANALYSIS_INTERVAL):
+    """各処理のp50/p99と実時間の予算に対する比をまとめる"""
+    budget = block_size / sample_rate
+    summary = {}
+    for stage, times in stage_times.items():
+        if len(times) == 0:
+            continue
+        p50, p99 = np.percentile(times, [50, 99])
+        # 解析はintervalパケットに1回なので, 予算もintervalパケット分で比べる
+        stage_budget = budget * interval if stage == 'analyze' else budget
+        summary[stage] = {
+            'p50_us': p50 * 1e6,
+            'p99_us': p99 * 1e6,
+            'p50_ratio': p50 / stage_budget,
+            'p99_ratio': p99 / stage_budget,
+        }
+    return summary
+
+
+def git_revision():
+    """現在のコミットのハッシュ(取得できなければ'unknown')"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return 'unknown'
+
+
+def print_results(results):
+    """結果を表形式で表示する"""
+    for key, entry in results['runs'].items():
+        print(f"\n[{key}] 予算 {entry['budget_us']:.0f}us/パケット")
+        print(f"{'処理':<24}{'p50(us)':>10}{'p99(us)':>10}{'p50比':>9}{'p99比':>9}")
+        for stage, stats in entry['stages'].items():
+            print(f"{stage:<24}{stats['p50_us']:>10.1f}{stats['p99_us']:>10.1f}"
+                  f"{stats['p50_ratio']:>9.4f}{stats['p99_ratio']:>9.4f}")
+
+
+def compare(results, baseline, threshold, min_ratio):
+    """前回の結果と比べ, p99の比が閾値以上悪化した項目を返す
+
+    予算に対してmin_ratio未満の軽い処理は測定のばらつきが大きいので悪化とみなさない.
+    """
+    regressions = []
+    for key, entry in results['runs'].items():
+        old_entry = baseline['runs'].get(key)
+        if old_entry is None:
+            continue
+        for stage, stats in entry['stages'].items():
+            old = old_entry['stages'].get(stage)
+            if old is None:
+                continue
+            change = stats['p99_ratio'] / old['p99_ratio'] - 1
+            regressed = change > threshold and stats['p99_ratio'] >= min_ratio
+            marker = ' ←悪化' if regressed else ''
+            print(f"{key} {stage:<24}p99比 {old['p99_ratio']:.4f} → {stats['p99_ratio']:.4f} "
+                  f"({change * 100:+.1f}%){marker}")
+            if regressed:
+                regressions.append((key, stage, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="パケットごとの処理のベンチマーク")
+    parser.add_argument('--buffer-sizes', type=int, nargs='+', default=[256, 512, 1024, 2048],
+                        help="BUFFER_SIZE(バイト)")
+    parser.add_argument('--iterations', type=int, default=2000, help="1項目あたりのパケット数")
+    parser.add_argument('--output', help="結果の保存先(省略時は benchmarks/<コミット>.json)")
+    parser.add_argument('--compare', help="比較する前回の結果のJSON")
+    parser.add_argument('--threshold', type=float, default=0.1, help="悪化とみなすp99比の増加率")
+    parser.add_argument('--min-ratio', type=float, default=0.01, help="悪化の判定対象にするp99比の下限")
+    args = parser.parse_args()
+
+    revision = git_revision()
+    results = {
+        'revision': revision,
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'machine': platform.platform(),
+        'runs': {},
+    }
+    for buffer_size in args.buffer_sizes:
+        for name, run in (('d', benchmark_d), ('e', benchmark_e)):
+            sample_rate, block_size, stage_times = run(buffer_size, args.iterations)
+            results['runs'][f"{name}.py/{sample_rate}Hz/{buffer_size}B"] = {
+                'sample_rate': sample_rate,
+                'buffer_size': buffer_size,
+                'budget_us': block_size / sample_rate * 1e6,
+                'stages': summarize(sample_rate, block_size, stage_times),
+            }
+    print_results(results)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n結果を保存しました: {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\n{baseline['revision']} との比較")
+        regressions = compare(results, baseline, args.threshold, args.min_ratio)
+        if regressions:
+            print(f"{len(regressions)}項目で実時間比が悪化しました")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
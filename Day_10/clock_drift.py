@@ -0,0 +1,123 @@
+"""独立したクロックどうしのずれ(ドリフト)の推定
+
+- DriftEstimator: 受信したフレームのメディアタイムスタンプと到着時刻から, 相手の録音のクロックが
+  自分の時計よりどれだけ速いかを推定する. ジッタバッファが再生の速さの補正に使う
+- EchoDriftTracker: 推定したエコーの遅延の傾きから, 自分のマイクとスピーカーのクロックのずれを推定する.
+  e.pyがエコーキャンセラの参照信号のレート変換の比に使う
+
+どちらも resampler.FractionalResampler の比を少しずつ変えて補正するので, バッファの深さや
+エコーの遅延が一定に保たれ, フレームの間引き/挿入やフィルタの学習し直しが起きない.
+"""
+import numpy as np
+
+
+class DriftEstimator:
+    """メディアタイムスタンプ(相手のサンプル数)と到着時刻(自分の時計)の回帰直線の傾きからドリフトを求める
+
+    ネットワークの揺らぎで到着時刻はばらつくので, time_constant_s 程度の長い時間の指数重み付き最小二乗で
+    平滑化する. 観測が min_span_s 秒分たまるまでは 0 を返す. 傾きが stable_s 秒の間 ±tolerance_ppm 以内に
+    留まったときだけ drift を更新するので, 通話の始めの送信の揺れなどで推定がさまよっている間は補正しない.
+    結果は ±max_ppm に制限する.
+    """
+
+    def __init__(self, sample_rate, time_constant_s=60.0, min_span_s=30.0, stable_s=10.0, tolerance_ppm=20.0,
+                 max_ppm=1000.0):
+        self.sample_rate = sample_rate
+        self.time_constant_s = time_constant_s
+        self.min_span_s = min_span_s
+        self.stable_s = stable_s
+        self.tolerance = tolerance_ppm * 1e-6
+        self.max_drift = max_ppm * 1e-6
+
+        self.origin = None       # (最初の到着時刻, 最初のタイムスタンプ)
+        self.last_timestamp = None
+        self.unwrapped = 0       # 折り返しを直したタイムスタンプ(最初のフレームから)
+        self.last_time = None
+        # 重み付きの和: 重み, x, y, x^2, xy (xは到着時刻, yはタイムスタンプの時刻とのずれ. どちらも秒)
+        self.sums = np.zeros(5)
+        self.drift = 0.0
+        # 公開の候補の傾きと, その傾きの近くに留まり始めた時刻
+        self.candidate = None
+        self.candidate_since = 0.0
+
+    def observe(self, timestamp, arrival):
+        """1フレームの(メディアタイムスタンプ, 到着時刻)を入れる"""
+        if self.origin is None:
+            self.origin = arrival
+            self.last_timestamp = timestamp
+            self.last_time = 0.0
+        delta = ((timestamp - self.last_timestamp + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+        self.last_timestamp = timestamp
+        self.unwrapped += delta
+
+        x = arrival - self.origin
+        y = self.unwrapped / self.sample_rate - x
+        # 経過時間に応じて古い観測を忘れる
+        self.sums *= np.exp(-(x - self.last_time) / self.time_constant_s)
+        self.last_time = x
+        self.sums += (1.0, x, y, x * x, x * y)
+
+        weight, sx, sy, sxx, sxy = self.sums
+        variance = weight * sxx - sx * sx
+        if x < self.min_span_s or variance <= 0:
+            return
+        slope = (weight * sxy - sx * sy) / variance
+        if self.candidate is None or abs(slope - self.candidate) > self.tolerance:
+            self.candidate = slope
+            self.candidate_since = x
+        elif x - self.candidate_since >= self.stable_s:
+            self.drift = float(np.clip(slope, -self.max_drift, self.max_drift))
+
+    @property
+    def ppm(self):
+        return self.drift * 1e6
+
+
+class EchoDriftTracker:
+    """エコーの遅延(サンプル)をマイクの位置に対して直線で近似し, 傾きから参照信号の変換の比を求める
+
+    遅延は通話の間ほぼ一定のはずで, 増えていくならマイクのクロックがスピーカーより速い.
+    window_s 秒分の遅延の推定が集まるたびに傾きを求めて ratio に掛け, 集め直す
+    (補正が効いていれば次の傾きは0に近づく). 続けて入れた遅延が jump_tolerance より大きく跳んだら
+    エコー経路が変わったとみなして, それまでの窓を捨てる.
+    """
+
+    def __init__(self, sample_rate, window_s=20.0, min_points=10, jump_tolerance=64, max_ppm=1000.0):
+        self.sample_rate = sample_rate
+        self.window_samples = int(window_s * sample_rate)
+        self.min_points = min_points
+        self.jump_tolerance = jump_tolerance
+        self.max_drift = max_ppm * 1e-6
+        self.positions = []
+        self.delays = []
+        self.weights = []
+        # 参照信号の 出力サンプル数 / 入力サンプル数(resampler.FractionalResampler.ratio)
+        self.ratio = 1.0
+        self.corrections = 0
+
+    @property
+    def ppm(self):
+        return (self.ratio - 1) * 1e6
+
+    def update(self, position, delay_samples, weight):
+        """マイクの通算位置 position での遅延の推定を入れる. 比を更新したらTrueを返す"""
+        if self.delays and abs(delay_samples - self.delays[-1]) > self.jump_tolerance:
+            self.reset()
+        self.positions.append(position)
+        self.delays.append(delay_samples)
+        self.weights.append(weight)
+        if position - self.positions[0] < self.window_samples or len(self.delays) < self.min_points:
+            return False
+
+        positions = np.array(self.positions, dtype=np.float64)
+        slope = np.polyfit(positions - positions[0], self.delays, 1, w=np.sqrt(self.weights))[0]
+        self.reset()
+        # 遅延が増えている(参照が足りない)なら参照を伸ばす
+        self.ratio = float(np.clip(self.ratio * (1 + slope), 1 - self.max_drift, 1 + self.max_drift))
+        self.corrections += 1
+        return True
+
+    def reset(self):
+        self.positions = []
+        self.delays = []
+        self.weights = []
@@ -0,0 +1,271 @@
+"""音声パケットの圧縮(コーデック)
+
+16bit リニアPCMの代わりに送ることで, 1通話あたりの帯域を減らす.
+- pcm:   16bit リニアPCM(圧縮なし)
+- ulaw:  G.711 μ-law. 1サンプル8bit(1/2)
+- adpcm: IMA-ADPCM(RTPのDVI4と同じ形). 1サンプル4bit + パケットごとに4バイトのヘッダ(約1/4)
+         ヘッダに予測値と量子化幅の番号を入れるので, パケットが欠けても次のパケットから復号できる.
+         サンプル数が奇数なら最後の4bitは埋め草で, ヘッダの予約のバイトを1にして知らせる
+複数チャンネルの音声はインターリーブのまま送る. pcm, ulawはサンプルごとの変換なのでそのまま使え,
+adpcmはチャンネルごとに予測するので, パケットに チャンネルごとの ヘッダ + 符号 を順に並べる.
+"""
+import struct
+
+import numpy as np
+
+CODECS = ('pcm', 'ulaw', 'adpcm')
+
+# G.711 μ-law(14bitに落としてから8区間に分けて量子化する)
+ULAW_BIAS = 0x84
+ULAW_CLIP = 8159
+# 14bitの値 >> 6 から区間の番号を引く表
+ULAW_SEGMENTS = np.array([i.bit_length() for i in range(128)], dtype=np.int32)
+
+
+def _ulaw_decode_table():
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (codes >> 4) & 0x07
+    mantissa = codes & 0x0F
+    magnitude = ((mantissa << 3) + ULAW_BIAS << exponent) - ULAW_BIAS
+    return np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+ULAW_DECODE = _ulaw_decode_table()
+
+
+def ulaw_encode(samples):
+    """16bit PCM(int16の配列)をμ-lawのバイト列(uint8の配列)にする"""
+    values = samples.astype(np.int32) >> 2
+    mask = np.where(values < 0, 0x7F, 0xFF)
+    values = np.minimum(np.abs(values), ULAW_CLIP) + (ULAW_BIAS >> 2)
+    np.minimum(values, 0x1FFF, out=values)
+    segment = ULAW_SEGMENTS[values >> 6]
+    mantissa = (values >> (segment + 1)) & 0x0F
+    return (((segment << 4) | mantissa) ^ mask).astype(np.uint8)
+
+
+def ulaw_decode(codes):
+    """μ-lawのバイト列を16bit PCM(int16の配列)に戻す"""
+    return ULAW_DECODE[codes]
+
+
+# IMA-ADPCM
+ADPCM_STEPS = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307,
+    337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066,
+    2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899,
+    15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767,
+]
+ADPCM_INDEX_ADJUST = [-1, -1, -1, -1, 2, 4, 6, 8] * 2
+ADPCM_HEADER = struct.Struct('!hBB')  # 予測値, 量子化幅の番号, 最後の4bitが埋め草なら1(DVI4の予約)
+
+
+def _adpcm_tables():
+    """(量子化幅の番号, 符号)ごとの予測値の増分と次の番号の表"""
+    differences = []
+    next_indices = []
+    for index, step in enumerate(ADPCM_STEPS):
+        row = []
+        for code in range(16):
+            difference = step >> 3
+            if code & 4:
+                difference += step
+            if code & 2:
+                difference += step >> 1
+            if code & 1:
+                difference += step >> 2
+            row.append(-difference if code & 8 else difference)
+        differences.append(row)
+        next_indices.append([min(max(index + ADPCM_INDEX_ADJUST[code], 0), 88) for code in range(16)])
+    return differences, next_indices
+
+
+ADPCM_DIFFERENCES, ADPCM_NEXT_INDEX = _adpcm_tables()
+ADPCM_DIFFERENCE_ARRAY = np.array(ADPCM_DIFFERENCES, dtype=np.int32)
+ADPCM_INDEX_ADJUST_ARRAY = np.array(ADPCM_INDEX_ADJUST, dtype=np.int64)
+
+
+def _adpcm_encode_rows():
+    """量子化幅の番号ごとの (|差分|→符号の大きさ の表, 表の長さ, 予測値の増分, 次の番号)
+
+    符号の大きさ(0〜7)は|差分|について単調なので, 大きさ7になる|差分|までを1バイトずつの表にする.
+    """
+    rows = []
+    for index, step in enumerate(ADPCM_STEPS):
+        # 大きさ m の符号になる最小の|差分|(step, step/2, step/4 を順に引く量子化と同じ境目)
+        thresholds = [(m >> 2) * step + (m >> 1 & 1) * (step >> 1) + (m & 1) * (step >> 2) for m in range(1, 8)]
+        table = np.searchsorted(thresholds, np.arange(thresholds[-1]), side='right').astype(np.uint8)
+        rows.append((table.tobytes(), thresholds[-1], tuple(ADPCM_DIFFERENCES[index]),
+                     tuple(ADPCM_NEXT_INDEX[index])))
+    return rows
+
+
+ADPCM_ENCODE_ROWS = _adpcm_encode_rows()
+
+
+def _clamped_cumsum(start, increments, low, high):
+    """start に increments を順に足し, 足すたびに [low, high] にクリップした値の列を返す
+
+    下限だけで止まる区間は累積和から累積最小値の分を持ち上げ, 上限だけで止まる区間は累積最大値の分を
+    下げればまとめて求まる. 反対側の限界に達したところから, もう一方の向きで続きを求める.
+    """
+    output = np.cumsum(increments, dtype=np.int64)
+    output += start
+    if output.min() >= low and output.max() <= high:
+        return output
+    position = 0
+    value = start
+    lower = True
+    while position < len(output):
+        total = np.cumsum(increments[position:], dtype=np.int64)
+        total += value
+        if lower:
+            values = total - np.minimum(np.minimum.accumulate(total), low)
+            values += low
+            outside = values > high
+        else:
+            values = total - np.maximum(np.maximum.accumulate(total), high)
+            values += high
+            outside = values < low
+        if not outside.any():
+            output[position:] = values
+            break
+        outside = np.flatnonzero(outside)
+        end = position + outside[0]
+        output[position:end] = values[:outside[0]]
+        value = high if lower else low
+        output[end] = value
+        position = end + 1
+        lower = not lower
+    return output
+
+
+def adpcm_encode(samples, predictor=0, index=0):
+    """16bit PCM(int16の配列)をIMA-ADPCMの4bit符号に量子化する
+
+    予測値が1サンプルごとに前の符号(復号側と同じ予測値)に依存するので, ループは避けられない.
+    ループの中は量子化幅の番号ごとの表(ADPCM_ENCODE_ROWS)を引くだけにしている.
+
+    Returns:
+        tuple: (符号(uint8の配列), 最後の予測値, 最後の量子化幅の番号)
+    """
+    codes = bytearray(len(samples))
+    rows = ADPCM_ENCODE_ROWS
+    table, limit, differences, next_indices = rows[index]
+    for n, sample in enumerate(samples.tolist()):
+        delta = sample - predictor
+        if delta >= 0:
+            code = table[delta] if delta < limit else 7
+        else:
+            code = 8 | table[-delta] if -delta < limit else 15
+        predictor += differences[code]
+        if predictor > 32767:
+            predictor = 32767
+        elif predictor < -32768:
+            predictor = -32768
+        index = next_indices[code]
+        table, limit, differences, next_indices = rows[index]
+        codes[n] = code
+    return np.frombuffer(codes, dtype=np.uint8), predictor, index
+
+
+def adpcm_decode(codes, predictor=0, index=0):
+    """IMA-ADPCMの4bit符号を16bit PCM(int16の配列)に戻す
+
+    量子化幅の番号の列は符号だけで決まる(0〜88にクリップした増減の累積)ので先に求め,
+    予測値はその番号と符号から引いた増分を16bitの範囲にクリップしながら累積する. どちらも配列演算で求める.
+    """
+    if len(codes) == 0:
+        return np.zeros(0, dtype=np.int16)
+    codes = np.asarray(codes, dtype=np.intp)
+    after = _clamped_cumsum(index, ADPCM_INDEX_ADJUST_ARRAY[codes], 0, 88)
+    indices = np.empty(len(codes), dtype=np.intp)
+    indices[0] = index
+    indices[1:] = after[:-1]
+    differences = ADPCM_DIFFERENCE_ARRAY[indices, codes]
+    return _clamped_cumsum(predictor, differences, -32768, 32767).astype(np.int16)
+
+
+class PcmCodec:
+    """16bit リニアPCM(そのまま送る)"""
+    name = 'pcm'
+    payload_type = 96
+
+    def encoded_size(self, sample_count):
+        return 2 * sample_count
+
+    def encode(self, data):
+        return bytes(data)
+
+    def decode(self, payload):
+        return payload
+
+
+class UlawCodec:
+    """G.711 μ-law"""
+    name = 'ulaw'
+    payload_type = 97
+
+    def encoded_size(self, sample_count):
+        return sample_count
+
+    def encode(self, data):
+        return ulaw_encode(np.frombuffer(data, dtype='<i2')).tobytes()
+
+    def decode(self, payload):
+        return ulaw_decode(np.frombuffer(payload, dtype=np.uint8)).astype('<i2').tobytes()
+
+
+class AdpcmCodec:
+    """IMA-ADPCM(DVI4). 送信側の予測値と量子化幅はチャンネルごとにパケットをまたいで引き継ぐ"""
+    name = 'adpcm'
+    payload_type = 98
+
+    def __init__(self, channels=1):
+        self.channels = channels
+        self.predictors = [0] * channels
+        self.indices = [0] * channels
+
+    def encoded_size(self, sample_count):
+        frames = sample_count // self.channels
+        return self.channels * (ADPCM_HEADER.size + (frames + 1) // 2)
+
+    def encode(self, data):
+        # チャンネルごとのビュー(コピーしない)を順に符号化する
+        samples = np.frombuffer(data, dtype='<i2').reshape(-1, self.channels)
+        return b''.join(self._encode_channel(channel, samples[:, channel]) for channel in range(self.channels))
+
+    def _encode_channel(self, channel, samples):
+        header = ADPCM_HEADER.pack(self.predictors[channel], self.indices[channel], len(samples) % 2)
+        codes, self.predictors[channel], self.indices[channel] = adpcm_encode(
+            samples, self.predictors[channel], self.indices[channel])
+        if len(codes) % 2:
+            codes = np.append(codes, 0)
+        # 先のサンプルを上位4bitに詰める
+        return header + ((codes[0::2] << 4) | codes[1::2]).astype(np.uint8).tobytes()
+
+    def decode(self, payload):
+        size = len(payload) // self.channels
+        planes = [self._decode_channel(payload[i:i + size]) for i in range(0, size * self.channels, size)]
+        return np.stack(planes, axis=1).astype('<i2').tobytes()
+
+    def _decode_channel(self, payload):
+        predictor, index, padded = ADPCM_HEADER.unpack_from(payload)
+        packed = np.frombuffer(payload, dtype=np.uint8, offset=ADPCM_HEADER.size)
+        codes = np.empty(2 * len(packed), dtype=np.uint8)
+        codes[0::2] = packed >> 4
+        codes[1::2] = packed & 0x0F
+        # 埋め草の4bitは復号しない(フレームの長さに戻す)
+        return adpcm_decode(codes[:len(codes) - (padded & 1)], predictor, min(index, 88))
+
+
+def get_codec(name, channels=1):
+    """名前からコーデックを作る(送信と受信で別のインスタンスを使う. channels はインターリーブしたチャンネル数)"""
+    if name == 'pcm':
+        return PcmCodec()
+    if name == 'ulaw':
+        return UlawCodec()
+    if name == 'adpcm':
+        return AdpcmCodec(channels)
+    raise ValueError(f"不明なコーデック: {name}")
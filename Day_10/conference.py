@@ -0,0 +1,197 @@
+"""複数人で通話する会議サーバー
+
+使い方:
+    python conference.py <port> [--max-participants 16] [--rate 48000] [--workers 2]
+
+クライアントは e.py client をそのまま使う(--transport, --codec もクライアントごとに選べる).
+接続はすべて1本のasyncioのイベントループで扱い, 参加者ごとのスレッドは作らない.
+参加者ごとの受信コルーチンがジッタバッファにフレームを入れ, ミキサーは共通の時計で1フレームごとに
+全員のフレームを1つの配列に並べて, 「全員の和 - 自分」(mix-minus)を1回の配列演算で作る.
+全員の出力に共通のゲインをかけるリミッタで, 大勢が同時に話しても割れないようにする.
+ミックスと符号化はexecutorのスレッドで行い, ループを止めない.
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from aio_transport import open_channel
+from jitter_buffer import JitterBuffer
+from transport import parse_transport_options
+
+BUFFER_SIZE = 512
+FRAME_SAMPLES = BUFFER_SIZE // 2
+
+
+class Participant:
+    """1人の参加者. 受信したフレームはジッタバッファへ入れる"""
+
+    def __init__(self, name, channel, sample_rate, max_backlog=8):
+        self.name = name
+        self.channel = channel
+        self.jitter_buffer = JitterBuffer(FRAME_SAMPLES, sample_rate)
+        # 送信が詰まった参加者のせいでミキサーが止まらないよう, 溜まりすぎたら捨てる
+        self.max_backlog = max_backlog * BUFFER_SIZE
+        self.discarded = 0
+
+    async def receive(self):
+        """切断されるまで受信してジッタバッファに入れる"""
+        try:
+            while True:
+                frame = await self.channel.recv()
+                if frame is None:
+                    break
+                self.jitter_buffer.put(frame)
+        finally:
+            self.jitter_buffer.close()
+
+    def send(self, payload):
+        """符号化済みのフレームを送る(待たない)"""
+        if self.jitter_buffer.closed:
+            return
+        if self.channel.backlog() > self.max_backlog:
+            self.discarded += 1
+            return
+        self.channel.send_payload(payload)
+
+
+class SharedLimiter:
+    """全員の出力に共通のゲインをかけるリミッタ
+
+    フレーム内の最大振幅が閾値を超えたら即座にゲインを下げ, 戻すときはゆっくり戻す.
+    ゲインはフレーム内で直線的に補間し, 最後に16bitの範囲でクリップする.
+    """
+
+    def __init__(self, frame_samples, threshold=20000, release=0.05):
+        self.threshold = threshold
+        self.release = release
+        self.gain = 1.0
+        self.ramp = np.linspace(0.0, 1.0, frame_samples, endpoint=False, dtype=np.float32)
+
+    def process(self, mixes):
+        """mixes(参加者数 x サンプル数のfloat32)をその場で制限する"""
+        peak = float(np.abs(mixes).max()) if mixes.size else 0.0
+        target = min(1.0, self.threshold / peak) if peak > 0 else 1.0
+        previous = self.gain
+        if target < self.gain:
+            self.gain = target
+        else:
+            self.gain += (target - self.gain) * self.release
+        mixes *= previous + (self.gain - previous) * self.ramp
+        np.clip(mixes, -32768, 32767, out=mixes)
+        return mixes
+
+
+class ConferenceMixer:
+    """共通の時計で全員のフレームを集め, mix-minusを作って送り返す"""
+
+    def __init__(self, sample_rate, max_participants, executor):
+        self.sample_rate = sample_rate
+        self.max_participants = max_participants
+        self.executor = executor
+        self.participants = []
+        self.frames = np.zeros((max_participants, FRAME_SAMPLES), dtype=np.float32)
+        self.limiter = SharedLimiter(FRAME_SAMPLES)
+        self.tick_times = []
+
+    def add(self, participant):
+        if len(self.participants) >= self.max_participants:
+            return False
+        self.participants.append(participant)
+        return True
+
+    def remove(self, participant):
+        self.participants.remove(participant)
+
+    def mix(self, participants):
+        """1フレーム分を混ぜ, 参加者ごとに符号化したデータを返す(executorで実行)"""
+        count = len(participants)
+        frames = self.frames[:count]
+        for row, participant in zip(frames, participants):
+            row[:] = np.frombuffer(participant.jitter_buffer.get(), dtype='<i2')
+
+        # mix-minus: 全員の和から自分の分を引く(参加者数によらず配列演算1回)
+        mixes = frames.sum(axis=0) - frames
+        self.limiter.process(mixes)
+        output = mixes.astype('<i2')
+        return [participant.channel.encoder.encode(row.tobytes())
+                for row, participant in zip(output, participants)]
+
+    async def run(self):
+        """実時間のペースで1フレームずつ混ぜて送る"""
+        loop = asyncio.get_running_loop()
+        period = FRAME_SAMPLES / self.sample_rate
+        deadline = loop.time()
+        while True:
+            deadline += period
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            participants = list(self.participants)
+            if not participants:
+                continue
+            begin = time.perf_counter()
+            payloads = await loop.run_in_executor(self.executor, self.mix, participants)
+            for participant, payload in zip(participants, payloads):
+                participant.send(payload)
+            self.tick_times.append(time.perf_counter() - begin)
+            if len(self.tick_times) >= 1000:
+                self.report()
+
+    def report(self):
+        """ミキサーの処理時間を実時間の予算と比べて表示する"""
+        budget = FRAME_SAMPLES / self.sample_rate
+        times = np.array(self.tick_times)
+        self.tick_times = []
+        print(f"参加者: {len(self.participants)}人 ミキサー p50: {np.percentile(times, 50) * 1e6:.0f}us "
+              f"p99: {np.percentile(times, 99) * 1e6:.0f}us (予算 {budget * 1e6:.0f}us)")
+
+
+async def serve(port, sample_rate, max_participants, transport_options, workers):
+    executor = ThreadPoolExecutor(max_workers=workers)
+    mixer = ConferenceMixer(sample_rate, max_participants, executor)
+
+    async def handle(reader, writer):
+        address = writer.get_extra_info('peername')
+        name = f"{address[0]}:{address[1]}"
+        try:
+            channel = await open_channel(reader, writer, True, transport_options, FRAME_SAMPLES, sample_rate)
+        except (ConnectionError, OSError, ValueError) as e:
+            print(f"{name} との接続に失敗しました: {e}")
+            writer.close()
+            return
+        participant = Participant(name, channel, sample_rate)
+        if not mixer.add(participant):
+            print(f"満員のため {name} を切断します")
+            channel.close()
+            return
+        print(f"{name} が参加しました (コーデック: {channel.encoder.name})")
+        try:
+            await participant.receive()
+        finally:
+            mixer.remove(participant)
+            channel.close()
+            print(f"{name} が退出しました: {participant.jitter_buffer.stats()} 送信破棄: {participant.discarded}")
+
+    server = await asyncio.start_server(handle, port=port)
+    print(f"会議サーバー待機: ポート {port} (最大{max_participants}人)")
+    async with server:
+        await asyncio.gather(server.serve_forever(), mixer.run())
+
+
+def main():
+    argv, transport_options = parse_transport_options(None)
+    parser = argparse.ArgumentParser(description="会議サーバー")
+    parser.add_argument('port', type=int)
+    parser.add_argument('--max-participants', type=int, default=16)
+    parser.add_argument('--rate', type=int, default=48000, help="サンプルレート(違うレートの参加者は送受信のときに変換する)")
+    parser.add_argument('--workers', type=int, default=2, help="ミックスと符号化を行うスレッド数")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.port, args.rate, args.max_participants, transport_options, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
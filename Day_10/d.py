@@ -1,175 +1,267 @@
 import socket
-import subprocess
 import threading
 import sys
-import audioop
 import time
 import matplotlib.pyplot as plt
-import struct
-from collections import deque
 import numpy as np
+from analysis_worker import AnalysisWorker, DelayEstimate, INITIAL_ESTIMATE
+from ring_buffer import RingBuffer
+from audio_io import Pacer, downmix, open_audio, parse_audio_options
+from transport import open_channel, parse_transport_options
+from delay_estimator import CoarseToFineDelayTracker, DelayStateTracker
+from jitter_buffer import JitterBuffer
+from amplitude_recorder import AmplitudeRecorder
+from metrics import open_metrics, parse_metrics_options
+from resampler import FractionalResampler, PolyphaseResampler, Reframer
+from session_recorder import open_recorder, parse_record_options
 
 # 定数
 BUFFER_SIZE = 512
+SAMPLE_RATE = 44100
+# 何パケットごとに遅延推定を依頼するか. 推定結果の表示はその PRINT_EVERY 回に1回
+ANALYSIS_INTERVAL = 10
+PRINT_EVERY = 5
 # SoXのオーディオ設定（C言語版と同一）
 AUDIO_FORMAT = [
     '-t', 'raw',    # タイプ: raw
     '-b', '16',     # ビット深度: 16-bit
     '-c', '1',      # チャンネル数: 1 (mono)
     '-e', 's',      # エンコーディング: signed-integer
-    '-r', '44100',  # サンプルレート: 44.1kHz
+    '-r', str(SAMPLE_RATE),  # サンプルレート: 44.1kHz
     '-',            # 標準入出力を使用
 ]
 
 class EchoCanceller:
-    def __init__(self, sample_rate=44100, max_delay_s=0.5):
+    def __init__(self, sample_rate=44100, max_delay_s=0.5, block_size=256):
         self.sample_rate = sample_rate
+        self.block_size = block_size
         self.max_delay_samples = int(max_delay_s * sample_rate)
 
         # 送信音声の履歴(相互相関用)
-        self.sent_audio_buffer = deque(maxlen=self.max_delay_samples * 2)
+        self.sent_audio_buffer = RingBuffer(self.max_delay_samples * 2)
 
         # 受信音声バッファ
-        self.received_audio_buffer = deque(maxlen=self.max_delay_samples * 2)
+        self.received_audio_buffer = RingBuffer(self.max_delay_samples * 2)
 
-        self.estimated_delay = 0
         self.lock = threading.Lock()
         self.process_count = 0  # 処理頻度制御用
+        self.metrics = None  # 計測値の出力先(MetricsWriter)
+
+        # 解析ワーカーが公開する最新の推定結果と, 解析の依頼用イベント
+        self.estimate = INITIAL_ESTIMATE
+        self.analysis_request = threading.Event()
+
+        # 粗い全域探索と細かい局所探索を組み合わせた遅延推定器と, 推定器に渡し済みのマイク音声の通算位置(解析ワーカーだけが触る)
+        self.delay_tracker = CoarseToFineDelayTracker(block_size=block_size, max_delay_samples=self.max_delay_samples)
+        self.analysis_count = 0
+        self.analysis_position = 0
+        self.stream_offset = None  # 受信音声とマイク音声の通算位置の差
+        # 生の推定を平滑化し, 外れ値を捨てて, 確かめられた変化だけを公開する
+        self.delay_state = DelayStateTracker()
 
     def add_sent_audio(self, audio_data):
         """送信音声データを追加"""
         with self.lock:
-            # バイトデータを16bit整数配列に変換
-            samples = struct.unpack(f'<{len(audio_data)//2}h', audio_data)
-            self.sent_audio_buffer.extend(samples)
+            self.sent_audio_buffer.write(audio_data)
+
+    @property
+    def estimated_delay(self):
+        return self.estimate.delay_samples
 
     def process_received_audio(self, audio_data):
-        """受信音声を処理し、遅延を推定"""
+        """受信音声を記録し、一定間隔で解析ワーカーに遅延推定を依頼"""
         with self.lock:
-            # バイトデータを16bit整数配列に変換
-            samples = struct.unpack(f'<{len(audio_data)//2}h', audio_data)
-            self.received_audio_buffer.extend(samples)
+            self.received_audio_buffer.write(audio_data)
 
-            # 処理頻度を下げる（50回に1回のみ実行）
-            self.process_count += 1
-            if (self.process_count % 50 == 0 and 
-                len(self.received_audio_buffer) >= self.max_delay_samples * 2 and 
-                len(self.sent_audio_buffer) >= self.max_delay_samples * 2):
-                self.estimate_delay()
+        # 処理頻度を下げる（ANALYSIS_INTERVAL回に1回のみ依頼）
+        self.process_count += 1
+        if self.process_count % ANALYSIS_INTERVAL == 0:
+            self.analysis_request.set()
 
         return audio_data # 処理後のデータを返す
     
-    def estimate_delay(self):
-        """FFTを使った高速相互相関による遅延推定"""
-        window_size = 8192
-        if len(self.sent_audio_buffer) < window_size or len(self.received_audio_buffer) < window_size:
+    def snapshot(self):
+        """前回の解析以降に届いたマイク/受信音声をブロック単位でコピーして返す(ロックはコピーの間だけ)"""
+        block_size = self.block_size
+        with self.lock:
+            sent_total = self.sent_audio_buffer.total
+            received_total = self.received_audio_buffer.total
+            # 最初は両方の最新サンプルが同時刻に届いたとみなして対応付け, 以後は通算位置の差を保つ
+            # (レート変換で書き込みの単位が揃わなくても対応がずれない). 大きくずれたら対応付け直す
+            if self.stream_offset is None or abs(received_total - sent_total - self.stream_offset) > self.max_delay_samples:
+                self.stream_offset = received_total - sent_total
+            offset = self.stream_offset
+            start = max(self.analysis_position, sent_total - self.max_delay_samples, -offset)
+            count = (min(sent_total, received_total - offset) - start) // block_size * block_size
+            if count <= 0:
+                return None
+            sent_samples = self.sent_audio_buffer.read(start, count).astype(np.float32)
+            received_samples = self.received_audio_buffer.read(start + offset, count).astype(np.float32)
+        self.analysis_position = start + count
+        return sent_samples, received_samples
+
+    def analyze(self):
+        """解析ワーカーから呼ばれ、スナップショットで遅延を推定して結果を公開"""
+        snapshot = self.snapshot()
+        if snapshot is None:
             return
-        
-        sent_samples = np.array(list(self.sent_audio_buffer)[-window_size:], dtype=np.float32)
-        received_samples = np.array(list(self.received_audio_buffer)[-window_size:], dtype=np.float32)
-        
-        # 平均を引く（DC成分除去）
-        sent_samples = sent_samples - np.mean(sent_samples)
-        received_samples = received_samples - np.mean(received_samples)
-        
-        # FFTベースの相互相関計算
-        correlation_length = len(sent_samples) + len(received_samples) - 1
-        fft_size = 2 ** int(np.ceil(np.log2(correlation_length)))
-        
-        sent_fft = np.fft.rfft(sent_samples, fft_size)
-        received_fft = np.fft.rfft(received_samples, fft_size)
-        
-        cross_correlation_fft = sent_fft.conj() * received_fft
-        correlation = np.fft.irfft(cross_correlation_fft, fft_size)
-        correlation = correlation[:correlation_length]
-        
-        # 正規化（重要！）
-        norm = np.sqrt(np.sum(sent_samples**2) * np.sum(received_samples**2))
-        if norm > 0:
-            correlation = correlation / norm
-        
-        max_corr_index = np.argmax(np.abs(correlation))
-        correlation_center = len(correlation) // 2
-        delay_samples = max_corr_index - correlation_center
-        
-        if 0 <= delay_samples <= self.max_delay_samples:
-            self.estimated_delay = delay_samples
-            delay_s = delay_samples / self.sample_rate
-            correlation_strength = np.abs(correlation[max_corr_index])
-            print(f"推定遅延(FFT): {delay_s:.3f}s ({delay_samples}サンプル) 相関: {correlation_strength:.3f}")
+        self.analysis_count += 1
+        raw = self.estimate_delay(*snapshot)
+        if raw is None:
+            return
+        if self.delay_state.update(raw.delay_samples, raw.correlation, raw.confidence):
+            # 参照の差し替えだけで公開するので, 音声スレッドはロック不要
+            self.estimate = raw._replace(delay_samples=self.delay_state.delay_samples)
+        # 外れ値は公開しない
+        estimate = self.estimate
+        delay_s = estimate.delay_samples / self.sample_rate
+        if self.metrics is not None:
+            # 計測値を出力するときはコンソールに表示しない
+            self.metrics.emit('delay', estimate.delay_samples, delay_s, estimate.correlation, estimate.gain,
+                              estimate.confidence, raw.delay_samples, 0.0)
+            return
+        if self.analysis_count % PRINT_EVERY:
+            return
+        print(f"推定遅延(FFT): {delay_s:.3f}s ({estimate.delay_samples}サンプル) 相関: {estimate.correlation:.3f} 信頼度: {estimate.confidence:.3f} 生の推定: {raw.delay_samples}サンプル")
+
+    def estimate_delay(self, sent_samples, received_samples):
+        """GCC-PHATによる遅延推定(受信音声に対するマイク音声の遅れ). 粗い探索から細かい探索へ絞り込む"""
+        # スナップショット全体をまとめて渡す(推定器の中でブロックごとに処理する)
+        self.delay_tracker.update(received_samples, sent_samples)
+
+        result = self.delay_tracker.estimate()
+        if result is None:
+            return None
+        delay_samples, correlation_strength, confidence = result
+        return DelayEstimate(delay_samples, correlation_strength, 1.0, confidence, time.time())
 
 # グローバルなエコーキャンセラーインスタンス
 echo_canceller = EchoCanceller()
 
-def send_audio(sock):
-    """マイクから音声を録音し、ソケット経由で送信する"""
-    rec_process = subprocess.Popen(['rec'] + AUDIO_FORMAT, stdout=subprocess.PIPE)
+def send_audio(channel, source, session_recorder=None):
+    """マイク(AudioSource)から音声を録音し、メディアチャネル経由で送信する(伝送路のレートに変換する)
+
+    session_recorder があればマイクの音声と送信したフレームを記録する.
+    """
     print("音声送信スレッドを開始しました。")
 
+    to_wire = PolyphaseResampler(SAMPLE_RATE, channel.sample_rate)
+    wire_frames = Reframer(channel.frame_samples)
     try:
         while True:
-            data = rec_process.stdout.read(BUFFER_SIZE)
+            data = source.read(BUFFER_SIZE)
             if not data:
                 break
+            if session_recorder is not None:
+                session_recorder.append('mic', data)
 
             # エコーキャンセラに送信音声を記録
             echo_canceller.add_sent_audio(data)
 
-            sock.sendall(data)
+            for frame in wire_frames.push(to_wire.process_bytes(data)):
+                if session_recorder is not None:
+                    session_recorder.append('sent', frame)
+                channel.send(frame)
     except (BrokenPipeError, ConnectionResetError):
         print("送信中に接続が切れました。")
+    except OSError as e:
+        # 通話の終わりに受信スレッドがチャネルを閉じたあとは送れないのが正常なので, 表示しない
+        if not channel.closed:
+            print(f"send_audioでエラーが発生しました: {e}")
     except Exception as e:
         print(f"send_audioでエラーが発生しました: {e}")
     finally:
-        rec_process.terminate()
+        source.close()
         print("送信スレッド終了")
 
-def recv_audio(sock, amplitudes, timestamps, duration=60.0):
-    """ソケットから音声データを受信し、スピーカーで再生しつつ振幅を記録"""
-    play_process = subprocess.Popen(['play'] + AUDIO_FORMAT, stdin=subprocess.PIPE)
+def recv_audio(channel, jitter_buffer, session_recorder=None, duration=60.0):
+    """メディアチャネルから音声フレームを受信し、ジッタバッファに入れる(再生はモノラルなので, 複数チャンネルは平均する)
+
+    session_recorder があれば受信したフレームを(平均する前に)タイムスタンプとシーケンス番号ごと記録する.
+    """
     print("音声受信スレッドを開始しました。")
 
     start_time = None
     try:
         while True:
-            data = sock.recv(BUFFER_SIZE)
-            if not data:
+            frame = channel.recv()
+            if frame is None:
                 break
             now = time.time()
             if start_time is None:
                 start_time = now
-            elapsed = now - start_time
-            if elapsed > duration:
+            if now - start_time > duration:
                 print(f"{duration}秒の記録完了")
                 break
 
-            processed_data = echo_canceller.process_received_audio(data)
-            # RMS振幅を記録
-            rms = audioop.rms(processed_data, 2)
-            amplitudes.append(rms)
-            timestamps.append(elapsed)
-            # 再生
-            play_process.stdin.write(data)
+            if session_recorder is not None:
+                session_recorder.append('received', frame.payload, frame.timestamp, frame.sequence)
+            if channel.peer_channels > 1:
+                frame = frame._replace(payload=downmix(frame.payload, channel.peer_channels))
+            jitter_buffer.put(frame)
     except (BrokenPipeError, ConnectionResetError):
         print("受信中に接続が切れました。")
     except Exception as e:
         print(f"recv_audioでエラー: {e}")
     finally:
-        play_process.terminate()
+        jitter_buffer.close()
+        print(f"ジッタバッファ: {jitter_buffer.stats()}")
         print("受信スレッド終了")
-        sock.close()
+        channel.close()
+
+def play_audio(jitter_buffer, sink, recorder, metrics=None, session_recorder=None):
+    """ジッタバッファから1フレームずつ一定のペースで取り出し、スピーカー(AudioSink)で再生しつつ振幅を記録
 
-def plot_wave(amplitudes, timestamps):
-    """メインスレッドで振幅をプロット"""
-    if not amplitudes:
+    session_recorder があれば再生した音声を記録する.
+    """
+    print("音声再生スレッドを開始しました。")
+
+    # 相手の録音のクロックとのずれをジッタバッファが決めた比で吸収し, 伝送路のレートからデバイスのレートに変換する
+    clock = FractionalResampler()
+    to_device = PolyphaseResampler(jitter_buffer.sample_rate, SAMPLE_RATE)
+    pacer = Pacer(SAMPLE_RATE)
+    start_time = time.time()
+    played = 0
+    try:
+        while not jitter_buffer.closed:
+            clock.ratio = jitter_buffer.playout_ratio()
+            data = to_device.process_bytes(clock.process_bytes(jitter_buffer.get()))
+            pacer.wait(len(data) // 2)
+
+            # 実際に再生する音声をエコーキャンセラの参照にする
+            processed_data = echo_canceller.process_received_audio(data)
+            # RMS振幅を記録
+            rms = recorder.record(processed_data, time.time() - start_time)
+            # 再生
+            sink.write(data)
+            if session_recorder is not None:
+                session_recorder.append('played', data)
+
+            if metrics is not None:
+                metrics.emit('rms', rms)
+                played += 1
+                if played % 50 == 0:
+                    metrics.emit_mapping('jitter', jitter_buffer.stats())
+    except BrokenPipeError:
+        print("再生先が閉じられました。")
+    except Exception as e:
+        print(f"play_audioでエラー: {e}")
+    finally:
+        sink.close()
+        print("再生スレッド終了")
+
+def plot_wave(recorder):
+    """メインスレッドで振幅をプロット(長い通話は区間ごとの最小・最大の幅と平均で描く)"""
+    if recorder.count == 0:
         print("プロットするデータがありません。")
         return
     
-    avg_amplitude = sum(amplitudes) / len(amplitudes)
-    print(f"平均RMS振幅: {avg_amplitude:.2f}")
+    print(f"平均RMS振幅: {recorder.mean():.2f}")
     
+    times, lows, highs, means = recorder.series()
     plt.figure(figsize=(8, 4))
-    plt.plot(timestamps, amplitudes)
+    plt.fill_between(times, lows, highs, alpha=0.3)
+    plt.plot(times, means)
     plt.xlabel("Time (s)")
     plt.ylabel("RMS amplitude")
     plt.title("Amplitude record")
@@ -178,51 +270,89 @@ def plot_wave(amplitudes, timestamps):
     plt.show()
 
 def main():
-    if len(sys.argv) < 2:
-        print(f"使い方: python {sys.argv[0]} [server <port> | client <host> <port>]")
+    argv, audio_options = parse_audio_options(sys.argv[1:])
+    argv, transport_options = parse_transport_options(argv)
+    argv, metrics_options = parse_metrics_options(argv)
+    argv, record_options = parse_record_options(argv)
+    if transport_options.asyncio:
+        print("d.pyは--asyncioに対応していません. 送受信はスレッドで行います")
+    if len(argv) < 1:
+        print(f"使い方: python {sys.argv[0]} [server <port> | client <host> <port>] "
+              "[--backend sox|file|loopback|callback] [--input <file> --output <file>] [--transport tcp|udp] [--codec pcm|ulaw|adpcm] "
+              "[--metrics <file.jsonl|file.bin|udp://host:port>] [--dashboard] [--record <dir>]")
         return
 
-    mode = sys.argv[1]
-    amplitudes = []
-    timestamps = []
-
-    if mode == 'server':
-        port = int(sys.argv[2])
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind(('', port))
-            s.listen(1)
-            print(f"サーバー待機: ポート {port}")
-            conn, addr = s.accept()
-            print(f"クライアント接続: {addr}")
-            sender = threading.Thread(target=send_audio, args=(conn,), daemon=True)
-            receiver = threading.Thread(target=recv_audio, args=(conn, amplitudes, timestamps), daemon=True)
-            sender.start()
-            receiver.start()
-            receiver.join()
-            sender.join()
-
-    elif mode == 'client':
-        host, port = sys.argv[2], int(sys.argv[3])
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                s.connect((host, port))
-                print(f"接続成功: {host}:{port}")
-                sender = threading.Thread(target=send_audio, args=(s,), daemon=True)
-                receiver = threading.Thread(target=recv_audio, args=(s, amplitudes, timestamps), daemon=True)
+    mode = argv[0]
+    recorder = AmplitudeRecorder()
+    metrics = open_metrics(metrics_options)
+    echo_canceller.metrics = metrics
+
+    # 遅延推定は音声スレッドではなく解析ワーカーで実行する
+    analysis_worker = AnalysisWorker(echo_canceller.analyze, echo_canceller.analysis_request)
+    analysis_worker.start()
+
+    # 接続やハンドシェイクに失敗して途中で返るときも, 計測値を書き出して閉じる
+    session_recorder = None
+    try:
+        if mode == 'server':
+            port = int(argv[1])
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                s.bind(('', port))
+                s.listen(1)
+                print(f"サーバー待機: ポート {port}")
+                conn, addr = s.accept()
+                print(f"クライアント接続: {addr}")
+                channel = open_channel(conn, True, transport_options, BUFFER_SIZE // 2, SAMPLE_RATE)
+                source, sink = open_audio(audio_options, AUDIO_FORMAT, SAMPLE_RATE, BUFFER_SIZE // 2)
+                session_recorder = open_recorder(record_options, SAMPLE_RATE, 1, channel)
+                sender = threading.Thread(target=send_audio, args=(channel, source, session_recorder), daemon=True)
+                jitter_buffer = JitterBuffer(channel.frame_samples, channel.sample_rate)
+                receiver = threading.Thread(target=recv_audio, args=(channel, jitter_buffer, session_recorder), daemon=True)
+                player = threading.Thread(target=play_audio, args=(jitter_buffer, sink, recorder, metrics, session_recorder),
+                                          daemon=True)
                 sender.start()
                 receiver.start()
+                player.start()
                 receiver.join()
+                player.join()
                 sender.join()
-            except Exception as e:
-                print(f"接続エラー: {e}")
-                return
-    else:
-        print("モード指定エラー")
-        return
+
+        elif mode == 'client':
+            host, port = argv[1], int(argv[2])
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect((host, port))
+                    print(f"接続成功: {host}:{port}")
+                    channel = open_channel(s, False, transport_options, BUFFER_SIZE // 2, SAMPLE_RATE)
+                    source, sink = open_audio(audio_options, AUDIO_FORMAT, SAMPLE_RATE, BUFFER_SIZE // 2)
+                    session_recorder = open_recorder(record_options, SAMPLE_RATE, 1, channel)
+                    sender = threading.Thread(target=send_audio, args=(channel, source, session_recorder), daemon=True)
+                    jitter_buffer = JitterBuffer(channel.frame_samples, channel.sample_rate)
+                    receiver = threading.Thread(target=recv_audio, args=(channel, jitter_buffer, session_recorder), daemon=True)
+                    player = threading.Thread(target=play_audio, args=(jitter_buffer, sink, recorder, metrics, session_recorder),
+                                              daemon=True)
+                    sender.start()
+                    receiver.start()
+                    player.start()
+                    receiver.join()
+                    player.join()
+                    sender.join()
+                except Exception as e:
+                    print(f"接続エラー: {e}")
+                    return
+        else:
+            print("モード指定エラー")
+            return
+    finally:
+        analysis_worker.stop()
+        if metrics is not None:
+            metrics.close()
+        if session_recorder is not None:
+            session_recorder.close()
 
     # メインスレッドでプロット
-    plot_wave(amplitudes, timestamps)
+    plot_wave(recorder)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+"""通話中の再生音声のRMS, 推定遅延, 相関, ゲインをリアルタイムに表示する
+
+音声のプロセスは計測値を共有メモリのリングバッファに書くだけで, 描画は別プロセスで
+refresh秒ごと(既定0.2秒)に行う. 描画がGILを取り合って音声スレッドを遅らせることはない.
+MetricsWriterと同じ emit(kind, *values) で受け取るので, metrics.open_metrics から --dashboard で有効にする.
+窓の「保存」ボタンか s キー, または音声のプロセスへのSIGUSR1(snapshot())でその時点のグラフを画像に保存する.
+"""
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from metrics import METRIC_FIELDS
+
+# 表示する系列: (種類, 項目)
+SERIES = {
+    'rms': ('rms',),
+    'delay': ('delay_s', 'correlation', 'gain'),
+}
+
+
+class SharedRing:
+    """共有メモリ上の固定長リングバッファ(書き込みは1スレッドだけ)
+
+    先頭8バイトに通算の書き込み数, 続いて capacity x (1 + width) のfloat64(時刻と値)を置く.
+    """
+
+    def __init__(self, width, capacity=4096, name=None):
+        self.width = width
+        self.capacity = capacity
+        size = 8 + capacity * (1 + width) * 8
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.count = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.rows = np.ndarray((capacity, 1 + width), dtype=np.float64, buffer=self.shm.buf, offset=8)
+        if self.owner:
+            self.count[0] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, timestamp, values):
+        """1行書いてから書き込み数を進める(読む側は進んだ分だけを見る)"""
+        count = int(self.count[0])
+        row = self.rows[count % self.capacity]
+        row[0] = timestamp
+        row[1:] = values
+        self.count[0] = count + 1
+
+    def read(self):
+        """古い順に (時刻, 値の2次元配列) を返す. 上書き中かもしれない最古の1行は読まない
+
+        写している間に書き込みが進むと古い行が新しい行に置き換わって混ざるので,
+        写す前後で書き込み数を読み, 変わっていたら読み直す(seqlock).
+        """
+        while True:
+            count = int(self.count[0])
+            available = min(count, self.capacity - 1)
+            order = np.arange(count - available, count) % self.capacity
+            rows = self.rows[order]
+            if int(self.count[0]) == count:
+                return rows[:, 0], rows[:, 1:]
+
+    def close(self):
+        # 共有メモリを参照する配列を先に手放す
+        del self.count, self.rows
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class LiveDashboard:
+    """計測値を共有メモリに書き, 別プロセスの窓で表示する"""
+
+    def __init__(self, refresh=0.2, window_s=30.0, capacity=8192):
+        self.start_time = time.time()
+        self.rings = {kind: SharedRing(len(names), capacity) for kind, names in SERIES.items()}
+        # 受け取る値のうち表示する項目の位置
+        self.columns = {kind: [METRIC_FIELDS[kind].index(name) for name in names] for kind, names in SERIES.items()}
+
+        # 音声のプロセスのmatplotlibやスレッドを引き継がないよう, spawnで起動する
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.stopped = context.Event()
+        names = {kind: ring.name for kind, ring in self.rings.items()}
+        self.process = context.Process(target=run_dashboard,
+                                       args=(names, capacity, refresh, window_s, self.requests, self.stopped),
+                                       daemon=True)
+        self.process.start()
+
+        # kill -USR1 <pid> で保存できるようにする(シグナルを扱えるのはメインスレッドだけ)
+        self.previous_handler = None
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            self.previous_handler = signal.signal(signal.SIGUSR1, lambda signum, frame: self.snapshot())
+
+    def emit(self, kind, *values):
+        """表示する種類なら共有メモリに書く(待たない)"""
+        ring = self.rings.get(kind)
+        if ring is None:
+            return
+        ring.write(time.time() - self.start_time, [values[i] for i in self.columns[kind]])
+
+    def emit_mapping(self, kind, mapping):
+        if kind in self.rings:
+            self.emit(kind, *(mapping[name] for name in METRIC_FIELDS[kind]))
+
+    def snapshot(self, path=None):
+        """表示中のグラフを画像に保存するよう依頼する(省略時は dashboard-<時刻>.png)"""
+        self.requests.put(path)
+
+    def close(self):
+        """表示のプロセスを止めて共有メモリを解放する"""
+        if self.previous_handler is not None:
+            signal.signal(signal.SIGUSR1, self.previous_handler)
+            self.previous_handler = None
+        self.stopped.set()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        for ring in self.rings.values():
+            ring.close()
+
+
+def snapshot_path():
+    return time.strftime('dashboard-%Y-%m-%dT%H-%M-%S.png')
+
+
+def run_dashboard(names, capacity, refresh, window_s, requests, stopped):
+    """表示のプロセス. refresh秒ごとに共有メモリを読んで直近window_s秒を描き直す"""
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Button
+
+    rings = {kind: SharedRing(len(SERIES[kind]), capacity, name) for kind, name in names.items()}
+
+    fig, axes = plt.subplots(3, 1, sharex=True, figsize=(9, 7))
+    fig.canvas.manager.set_window_title('internet_phone dashboard')
+    rms_line, = axes[0].plot([], [])
+    axes[0].set_ylabel('RMS amplitude')
+    delay_line, = axes[1].plot([], [], marker='o')
+    axes[1].set_ylabel('delay time[s]')
+    correlation_line, = axes[2].plot([], [], marker='o', label='correlation')
+    gain_line, = axes[2].plot([], [], label='gain')
+    axes[2].set_ylim(0, 1)
+    axes[2].set_xlabel('Time (s)')
+    axes[2].legend(loc='upper left')
+    for ax in axes:
+        ax.grid(True)
+    fig.subplots_adjust(bottom=0.12)
+    button = Button(fig.add_axes([0.82, 0.01, 0.15, 0.05]), 'Save')
+    button.on_clicked(lambda event: save(fig, None))
+    fig.canvas.mpl_connect('key_press_event', lambda event: save(fig, None) if event.key == 's' else None)
+
+    plt.show(block=False)
+    try:
+        while not stopped.is_set() and plt.fignum_exists(fig.number):
+            times, values = rings['rms'].read()
+            rms_line.set_data(times, values[:, 0])
+            delay_times, delay_values = rings['delay'].read()
+            delay_line.set_data(delay_times, delay_values[:, 0])
+            correlation_line.set_data(delay_times, delay_values[:, 1])
+            gain_line.set_data(delay_times, delay_values[:, 2])
+
+            now = max(times[-1] if len(times) else 0.0, delay_times[-1] if len(delay_times) else 0.0)
+            axes[0].set_xlim(max(0.0, now - window_s), max(now, window_s))
+            for ax in axes[:2]:
+                ax.relim()
+                ax.autoscale_view(scalex=False)
+
+            while True:
+                try:
+                    save(fig, requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            fig.canvas.draw_idle()
+            # 待つ間も窓の操作(保存ボタンなど)を受け付ける
+            fig.canvas.start_event_loop(refresh)
+    finally:
+        for ring in rings.values():
+            ring.close()
+        plt.close(fig)
+
+
+def save(fig, path):
+    path = path or snapshot_path()
+    fig.savefig(path, dpi=150, bbox_inches='tight')
+    print(f"グラフを保存しました: {path}")
@@ -0,0 +1,323 @@
+import numpy as np
+
+
+class GccPhatDelayTracker:
+    """ブロックごとに相互スペクトルを更新するGCC-PHAT遅延推定器
+
+    参照信号の過去ブロックのスペクトルを保持しておき, マイク信号の新しいブロックとの
+    相互スペクトルをパーティション(遅延 p*B 〜 (p+1)*B-1)ごとに指数平滑化する.
+    1回の更新は長さ2Bの小さなFFTを参照・マイク1回ずつで済み, 窓全体を再計算しない.
+    複数ブロックをまとめて渡すと, FFTと相互スペクトルの積和をブロックをまたいで一度に計算する.
+    set_window()で探索するパーティションを絞ると, 1回の更新の計算量もその数に比例して減る.
+
+    遅延は「マイク信号が参照信号より何サンプル遅れているか」(0以上).
+    音声のように低域に偏った信号では, フレーム端の不連続から漏れた低域成分が
+    PHATで強調されてブロック境界に偽のピークが立つため, 先にプリエンファシスをかける.
+    """
+
+    def __init__(self, block_size=256, max_delay_samples=24000, smoothing=0.95, min_updates=None,
+                 pre_emphasis=0.97):
+        self.block_size = block_size
+        self.pre_emphasis = pre_emphasis
+        self.fft_size = 2 * block_size
+        self.num_partitions = -(-max_delay_samples // block_size)
+        self.max_delay_samples = max_delay_samples
+        self.smoothing = smoothing
+        # 推定を返すまでに必要な更新回数(少なくとも最大遅延分の参照が溜まるまで)
+        self.min_updates = self.num_partitions if min_updates is None else min_updates
+        # 窓を動かした後, 相互スペクトルが落ち着くまでの更新回数
+        self.settle_updates = int(round(1 / (1 - smoothing)))
+
+        bins = block_size + 1
+        # 参照スペクトルの履歴(古い順). 後ろに追記し, 埋まったら直近のパーティション数分を先頭に戻す
+        self.spectra_buffer = np.zeros((2 * self.num_partitions, bins), dtype=np.complex128)
+        self.spectra_end = self.num_partitions
+        # 前のブロック(プリエンファシス済み)と, 各信号の直前のサンプル
+        self.previous_reference = np.zeros(block_size)
+        self.last_reference = 0.0
+        self.last_captured = 0.0
+        # マイク信号を後半に置いたフレームのスペクトルは, 前半に置いたものの奇数ビンの符号を反転したもの
+        self.shift = (-1.0) ** np.arange(bins)
+        self.update_count = 0
+        self.set_window(0, self.num_partitions)
+        self.window_min_updates = self.min_updates
+
+    def set_window(self, first_partition, count):
+        """探索するパーティションを first_partition から count 個に絞る(相互スペクトルは貯め直す)"""
+        first_partition = max(0, min(first_partition, self.num_partitions))
+        count = max(0, min(count, self.num_partitions - first_partition))
+        self.first_partition = first_partition
+        self.partitions = np.arange(first_partition, first_partition + count)
+        self.cross_spectra = np.zeros((count, self.block_size + 1), dtype=np.complex128)
+        self.window_updates = 0
+        self.window_min_updates = self.settle_updates
+
+    @property
+    def window_partitions(self):
+        return len(self.partitions)
+
+    def update(self, reference, captured):
+        """参照信号とマイク信号を取り込む(長さはブロックの倍数. 複数ブロックをまとめて渡すと速い)"""
+        block_size = self.block_size
+        blocks = len(reference) // block_size
+        if blocks == 0:
+            return
+
+        # 参照: [前ブロック, 今ブロック], マイク: [0, 今ブロック] のフレームを全ブロック分まとめてFFTする
+        last_reference, last_captured = reference[-1], captured[-1]
+        reference = self._emphasize(reference, self.last_reference).reshape(blocks, block_size)
+        captured = self._emphasize(captured, self.last_captured).reshape(blocks, block_size)
+        self.last_reference, self.last_captured = last_reference, last_captured
+        frames = np.empty((blocks, self.fft_size))
+        frames[0, :block_size] = self.previous_reference
+        frames[1:, :block_size] = reference[:-1]
+        frames[:, block_size:] = reference
+        self.previous_reference = reference[-1].copy()
+        spectra = self._append_spectra(np.fft.rfft(frames, axis=1))
+        self.update_count += blocks
+        self.window_updates += blocks
+        if not len(self.partitions):
+            return
+
+        # 各ブロックの寄与に指数平滑の重みをかけておき, 最後にまとめて足す
+        weights = (1 - self.smoothing) * self.smoothing ** np.arange(blocks - 1, -1, -1)
+        weighted = np.conjugate(np.fft.rfft(captured, self.fft_size, axis=1) * self.shift * weights[:, None])
+        self.cross_spectra *= self.smoothing ** blocks
+
+        # パーティションpの相互スペクトルは遅延 p*B + m (0 <= m < B) の相関に対応する.
+        # ブロックtの相手は spectra[P - p + t] (P: パーティション数) なので, 長さblocksの窓をずらして並べる
+        start = self.num_partitions - self.partitions[-1]
+        count = len(self.partitions)
+        if blocks < 4:
+            # ブロックが少ないときはブロックごとに全パーティションをまとめて計算する方が速い
+            for t in range(blocks):
+                self.cross_spectra += np.conjugate(spectra[start + t:start + t + count][::-1] * weighted[t])
+            return
+        windows = np.lib.stride_tricks.sliding_window_view(spectra, blocks, axis=0)
+        selected = windows[start:start + count][::-1]
+        self.cross_spectra += np.conjugate(np.einsum('pkt,tk->pk', selected, weighted))
+
+    @property
+    def reference_spectra(self):
+        """直近のパーティション数分の参照スペクトル(古い順)"""
+        return self.spectra_buffer[self.spectra_end - self.num_partitions:self.spectra_end]
+
+    def _append_spectra(self, new_spectra):
+        """参照スペクトルを履歴に追記し, 追記分の前に直近の履歴が並んだビューを返す"""
+        count = len(new_spectra)
+        history = self.num_partitions
+        if self.spectra_end + count > len(self.spectra_buffer):
+            recent = self.reference_spectra.copy()
+            if history + count > len(self.spectra_buffer):
+                self.spectra_buffer = np.zeros((2 * (history + count), self.block_size + 1), dtype=np.complex128)
+            self.spectra_buffer[:history] = recent
+            self.spectra_end = history
+        end = self.spectra_end + count
+        self.spectra_buffer[self.spectra_end:end] = new_spectra
+        self.spectra_end = end
+        return self.spectra_buffer[end - count - history:end]
+
+    def _emphasize(self, signal, last):
+        """プリエンファシス y[n] = x[n] - a*x[n-1] をかけた新しい配列を返す(lastは前回の最後のサンプル)"""
+        out = np.empty(len(signal))
+        out[0] = signal[0] - self.pre_emphasis * last
+        np.multiply(signal[:-1], -self.pre_emphasis, out=out[1:])
+        out[1:] += signal[1:]
+        return out
+
+    def estimate(self, guard=None):
+        """現在の相互スペクトルから遅延を推定する
+
+        Returns:
+            tuple | None: (遅延サンプル数, 相関の強さ 0〜1, 信頼度 0〜1).
+                まだ十分なデータがない場合はNone.
+        """
+        count = len(self.partitions)
+        if (count == 0 or self.window_updates < self.window_min_updates
+                or self.update_count < self.first_partition + count):
+            return None
+
+        # PHAT重み付け: 振幅で割って位相だけを残す
+        magnitude = np.abs(self.cross_spectra)
+        if not magnitude.any():
+            return None
+        weighted = self.cross_spectra / (magnitude + 1e-12)
+        correlation = np.fft.irfft(weighted, self.fft_size, axis=1)[:, :self.block_size]
+        offset = self.first_partition * self.block_size
+        correlation = np.abs(correlation.ravel()[:self.max_delay_samples + 1 - offset])
+
+        peak_index = int(np.argmax(correlation))
+        peak = correlation[peak_index]
+        if peak <= 0:
+            return None
+
+        # 信頼度: ピーク近傍を除いた2番目のピークとの比
+        guard = self.block_size // 8 if guard is None else guard
+        sidelobes = np.concatenate((correlation[:max(peak_index - guard, 0)],
+                                    correlation[peak_index + guard + 1:]))
+        second = sidelobes.max() if len(sidelobes) else 0.0
+        confidence = 1.0 - second / peak
+        return offset + peak_index, float(peak), float(confidence)
+
+
+class Decimator:
+    """窓関数法のFIRローパスをかけてから間引く(ブロックをまたいで状態を持つ)"""
+
+    def __init__(self, factor, taps_per_phase=8):
+        self.factor = factor
+        n = factor * taps_per_phase + 1
+        t = np.arange(n) - (n - 1) / 2
+        # 間引き後のナイキスト周波数の8割で切る
+        cutoff = 0.8 / factor
+        self.taps = cutoff * np.sinc(cutoff * t) * np.hamming(n)
+        self.history = np.zeros(n - 1)
+
+    def process(self, block):
+        """len(block) が factor の倍数のブロックを 1/factor の長さにする"""
+        signal = np.concatenate((self.history, block))
+        self.history = signal[len(block):]
+        return np.convolve(signal, self.taps, mode='valid')[::self.factor]
+
+
+class CoarseToFineDelayTracker:
+    """間引いた信号での全域の粗い探索と, 追跡中の遅延の周りだけの細かい探索を組み合わせた遅延推定器
+
+    粗い探索は 1/decimation のレートのGCC-PHATで最大遅延まで全部を見る(計算量は約1/decimation^2).
+    細かい探索は元のレートのGCC-PHATを, 追跡中の遅延 ±search_margin を含むパーティションだけで行う.
+    細かい探索も粗い探索も信頼度が min_confidence を下回る推定が fallback_after 回続いたら,
+    細かい探索を全域に広げて(従来と同じ全探索)遅延を探し直し, 見つかったらまた窓を絞る.
+    GccPhatDelayTrackerと同じ update() / estimate() で使える.
+    """
+
+    def __init__(self, block_size=256, max_delay_samples=24000, decimation=8, search_margin=512,
+                 min_confidence=0.2, fallback_after=5, smoothing=0.95):
+        self.block_size = block_size
+        self.decimation = decimation
+        self.search_margin = search_margin
+        self.min_confidence = min_confidence
+        self.fallback_after = fallback_after
+        self.coarse = GccPhatDelayTracker(block_size // decimation, -(-max_delay_samples // decimation), smoothing)
+        self.fine = GccPhatDelayTracker(block_size, max_delay_samples, smoothing)
+        # 最初は粗い探索だけで遅延のあたりをつける
+        self.fine.set_window(0, 0)
+        self.reference_decimator = Decimator(decimation)
+        self.captured_decimator = Decimator(decimation)
+        self.full_search = False
+        self.misses = 0
+
+    def update(self, reference, captured):
+        """参照信号とマイク信号を取り込む(長さはブロックの倍数)"""
+        self.coarse.update(self.reference_decimator.process(reference), self.captured_decimator.process(captured))
+        self.fine.update(reference, captured)
+
+    def estimate(self):
+        """細かい探索の結果を優先し, なければ粗い探索の結果を返す(形式はGccPhatDelayTrackerと同じ)"""
+        fine = self.fine.estimate()
+        if fine is not None and fine[2] >= self.min_confidence:
+            self.misses = 0
+            self._follow(fine[0])
+            return fine
+
+        coarse = self.coarse.estimate()
+        if coarse is not None and coarse[2] >= self.min_confidence:
+            # 遅延が窓の外へ動いたか, 窓を置き直した直後. 粗い結果(分解能 decimation サンプル)で代用する
+            self.misses = 0
+            delay_samples = coarse[0] * self.decimation
+            if not self.full_search:
+                self._follow(delay_samples)
+            return delay_samples, coarse[1], coarse[2]
+
+        if not self.full_search and coarse is not None:
+            self.misses += 1
+            if self.misses >= self.fallback_after:
+                # どちらも当てにならない状態が続いたので, 細かい探索を全域に広げる
+                self.full_search = True
+                self.fine.set_window(0, self.fine.num_partitions)
+                self.fine.window_min_updates = self.fine.min_updates
+        return fine if fine is not None else coarse
+
+    def _follow(self, delay_samples):
+        """全探索中か, 遅延が細かい探索の窓の端に近づいたら, 遅延を中心に窓を置き直す"""
+        block_size = self.block_size
+        window_start = self.fine.first_partition * block_size
+        window_end = window_start + self.fine.window_partitions * block_size
+        margin = self.search_margin // 2
+        if not self.full_search and window_start + margin <= delay_samples < window_end - margin:
+            return
+        first = max(0, (delay_samples - self.search_margin) // block_size)
+        last = (delay_samples + self.search_margin) // block_size
+        self.fine.set_window(first, last - first + 1)
+        self.full_search = False
+
+
+class DelayStateTracker:
+    """遅延推定の生の値を平滑化し, 確かめられた変化だけを下流に伝える1次元カルマンフィルタ
+
+    生の推定は相関の強さ x 信頼度 を重みとして取り込み, 重みが小さいほど観測の分散を大きくみなす.
+    予測から gate_sigma 標準偏差(かつ min_gate サンプル)以上離れた推定は外れ値として捨てるが,
+    同じあたり(jump_tolerance サンプル以内)の外れ値が confirm_count 回続いたら本当の変化とみなして乗り移る.
+    公開する遅延(delay_samples)は, 平滑化した値が hysteresis サンプル以上動いたときだけ更新する.
+    """
+
+    def __init__(self, process_noise=4.0, measurement_noise=64.0, min_weight=0.01, gate_sigma=3.0,
+                 min_gate=48, jump_tolerance=48, confirm_count=3, hysteresis=8):
+        self.process_noise = process_noise            # 1回の更新で遅延が動きうる分散(サンプル^2)
+        self.measurement_noise = measurement_noise    # 重み1の推定の分散(サンプル^2)
+        self.min_weight = min_weight
+        self.gate_sigma = gate_sigma
+        self.min_gate = min_gate
+        self.jump_tolerance = jump_tolerance
+        self.confirm_count = confirm_count
+        self.hysteresis = hysteresis
+
+        self.state = None       # 平滑化した遅延
+        self.variance = 0.0
+        self.candidates = []    # 連続した外れ値(乗り移りの候補)
+        self.delay_samples = None
+        self.rejected = 0
+
+    def update(self, delay_samples, correlation, confidence):
+        """生の推定を1つ取り込み, 取り込んだらTrue, 捨てたらFalseを返す"""
+        weight = correlation * max(confidence, 0.0)
+        if weight < self.min_weight:
+            return False
+        noise = self.measurement_noise / weight
+
+        if self.state is None:
+            self._reset(delay_samples, noise)
+            return True
+
+        self.variance += self.process_noise
+        innovation = delay_samples - self.state
+        gate = max(self.gate_sigma * (self.variance + noise) ** 0.5, self.min_gate)
+        if abs(innovation) > gate:
+            return self._consider_jump(delay_samples, noise)
+
+        self.candidates = []
+        gain = self.variance / (self.variance + noise)
+        self.state += gain * innovation
+        self.variance *= 1 - gain
+        self._publish()
+        return True
+
+    def _consider_jump(self, delay_samples, noise):
+        """外れ値を候補に積み, 同じあたりの候補が続いたら乗り移る"""
+        if self.candidates and abs(delay_samples - np.median(self.candidates)) > self.jump_tolerance:
+            self.candidates = []
+        self.candidates.append(delay_samples)
+        if len(self.candidates) < self.confirm_count:
+            self.rejected += 1
+            return False
+        self._reset(float(np.median(self.candidates)), noise)
+        return True
+
+    def _reset(self, delay_samples, noise):
+        self.state = float(delay_samples)
+        self.variance = noise
+        self.candidates = []
+        self.delay_samples = None
+        self._publish()
+
+    def _publish(self):
+        if self.delay_samples is None or abs(self.state - self.delay_samples) >= self.hysteresis:
+            self.delay_samples = int(round(self.state))
@@ -0,0 +1,112 @@
+import numpy as np
+
+
+class DoubleTalkDetector:
+    """ブロックごとのダブルトーク(遠端と近端が同時に話している状態)の検出
+
+    - Geigel: マイクの最大振幅が, エコー経路の長さ分の参照信号の最大振幅の geigel_threshold 倍を超えたら近端の声とみなす
+    - 正規化相互相関(NCC): マイク信号dとエコー推定値yの相関 E[dy]/E[d^2]. エコーだけなら1に近く,
+      近端の声が混ざるとその分だけ下がる. フィルタが収束するまではyが当てにならないので使わない
+
+    遠端が話していて(エコー経路の長さ分の参照信号のRMSの最大が far_silence_db を超える), 両方が近端の声と判定し,
+    さらに誤差(近端の声と残留エコー)のパワーがエコー推定値のパワーを超えたときにダブルトークとする
+    (エコー経路が変わっただけのときはGeigelが反応しない).
+    遠端が無音の間はGeigelが近端の雑音にも反応するので, ダブルトークとは別に遠端無音(far_silent)として返す.
+    エコー経路が見えず, 小さな参照で正規化した更新は近端の声で大きく崩れるので, e.pyはどちらの間も適応を止める.
+    フィルタが一度収束する(ERLEが erle_threshold_db を超える)までは検出しない.
+    検出後も hangover_blocks ブロックはダブルトークとみなし, 語尾で適応を再開しないようにする.
+    channels > 1 ならマイクごとに同じ判定を配列演算でまとめて行う(参照信号は共有).
+    """
+
+    def __init__(self, block_size=256, window_blocks=16, geigel_threshold=0.6, ncc_threshold=0.5,
+                 erle_threshold_db=6.0, hangover_blocks=10, smoothing=0.6, far_silence_db=-50.0, channels=1):
+        self.block_size = block_size
+        self.geigel_threshold = geigel_threshold
+        self.ncc_threshold = ncc_threshold
+        self.erle_threshold = 10 ** (erle_threshold_db / 10)
+        self.hangover_blocks = hangover_blocks
+        self.smoothing = smoothing
+        self.far_silence_power = 10 ** (far_silence_db / 10)
+        self.channels = channels
+
+        # 参照信号のブロックごとの最大振幅と平均パワー(エコー経路の長さ分. 全チャンネルで共有)
+        self.reference_peaks = np.zeros(window_blocks)
+        self.reference_powers = np.zeros(window_blocks)
+        # チャンネルごとの, マイク信号のパワー, マイクとエコー推定値の相互相関, 誤差とエコー推定値のパワー(指数平滑)
+        self.captured_power = np.zeros(channels)
+        self.cross_power = np.zeros(channels)
+        self.error_power = np.zeros(channels)
+        self.echo_power = np.zeros(channels)
+
+        self.converged = np.zeros(channels, dtype=bool)
+        self.hangover = np.zeros(channels, dtype=np.int64)
+        self.channel_active = np.zeros(channels, dtype=bool)
+        # 以下は全チャンネルをまとめた値(どれかがダブルトークならダブルトーク. NCCとERLEは最も低いチャンネル)
+        self.active = False
+        self.far_silent = True  # 遠端が無音か(全チャンネルで共有)
+        self.geigel = False
+        self.ncc = 1.0
+        self.erle_db = 0.0
+        # 通算のブロック数と, ダブルトーク, 遠端無音と判定したブロック数(解析ワーカーが差分を読む)
+        self.blocks = 0
+        self.double_talk_blocks = 0
+        self.far_silent_blocks = 0
+
+    def reset(self):
+        """フィルタを学習し直すときに, 収束の判定からやり直す"""
+        self.reference_peaks[:] = 0
+        self.reference_powers[:] = 0
+        self.captured_power[:] = 0
+        self.cross_power[:] = 0
+        self.error_power[:] = 0
+        self.echo_power[:] = 0
+        self.converged[:] = False
+        self.hangover[:] = 0
+        self.channel_active[:] = False
+        self.active = False
+        self.far_silent = True
+
+    def update(self, reference, captured, echo):
+        """1ブロック分の参照信号, マイク信号, エコー推定値から判定し, ダブルトークならTrueを返す
+
+        マイク信号とエコー推定値が (channels, block_size) の配列なら, 全チャンネルをまとめて判定し
+        チャンネルごとの判定(bool配列)を返す. 遠端が無音かは far_silent に入る.
+        """
+        self.reference_peaks[1:] = self.reference_peaks[:-1]
+        self.reference_peaks[0] = np.abs(reference).max()
+        self.reference_powers[1:] = self.reference_powers[:-1]
+        self.reference_powers[0] = np.dot(reference, reference) / len(reference)
+        self.far_silent = bool(self.reference_powers.max() < self.far_silence_power)
+        captured_2d = np.atleast_2d(captured)
+        echo_2d = np.atleast_2d(echo)
+        geigel = np.abs(captured_2d).max(axis=1) > self.geigel_threshold * self.reference_peaks.max()
+
+        error = captured_2d - echo_2d
+        a = self.smoothing
+        self.captured_power = a * self.captured_power + (1 - a) * np.einsum('cn,cn->c', captured_2d, captured_2d)
+        self.cross_power = a * self.cross_power + (1 - a) * np.einsum('cn,cn->c', captured_2d, echo_2d)
+        self.error_power = a * self.error_power + (1 - a) * np.einsum('cn,cn->c', error, error)
+        self.echo_power = a * self.echo_power + (1 - a) * np.einsum('cn,cn->c', echo_2d, echo_2d)
+        ncc = self.cross_power / (self.captured_power + 1e-10)
+        erle = (self.captured_power + 1e-10) / (self.error_power + 1e-10)
+
+        # 遠端が話している間の, 収束済みのチャンネルだけ判定し, 判定の後で収束したかを更新する
+        detected = (self.converged & geigel & (ncc < self.ncc_threshold)
+                    & (self.error_power > self.echo_power) & (not self.far_silent))
+        self.converged |= erle > self.erle_threshold
+
+        self.hangover = np.where(detected, self.hangover_blocks, np.maximum(self.hangover - 1, 0))
+        self.channel_active = detected | (self.hangover > 0)
+
+        self.active = bool(self.channel_active.any())
+        self.geigel = bool(geigel.any())
+        self.ncc = float(ncc.min())
+        self.erle_db = float(10 * np.log10(erle.min()))
+        self.blocks += 1
+        if self.active:
+            self.double_talk_blocks += 1
+        if self.far_silent:
+            self.far_silent_blocks += 1
+        if np.ndim(captured) > 1:
+            return self.channel_active
+        return self.active
@@ -1,234 +1,564 @@
+import asyncio
 import socket
-import subprocess
 import threading
 import sys
-import audioop
 import time
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
-import struct
-from collections import deque
 import numpy as np
+from analysis_worker import AnalysisWorker, DelayEstimate, INITIAL_ESTIMATE
+from adaptive_filter import PartitionedBlockFilter
+from double_talk import DoubleTalkDetector
+from ring_buffer import RingBuffer
+from audio_io import Pacer, deinterleave, downmix, open_audio, parse_audio_options
+from transport import open_channel, parse_transport_options, wire_frame_samples
+import aio_transport
+from delay_estimator import CoarseToFineDelayTracker, DelayStateTracker
+from jitter_buffer import JitterBuffer
+from amplitude_recorder import AmplitudeRecorder
+from clock_drift import EchoDriftTracker
+from metrics import open_metrics, parse_metrics_options
+from resampler import FractionalResampler, PolyphaseResampler, Reframer, block_size_for, parse_rate_options
+from session_recorder import open_recorder, parse_record_options
+from gain_stage import GainStage
 
 # 定数
 BUFFER_SIZE = 512
+SAMPLE_RATE = 48000
+# 何パケットごとに遅延推定を依頼するか. 推定結果の表示はその PRINT_EVERY 回に1回
+ANALYSIS_INTERVAL = 10
+PRINT_EVERY = 5
 # SoXのオーディオ設定（C言語版と同一）
 AUDIO_FORMAT = [
     '-t', 'raw',    # タイプ: raw
     '-b', '16',     # ビット深度: 16-bit
-    '-c', '1',      # チャンネル数: 1 (mono)
+    '-c', '1',      # チャンネル数: 1 (mono). 録音は --channels の数に差し替える
     '-e', 's',      # エンコーディング: signed-integer
-    '-r', '48000',  # サンプルレート: 48kHz
+    '-r', str(SAMPLE_RATE),  # サンプルレート: 48kHz
     '-',            # 標準入出力を使用
 ]
 
 class EchoCanceller:
-    def __init__(self, sample_rate=48000, max_delay_s=0.5):
+    def __init__(self, sample_rate=48000, max_delay_s=0.5, block_size=256, num_partitions=16, verbose=True,
+                 channels=1, analysis_interval=ANALYSIS_INTERVAL, delay_smoothing=0.95, gain_midpoint=0.2,
+                 gain_steepness=10):
         self.sample_rate = sample_rate
+        self.channels = channels  # マイクのチャンネル数(エコー除去はチャンネルごと, 遅延推定は平均で行う)
+        self.verbose = verbose  # 推定結果をコンソールに表示するか
         self.max_delay_samples = int(max_delay_s * sample_rate)
 
         # 送信音声の履歴(相互相関用)
-        self.sent_audio_buffer = deque(maxlen=self.max_delay_samples * 2)
+        self.sent_audio_buffer = RingBuffer(self.max_delay_samples * 2)
 
         # 受信音声バッファ
-        self.received_audio_buffer = deque(maxlen=self.max_delay_samples * 2)
+        self.received_audio_buffer = RingBuffer(self.max_delay_samples * 2)
 
-        self.estimated_delay = 0
         self.lock = threading.Lock()
         self.process_count = 0  # 処理頻度制御用
+        self.analysis_interval = analysis_interval  # 何パケットごとに遅延推定を依頼するか
+        self.metrics = None  # 計測値の出力先(MetricsWriter)
 
-        self.gain = 1
+        # 解析ワーカーが公開する最新の推定結果と, 解析の依頼用イベント
+        self.estimate = INITIAL_ESTIMATE
+        self.analysis_request = threading.Event()
+
+        # 粗い全域探索と細かい局所探索を組み合わせた遅延推定器と, 推定器に渡し済みのマイク音声の通算位置(解析ワーカーだけが触る)
+        # delay_smoothing は相互スペクトルの平均の重み(約 1/(1 - delay_smoothing) ブロックの窓)
+        self.delay_tracker = CoarseToFineDelayTracker(block_size=block_size, max_delay_samples=self.max_delay_samples,
+                                                      smoothing=delay_smoothing)
+        self.analysis_count = 0
+        self.analysis_position = 0
+        # 生の推定を平滑化し, 外れ値を捨てて, 確かめられた変化だけを公開する
+        self.delay_state = DelayStateTracker()
+        # 相関の強さをゲインに変換するシグモイドの中心と傾き(推定結果と計測値に出す参考値で, 送信音声には掛けない)
+        self.gain_midpoint = gain_midpoint
+        self.gain_steepness = gain_steepness
+        # マイクとスピーカーのクロックのずれ. 遅延の傾きから推定し, 参照信号をマイクのクロックに合わせて伸縮する
+        self.echo_drift = EchoDriftTracker(sample_rate)
+        self.reference_clock = FractionalResampler()
+
+        # 適応フィルタ(参照: 受信音声, 目的信号: マイク音声). 複数のマイクは1つのフィルタでまとめて処理する
+        self.block_size = block_size
+        self.echo_filter = PartitionedBlockFilter(block_size=block_size, num_partitions=num_partitions,
+                                                  channels=channels)
+        # ダブルトーク中はフィルタの適応と遅延推定を止める(マイクごとに判定する)
+        self.double_talk = DoubleTalkDetector(block_size=block_size, window_blocks=num_partitions, channels=channels)
+        # 前回の解析までに見た (ブロック数, ダブルトークのブロック数) と, 推定を省くダブルトークの割合
+        self.double_talk_seen = (0, 0, 0)
+        self.max_double_talk_ratio = 0.5
+        # マイク音声の通算位置に足すと, 同じ時刻の受信音声バッファ上の通算位置になる差.
+        # 送信スレッドが参照ブロックを読むときに決め, 参照の読み出しと遅延推定のスナップショットの両方で使う
+        # (推定した遅延がそのまま参照を遅らせる量になる). スレッドの揺らぎで参照がまだ届いていないことが
+        # ないよう, 最新のブロックより arrival_margin だけ前に対応付ける
+        self.reference_offset = None
+        self.arrival_margin = 2 * block_size
+        self.silence = np.zeros(block_size)
+        # 参照信号を遅らせる量(バルク遅延). 適応フィルタは bulk_delay 〜 bulk_delay + フィルタ長 の遅延を受け持つ.
+        # 解析ワーカーが pending_bulk_delay を決め, 送信スレッドがブロックの切れ目で反映する
+        self.filter_length = block_size * num_partitions
+        self.bulk_delay = 0
+        self.pending_bulk_delay = 0
+        # エコーの遅延がフィルタの先頭からこれだけ離れていて, 末尾の残響分の余裕もあれば合わせ直さない
+        self.pre_margin = 2 * block_size
+        self.tail_margin = self.filter_length // 4
 
     def add_sent_audio(self, audio_data):
-        """送信音声データを追加"""
+        """送信音声データを追加(複数チャンネルなら平均して遅延推定に使う)"""
+        if self.channels > 1:
+            audio_data = deinterleave(audio_data, self.channels).mean(axis=0).astype(np.int16)
         with self.lock:
-            # バイトデータを16bit整数配列に変換
-            samples = struct.unpack(f'<{len(audio_data)//2}h', audio_data)
-            self.sent_audio_buffer.extend(samples)
+            self.sent_audio_buffer.write(audio_data)
+
+    @property
+    def estimated_delay(self):
+        return self.estimate.delay_samples
 
     def process_received_audio(self, audio_data):
-        """受信音声を処理し、遅延を推定"""
+        """受信音声を(マイクのクロックに合わせて伸縮してから)記録し、一定間隔で解析ワーカーに遅延推定を依頼"""
+        self.reference_clock.ratio = self.echo_drift.ratio
+        reference = self.reference_clock.process_bytes(audio_data)
         with self.lock:
-            # バイトデータを16bit整数配列に変換
-            samples = struct.unpack(f'<{len(audio_data)//2}h', audio_data)
-            self.received_audio_buffer.extend(samples)
+            self.received_audio_buffer.write(reference)
 
-            # 処理頻度を下げる（50回に1回のみ実行）
-            self.process_count += 1
-            if (self.process_count % 50 == 0 and 
-                len(self.received_audio_buffer) >= self.max_delay_samples * 2 and 
-                len(self.sent_audio_buffer) >= self.max_delay_samples * 2):
-                self.estimate_delay()
+        # 処理頻度を下げる（analysis_interval回に1回のみ依頼）
+        self.process_count += 1
+        if self.process_count % self.analysis_interval == 0:
+            self.analysis_request.set()
 
         return audio_data # 処理後のデータを返す
+
+    def cancel_echo(self, audio_data):
+        """マイク音声から適応フィルタで推定したエコーを差し引く
+
+        複数チャンネルは (channels, サンプル数) のビューにして, ブロックごとに全チャンネルを一度に処理する.
+        """
+        samples = deinterleave(audio_data, self.channels)
+        length = samples.shape[-1]
+        if length == 0 or length % self.block_size != 0:
+            return audio_data
+
+        if self.pending_bulk_delay != self.bulk_delay:
+            # 遅延の変化が確かめられたので参照をずらし, フィルタは学習し直す(遠端のパワーの推定は残す)
+            self.bulk_delay = self.pending_bulk_delay
+            self.echo_filter.reset(keep_power=True)
+            self.double_talk.reset()
+
+        captured = samples / 32768.0
+        output = np.empty_like(captured)
+        # このブロック列の先頭のマイク音声の通算位置(add_sent_audio で書き込み済み)
+        position = self.sent_audio_buffer.total - length
+        for start in range(0, length, self.block_size):
+            reference = self.next_reference_block(position + start)
+            end = start + self.block_size
+            block = captured[..., start:end]
+            echo = self.echo_filter.predict(reference)
+            output[..., start:end] = block - echo
+            # ダブルトークのチャンネルだけ適応を止める. 遠端が無音の間は全チャンネルで止める
+            talking = self.double_talk.update(reference, block, echo)
+            self.echo_filter.adapt = np.logical_not(talking | self.double_talk.far_silent)
+            if np.any(self.echo_filter.adapt):
+                self.echo_filter.update(output[..., start:end])
+
+        # インターリーブに戻す
+        output = np.clip(output * 32768.0, -32768, 32767)
+        return output.T.astype('<i2').tobytes()
+
+    def next_reference_block(self, position):
+        """マイク音声の通算位置 position のブロックに対応する参照ブロック(bulk_delay だけ前)を取り出す
+
+        対応付けはブロックごとに保ち, 次の場合だけ決め直す.
+        - 対応する受信音声がまだ届いていない(マイクが先に進んだ): 届いている分に合わせてずらす
+        - 受信音声が max_delay_samples 以上先に進んだ(送信側が遅れすぎた): 古い参照を捨て, フィルタも学習し直す(パワーの推定は残す)
+        """
+        # totalは書き込み完了後に更新されるのでロック不要
+        received_total = self.received_audio_buffer.total
+        if received_total < self.block_size:
+            return self.silence
+        anchor = received_total - self.block_size - self.arrival_margin - position
+        if self.reference_offset is None or anchor + self.arrival_margin < self.reference_offset:
+            self.reference_offset = anchor
+        elif anchor - self.reference_offset > self.max_delay_samples:
+            self.reference_offset = anchor
+            self.echo_filter.reset(keep_power=True)
+            self.double_talk.reset()
+        start = position + self.reference_offset - self.bulk_delay
+        if start < 0:
+            return self.silence
+        return self.received_audio_buffer.read(start, self.block_size) / 32768.0
+
+    def align_reference(self, delay_samples):
+        """公開した遅延がフィルタの受け持つ範囲から外れたら, バルク遅延の変更を送信スレッドに依頼する"""
+        # バルク遅延は参照の対応(arrival_margin だけ古い側)からの遅れで数える
+        delay_samples -= self.arrival_margin
+        lower = self.bulk_delay + self.pre_margin if self.bulk_delay else 0
+        upper = self.bulk_delay + self.filter_length - self.tail_margin
+        if lower <= delay_samples <= upper:
+            return False
+        block_size = self.block_size
+        self.pending_bulk_delay = max(0, delay_samples - self.pre_margin) // block_size * block_size
+        return True
     
-    def estimate_delay(self):
-        """FFTを使った高速相互相関による遅延推定"""
-        window_size = 8192
-        if len(self.sent_audio_buffer) < window_size or len(self.received_audio_buffer) < window_size:
+    def snapshot(self):
+        """前回の解析以降に届いたマイク/受信音声をブロック単位でコピーして返す(ロックはコピーの間だけ)
+
+        マイク音声と受信音声は送信スレッドが参照の読み出しに使う対応(reference_offset)で並べるので,
+        推定した遅延は bulk_delay と同じ基準になる.
+        """
+        block_size = self.block_size
+        offset = self.reference_offset
+        if offset is None:
+            return None
+        with self.lock:
+            sent_total = self.sent_audio_buffer.total
+            received_total = self.received_audio_buffer.total
+            start = max(self.analysis_position, sent_total - self.max_delay_samples, -offset)
+            count = (min(sent_total, received_total - offset) - start) // block_size * block_size
+            if count <= 0:
+                return None
+            sent_samples = self.sent_audio_buffer.read(start, count).astype(np.float32)
+            received_samples = self.received_audio_buffer.read(start + offset, count).astype(np.float32)
+        self.analysis_position = start + count
+        return sent_samples, received_samples
+
+    def analyze(self):
+        """解析ワーカーから呼ばれ、スナップショットで遅延を推定して結果を公開"""
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return
+        self.analysis_count += 1
+        # 前回の解析以降のブロックの多くがダブルトークか遠端の無音なら, エコー経路が見えないので推定しない
+        detector = self.double_talk
+        counts = (detector.blocks, detector.double_talk_blocks, detector.far_silent_blocks)
+        seen_blocks, seen_double_talk, seen_far_silent = self.double_talk_seen
+        self.double_talk_seen = counts
+        blocks = max(counts[0] - seen_blocks, 1)
+        ratio = (counts[1] - seen_double_talk) / blocks
+        far_silent_ratio = (counts[2] - seen_far_silent) / blocks
+        skipped = ratio + far_silent_ratio > self.max_double_talk_ratio
+        if self.metrics is not None:
+            self.metrics.emit('double_talk', detector.active, ratio, detector.ncc, detector.erle_db, skipped,
+                              far_silent_ratio)
+        show = self.verbose and self.analysis_count % PRINT_EVERY == 0
+        if skipped:
+            if show:
+                print(f"ダブルトークか遠端の無音のため遅延推定を省略 "
+                      f"(ダブルトーク: {ratio:.2f}, 遠端の無音: {far_silent_ratio:.2f})")
             return
-        
-        sent_samples = np.array(list(self.sent_audio_buffer)[-window_size:], dtype=np.float32)
-        received_samples = np.array(list(self.received_audio_buffer)[-window_size:], dtype=np.float32)
-        
-        # 平均を引く（DC成分除去）
-        sent_samples = sent_samples - np.mean(sent_samples)
-        received_samples = received_samples - np.mean(received_samples)
-        
-        # FFTベースの相互相関計算
-        correlation_length = len(sent_samples) + len(received_samples) - 1
-        fft_size = 2 ** int(np.ceil(np.log2(correlation_length)))
-        
-        sent_fft = np.fft.rfft(sent_samples, fft_size)
-        received_fft = np.fft.rfft(received_samples, fft_size)
-        
-        cross_correlation_fft = sent_fft.conj() * received_fft
-        correlation = np.fft.irfft(cross_correlation_fft, fft_size)
-        correlation = correlation[:correlation_length]
-        
-        # 正規化（重要！）
-        norm = np.sqrt(np.sum(sent_samples**2) * np.sum(received_samples**2))
-        if norm > 0:
-            correlation = correlation / norm
-        
-        max_corr_index = np.argmax(np.abs(correlation))
-        correlation_center = len(correlation) // 2
-        delay_samples = max_corr_index - correlation_center
-        
-        if 0 <= delay_samples <= self.max_delay_samples:
-            self.estimated_delay = delay_samples
-            delay_s = delay_samples / self.sample_rate
-            correlation_strength = np.abs(correlation[max_corr_index])
-            self.gain = sigmoid(correlation_strength)
-            print(f"推定遅延(FFT): {delay_s:.3f}s ({delay_samples}サンプル) 相関: {correlation_strength:.3f} ゲイン: {self.gain}")
+        raw = self.estimate_delay(*snapshot)
+        if raw is None:
+            return
+        if self.delay_state.update(raw.delay_samples, raw.correlation, raw.confidence):
+            # 参照の差し替えだけで公開するので, 音声スレッドはロック不要
+            self.estimate = raw._replace(delay_samples=self.delay_state.delay_samples)
+            if self.align_reference(self.estimate.delay_samples) and self.verbose:
+                print(f"参照の遅延を {self.pending_bulk_delay}サンプルに合わせ直します")
+            if (self.echo_drift.update(self.analysis_position, raw.delay_samples, raw.correlation * raw.confidence)
+                    and self.verbose):
+                print(f"マイクとスピーカーのクロックのずれ: {self.echo_drift.ppm:+.1f}ppm")
+        # 外れ値は公開しない(ゲインも前回の推定のまま)
+        estimate = self.estimate
+        delay_s = estimate.delay_samples / self.sample_rate
+        if self.metrics is not None:
+            self.metrics.emit('delay', estimate.delay_samples, delay_s, estimate.correlation, estimate.gain,
+                              estimate.confidence, raw.delay_samples, self.echo_drift.ppm)
+        if not show:
+            return
+        print(f"推定遅延(FFT): {delay_s:.3f}s ({estimate.delay_samples}サンプル) 相関: {estimate.correlation:.3f} ゲイン: {estimate.gain} 信頼度: {estimate.confidence:.3f} 生の推定: {raw.delay_samples}サンプル")
+
+    def estimate_delay(self, sent_samples, received_samples):
+        """GCC-PHATによる遅延推定(受信音声に対するマイク音声の遅れ). 粗い探索から細かい探索へ絞り込む"""
+        # スナップショット全体をまとめて渡す(推定器の中でブロックごとに処理する)
+        self.delay_tracker.update(received_samples, sent_samples)
+
+        result = self.delay_tracker.estimate()
+        if result is None:
+            return None
+        delay_samples, correlation_strength, confidence = result
+        # スナップショットは arrival_margin だけ古い参照と並べてあるので, その分を足して
+        # 受信とマイクの同時刻からの遅れにする
+        delay_samples += self.arrival_margin
+        gain = float(sigmoid(correlation_strength, self.gain_midpoint, self.gain_steepness))
+        return DelayEstimate(delay_samples, correlation_strength, gain, confidence, time.time())
 
 def sigmoid(correlation_strength, midpoint=0.2, steepness=10):
     sig = 1 - 1 / (1 + np.exp(-steepness * (correlation_strength - midpoint)))
     return sig
 
-def apply_volume_limiter(data, gain):
-    sample_count = len(data) // 2
-    samples = struct.unpack(f'<{sample_count}h', data)
-    limited_samples = [int(sample * gain) for sample in samples]
-    limited_samples = [int(sample / 7) for sample in samples]
-    return struct.pack(f'<{len(limited_samples)}h', *limited_samples)
-
-def apply_volume_limiter0(audio_data):
-    """
-    音声データに音量制限を適用する
-    
-    Args:
-        audio_data (bytes): 16bit signed integer形式の音声データ
-    
-    Returns:
-        bytes: 音量制限が適用された音声データ
-    """
-    MAX_AMPLITUDE = 20000 
-    LIMITER_RATIO = 0.8
-
-    if len(audio_data) < 2:
-        return audio_data
-    
-    # バイトデータを16bit signed integerの配列に変換
-    sample_count = len(audio_data) // 2
-    samples = struct.unpack(f'<{sample_count}h', audio_data)
-    
-    # 音量制限を適用
-    limited_samples = []
-    for sample in samples:
-        # 絶対値が最大振幅を超えている場合は制限
-        if abs(sample) > MAX_AMPLITUDE:
-            # ソフトリミッティング（急激な変化を避ける）
-            if sample > 0:
-                limited_sample = int(MAX_AMPLITUDE + (sample - MAX_AMPLITUDE) * LIMITER_RATIO)
-                limited_sample = min(limited_sample, 32767)  # 16bit上限
-            else:
-                limited_sample = int(-MAX_AMPLITUDE + (sample + MAX_AMPLITUDE) * LIMITER_RATIO)
-                limited_sample = max(limited_sample, -32768)  # 16bit下限
-        else:
-            limited_sample = sample
-        
-        limited_samples.append(limited_sample)
-    
-    # 16bit signed integerの配列をバイトデータに変換
-    return struct.pack(f'<{len(limited_samples)}h', *limited_samples)
+def process_captured_audio(data, canceller, stage):
+    """送信前の処理(エコー除去とゲイン)をかけ, エコー除去後の音声と送信データを返す"""
+    # エコーキャンセラに送信音声を記録
+    canceller.add_sent_audio(data)
+    # 推定したエコーを差し引く
+    cancelled = canceller.cancel_echo(data)
+    # 固定の音量とソフトリミッタを適用する. 相関から求めたゲインは掛けない(エコー除去前のマイク音声の相関は
+    # 近端の声があっても0.9を超え, ゲインがほぼ0になって送信が無音になる)
+    return cancelled, stage.process(cancelled, 1.0)
 
+# 送信音量(ハウリング対策で固定で1/7に減衰させる)
+OUTPUT_VOLUME = 1 / 7
 
 # グローバルなエコーキャンセラーインスタンス
 echo_canceller = EchoCanceller()
+# 送信音量ステージ(ゲイン変化は滑らかに補間する)
+gain_stage = GainStage(volume=OUTPUT_VOLUME)
+
+def configure_dsp(dsp_rate, channels=1):
+    """エコー除去と遅延推定を dsp_rate, channels チャンネルで動かすよう, エコーキャンセラと音量ステージを作り直す"""
+    global echo_canceller, gain_stage
+    block_size = block_size_for(dsp_rate, SAMPLE_RATE, BUFFER_SIZE // 2)
+    echo_canceller = EchoCanceller(sample_rate=dsp_rate, block_size=block_size, channels=channels)
+    gain_stage = GainStage(volume=OUTPUT_VOLUME, block_size=block_size, channels=channels)
+
+def send_pipeline(channel, dsp_rate=SAMPLE_RATE, session_recorder=None):
+    """録音したデータから伝送路のフレームのリストを作る関数を返す(send_audio と send_audio_async で共有)
+
+    デバイス → 信号処理 → 伝送路 の順にレートを変換する(同じレートなら何もしない).
+    マイクの全チャンネルを処理し, 相手が受け付けなければモノラルにする.
+    session_recorder があればマイクの音声と送信するフレームを記録する.
+    """
+    channels = echo_canceller.channels
+    to_dsp = PolyphaseResampler(SAMPLE_RATE, dsp_rate, channels=channels)
+    dsp_blocks = Reframer(echo_canceller.block_size, channels)
+    to_wire = PolyphaseResampler(dsp_rate, channel.sample_rate, channels=channel.channels)
+    wire_frames = Reframer(channel.frame_samples, channel.channels)
+
+    def process(data):
+        if session_recorder is not None:
+            session_recorder.append('mic', data)
+        frames = []
+        for block in dsp_blocks.push(to_dsp.process_bytes(data)):
+            # エコー除去とゲイン
+            _, block = process_captured_audio(block, echo_canceller, gain_stage)
+            if channel.channels != channels:
+                block = downmix(block, channels)
+
+            for frame in wire_frames.push(to_wire.process_bytes(block)):
+                if session_recorder is not None:
+                    session_recorder.append('sent', frame)
+                frames.append(frame)
+        return frames
+    return process
 
-def send_audio(sock):
-    """マイクから音声を録音し、ソケット経由で送信する"""
-    rec_process = subprocess.Popen(['rec'] + AUDIO_FORMAT, stdout=subprocess.PIPE)
+def send_audio(channel, source, dsp_rate=SAMPLE_RATE, session_recorder=None):
+    """マイク(AudioSource)から音声を録音し、メディアチャネル経由で送信する(処理は send_pipeline)"""
     print("音声送信スレッドを開始しました。")
 
+    channels = echo_canceller.channels
+    process = send_pipeline(channel, dsp_rate, session_recorder)
     try:
         while True:
-            data = rec_process.stdout.read(BUFFER_SIZE)
+            data = source.read(BUFFER_SIZE * channels)
             if not data:
                 break
-
-            # エコーキャンセラに送信音声を記録
-            echo_canceller.add_sent_audio(data)
-            gain = echo_canceller.gain
-
-            #簡易なエコーキャンセラの実装
-            data = apply_volume_limiter(data, gain)
-
-            sock.sendall(data)
+            for frame in process(data):
+                channel.send(frame)
     except (BrokenPipeError, ConnectionResetError):
         print("送信中に接続が切れました。")
+    except OSError as e:
+        # 通話の終わりに受信スレッドがチャネルを閉じたあとは送れないのが正常なので, 表示しない
+        if not channel.closed:
+            print(f"send_audioでエラーが発生しました: {e}")
     except Exception as e:
         print(f"send_audioでエラーが発生しました: {e}")
     finally:
-        rec_process.terminate()
+        source.close()
         print("送信スレッド終了")
 
-def recv_audio(sock, amplitudes, timestamps, duration=60.0):
-    """ソケットから音声データを受信し、スピーカーで再生しつつ振幅を記録"""
-    play_process = subprocess.Popen(['play'] + AUDIO_FORMAT, stdin=subprocess.PIPE)
+def recv_audio(channel, jitter_buffer, session_recorder=None, duration=60.0):
+    """メディアチャネルから音声フレームを受信し、ジッタバッファに入れる(再生はモノラルなので, 複数チャンネルは平均する)
+
+    session_recorder があれば受信したフレームを(平均する前に)タイムスタンプとシーケンス番号ごと記録する.
+    """
     print("音声受信スレッドを開始しました。")
 
     start_time = None
     try:
         while True:
-            data = sock.recv(BUFFER_SIZE)
-            if not data:
+            frame = channel.recv()
+            if frame is None:
                 break
             now = time.time()
             if start_time is None:
                 start_time = now
-            elapsed = now - start_time
-            if elapsed > duration:
+            if now - start_time > duration:
                 print(f"{duration}秒の記録完了")
                 break
-
-            processed_data = echo_canceller.process_received_audio(data)
-            # RMS振幅を記録
-            rms = audioop.rms(processed_data, 2)
-            amplitudes.append(rms)
-            timestamps.append(elapsed)
-            # 再生
-            play_process.stdin.write(data)
+            accept_frame(channel, frame, jitter_buffer, session_recorder)
     except (BrokenPipeError, ConnectionResetError):
         print("受信中に接続が切れました。")
     except Exception as e:
         print(f"recv_audioでエラー: {e}")
     finally:
-        play_process.terminate()
+        jitter_buffer.close()
+        print(f"ジッタバッファ: {jitter_buffer.stats()}")
         print("受信スレッド終了")
-        sock.close()
+        channel.close()
+
+def accept_frame(channel, frame, jitter_buffer, session_recorder=None):
+    """受信したフレームを記録し, モノラルにしてジッタバッファに入れる(recv_audio と recv_audio_async で共有)"""
+    if session_recorder is not None:
+        session_recorder.append('received', frame.payload, frame.timestamp, frame.sequence)
+    if channel.peer_channels > 1:
+        frame = frame._replace(payload=downmix(frame.payload, channel.peer_channels))
+    jitter_buffer.put(frame)
 
-def plot_wave(amplitudes, timestamps):
-    """メインスレッドで振幅をプロット"""
-    if not amplitudes:
+def play_audio(jitter_buffer, sink, recorder, metrics=None, dsp_rate=SAMPLE_RATE, session_recorder=None):
+    """ジッタバッファから1フレームずつ一定のペースで取り出し、スピーカー(AudioSink)で再生しつつ振幅を記録
+
+    伝送路 → 信号処理 → デバイス の順にレートを変換する(同じレートなら何もしない).
+    session_recorder があれば再生した音声を記録する.
+    """
+    print("音声再生スレッドを開始しました。")
+
+    # 相手の録音のクロックとのずれは, ジッタバッファが決めた比で伸縮して吸収する
+    clock = FractionalResampler()
+    to_dsp = PolyphaseResampler(jitter_buffer.sample_rate, dsp_rate)
+    to_device = PolyphaseResampler(dsp_rate, SAMPLE_RATE)
+    pacer = Pacer(SAMPLE_RATE)
+    start_time = time.time()
+    played = 0
+    try:
+        while not jitter_buffer.closed:
+            clock.ratio = jitter_buffer.playout_ratio()
+            data = to_dsp.process_bytes(clock.process_bytes(jitter_buffer.get()))
+            output = to_device.process_bytes(data)
+            pacer.wait(len(output) // 2)
+
+            # 実際に再生する音声をエコーキャンセラの参照にする
+            processed_data = echo_canceller.process_received_audio(data)
+            # RMS振幅を記録
+            rms = recorder.record(processed_data, time.time() - start_time)
+            # 再生
+            sink.write(output)
+            if session_recorder is not None:
+                session_recorder.append('played', output)
+
+            if metrics is not None:
+                metrics.emit('rms', rms)
+                played += 1
+                if played % 50 == 0:
+                    metrics.emit_mapping('jitter', jitter_buffer.stats())
+    except BrokenPipeError:
+        print("再生先が閉じられました。")
+    except Exception as e:
+        print(f"play_audioでエラー: {e}")
+    finally:
+        sink.close()
+        print("再生スレッド終了")
+
+async def send_audio_async(channel, source, executor, dsp_rate=SAMPLE_RATE, session_recorder=None):
+    """send_audio のasyncio版. 録音の読み出しと信号処理は executor のスレッドで行い, 送信はループ上で行う"""
+    loop = asyncio.get_running_loop()
+    channels = echo_canceller.channels
+    process = send_pipeline(channel, dsp_rate, session_recorder)
+
+    def capture():
+        data = source.read(BUFFER_SIZE * channels)
+        return process(data) if data else None
+
+    try:
+        while True:
+            frames = await loop.run_in_executor(executor, capture)
+            if frames is None:
+                break
+            for frame in frames:
+                await channel.send(frame)
+    except ConnectionError:
+        print("送信中に接続が切れました。")
+    finally:
+        # 取り消されたときも, 読み出し中のスレッドを録音の終わりで返らせる
+        source.close()
+
+async def recv_audio_async(channel, jitter_buffer, session_recorder=None, duration=60.0):
+    """recv_audio のasyncio版. 受け取ったフレームはループ上でジッタバッファに入れる(待たない)"""
+    start_time = None
+    try:
+        while True:
+            frame = await channel.recv()
+            if frame is None:
+                break
+            now = time.time()
+            if start_time is None:
+                start_time = now
+            if now - start_time > duration:
+                print(f"{duration}秒の記録完了")
+                break
+            accept_frame(channel, frame, jitter_buffer, session_recorder)
+    finally:
+        jitter_buffer.close()
+        print(f"ジッタバッファ: {jitter_buffer.stats()}")
+        channel.close()
+
+async def run_call_async(sock, is_server, transport_options, frame_samples, dsp_rate, audio_options,
+                         record_options, recorder, metrics):
+    """接続済みのソケットで, 送受信を1本のイベントループで行う通話(--asyncio)
+
+    ハンドシェイクと送受信は aio_transport のチャネルで行い, スレッド版の相手ともそのままつながる.
+    止まるまで返らない録音の読み出し(と送信前の信号処理)と, 実時間のペースで待つ再生は
+    executor の2本のスレッドで動かす. 受信が終わったら再生の終わりを待ち, 送信を取り消す.
+    記録を始めたら SessionRecorder を返す.
+    """
+    reader, writer = await asyncio.open_connection(sock=sock)
+    channel = await aio_transport.open_channel(reader, writer, is_server, transport_options, frame_samples, dsp_rate)
+    print(f"コーデック: {channel.encoder.name}, サンプルレート: {channel.sample_rate}Hz (asyncioで送受信)")
+    channels = echo_canceller.channels
+    source, sink = open_audio(audio_options, AUDIO_FORMAT, SAMPLE_RATE, BUFFER_SIZE // 2, channels)
+    session_recorder = open_recorder(record_options, SAMPLE_RATE, channels, channel)
+    jitter_buffer = JitterBuffer(channel.frame_samples, channel.sample_rate)
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sender = asyncio.ensure_future(send_audio_async(channel, source, executor, dsp_rate, session_recorder))
+        player = loop.run_in_executor(executor, play_audio, jitter_buffer, sink, recorder, metrics, dsp_rate,
+                                      session_recorder)
+        await recv_audio_async(channel, jitter_buffer, session_recorder)
+        await player
+        sender.cancel()
+        try:
+            await sender
+        except asyncio.CancelledError:
+            pass
+    return session_recorder
+
+def run_call(sock, is_server, transport_options, frame_samples, dsp_rate, audio_options, record_options, recorder,
+             metrics):
+    """接続済みのソケットでハンドシェイクし, 通話が終わるまで送受信と再生を行う(記録していれば SessionRecorder を返す)
+
+    既定では送信, 受信, 再生をそれぞれのスレッドで行い, --asyncio なら run_call_async で行う.
+    """
+    if transport_options.asyncio:
+        return asyncio.run(run_call_async(sock, is_server, transport_options, frame_samples, dsp_rate,
+                                          audio_options, record_options, recorder, metrics))
+
+    channels = echo_canceller.channels
+    channel = open_channel(sock, is_server, transport_options, frame_samples, dsp_rate, channels)
+    source, sink = open_audio(audio_options, AUDIO_FORMAT, SAMPLE_RATE, BUFFER_SIZE // 2, channels)
+    session_recorder = open_recorder(record_options, SAMPLE_RATE, channels, channel)
+    sender = threading.Thread(target=send_audio, args=(channel, source, dsp_rate, session_recorder), daemon=True)
+    jitter_buffer = JitterBuffer(channel.frame_samples, channel.sample_rate)
+    receiver = threading.Thread(target=recv_audio, args=(channel, jitter_buffer, session_recorder), daemon=True)
+    player = threading.Thread(target=play_audio,
+                              args=(jitter_buffer, sink, recorder, metrics, dsp_rate, session_recorder),
+                              daemon=True)
+    sender.start()
+    receiver.start()
+    player.start()
+    receiver.join()
+    player.join()
+    sender.join()
+    return session_recorder
+
+def plot_wave(recorder):
+    """メインスレッドで振幅をプロット(長い通話は区間ごとの最小・最大の幅と平均で描く)"""
+    if recorder.count == 0:
         print("プロットするデータがありません。")
         return
     
-    avg_amplitude = sum(amplitudes) / len(amplitudes)
-    print(f"平均RMS振幅: {avg_amplitude:.2f}")
+    print(f"平均RMS振幅: {recorder.mean():.2f}")
     
+    times, lows, highs, means = recorder.series()
     plt.figure(figsize=(8, 4))
-    plt.plot(timestamps, amplitudes)
+    plt.fill_between(times, lows, highs, alpha=0.3)
+    plt.plot(times, means)
     plt.xlabel("Time (s)")
     plt.ylabel("RMS amplitude")
     plt.title("Amplitude record")
@@ -237,51 +567,74 @@ def plot_wave(amplitudes, timestamps):
     plt.show()
 
 def main():
-    if len(sys.argv) < 2:
-        print(f"使い方: python {sys.argv[0]} [server <port> | client <host> <port>]")
+    argv, audio_options = parse_audio_options(sys.argv[1:])
+    argv, transport_options = parse_transport_options(argv)
+    argv, metrics_options = parse_metrics_options(argv)
+    argv, rate_options = parse_rate_options(argv)
+    argv, record_options = parse_record_options(argv)
+    if len(argv) < 1:
+        print(f"使い方: python {sys.argv[0]} [server <port> | client <host> <port>] "
+              "[--backend sox|file|loopback|callback] [--input <file> --output <file>] [--transport tcp|udp] [--codec pcm|ulaw|adpcm] "
+              "[--metrics <file.jsonl|file.bin|udp://host:port>] [--dashboard] [--dsp-rate 16000] [--channels 2] [--record <dir>] [--asyncio]")
         return
 
-    mode = sys.argv[1]
-    amplitudes = []
-    timestamps = []
-
-    if mode == 'server':
-        port = int(sys.argv[2])
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind(('', port))
-            s.listen(1)
-            print(f"サーバー待機: ポート {port}")
-            conn, addr = s.accept()
-            print(f"クライアント接続: {addr}")
-            sender = threading.Thread(target=send_audio, args=(conn,), daemon=True)
-            receiver = threading.Thread(target=recv_audio, args=(conn, amplitudes, timestamps), daemon=True)
-            sender.start()
-            receiver.start()
-            receiver.join()
-            sender.join()
-
-    elif mode == 'client':
-        host, port = sys.argv[2], int(sys.argv[3])
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                s.connect((host, port))
-                print(f"接続成功: {host}:{port}")
-                sender = threading.Thread(target=send_audio, args=(s,), daemon=True)
-                receiver = threading.Thread(target=recv_audio, args=(s, amplitudes, timestamps), daemon=True)
-                sender.start()
-                receiver.start()
-                receiver.join()
-                sender.join()
-            except Exception as e:
-                print(f"接続エラー: {e}")
-                return
-    else:
-        print("モード指定エラー")
-        return
+    mode = argv[0]
+    dsp_rate = rate_options.dsp_rate or SAMPLE_RATE
+    channels = audio_options.channels
+    if dsp_rate != SAMPLE_RATE or channels != 1:
+        configure_dsp(dsp_rate, channels)
+    if dsp_rate != SAMPLE_RATE:
+        print(f"エコー除去と遅延推定は{dsp_rate}Hz(ブロック{echo_canceller.block_size}サンプル)で行います")
+    # 伝送路のレートは信号処理のレートで申し出る(フレームの時間はデバイス側と同じ)
+    frame_samples = wire_frame_samples(BUFFER_SIZE // 2, SAMPLE_RATE, dsp_rate)
+    recorder = AmplitudeRecorder()
+    metrics = open_metrics(metrics_options)
+    echo_canceller.metrics = metrics
+    # 計測値をファイルに出すときはコンソールに表示しない
+    echo_canceller.verbose = metrics is None
+
+    # 遅延推定は音声スレッドではなく解析ワーカーで実行する
+    analysis_worker = AnalysisWorker(echo_canceller.analyze, echo_canceller.analysis_request)
+    analysis_worker.start()
+
+    # 接続やハンドシェイクに失敗して途中で返るときも, 計測値を書き出して閉じる
+    session_recorder = None
+    try:
+        if mode == 'server':
+            port = int(argv[1])
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                s.bind(('', port))
+                s.listen(1)
+                print(f"サーバー待機: ポート {port}")
+                conn, addr = s.accept()
+                print(f"クライアント接続: {addr}")
+                session_recorder = run_call(conn, True, transport_options, frame_samples, dsp_rate, audio_options,
+                                            record_options, recorder, metrics)
+
+        elif mode == 'client':
+            host, port = argv[1], int(argv[2])
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect((host, port))
+                    print(f"接続成功: {host}:{port}")
+                    session_recorder = run_call(s, False, transport_options, frame_samples, dsp_rate, audio_options,
+                                                record_options, recorder, metrics)
+                except Exception as e:
+                    print(f"接続エラー: {e}")
+                    return
+        else:
+            print("モード指定エラー")
+            return
+    finally:
+        analysis_worker.stop()
+        if metrics is not None:
+            metrics.close()
+        if session_recorder is not None:
+            session_recorder.close()
 
     # メインスレッドでプロット
-    plot_wave(amplitudes, timestamps)
+    plot_wave(recorder)
 
 #amplitude_recodeのプロットの謎を理解
 if __name__ == '__main__':
@@ -0,0 +1,75 @@
+import numpy as np
+
+
+class GainStage:
+    """ゲインとソフトリミッタをまとめて適用する送信音量ステージ
+
+    16bit音声をnp.frombufferのビューとして読み, 事前確保した作業バッファ上で
+    ゲイン(ブロック内で前回値から直線的に補間)とソフトリミッタを適用し,
+    飽和演算で再利用する出力バッファに書き込む.
+    複数チャンネルはインターリーブのまま (サンプル数, channels) のビューとして扱い,
+    時刻ごとのゲインを全チャンネルにブロードキャストして1回の配列演算で処理する.
+    """
+
+    def __init__(self, volume=1.0, max_amplitude=20000, limiter_ratio=0.8, block_size=256, channels=1):
+        self.volume = volume                # ゲインに掛ける固定の音量
+        self.max_amplitude = max_amplitude  # 音量を掛ける前の振幅でこれを超えた分を圧縮する
+        self.limiter_ratio = limiter_ratio  # 超えた分に掛ける比率
+        self.channels = channels
+        self.previous_gain = None
+        self.ramp = np.zeros(0, dtype=np.float32)
+        self._allocate(block_size)
+
+    def _allocate(self, sample_count):
+        """作業バッファを確保する(より大きいブロックが来たときのみ. sample_count は1チャンネルあたり)"""
+        self.capacity = sample_count
+        self.gains = np.empty((sample_count, 1), dtype=np.float32)
+        self.work = np.empty((sample_count, self.channels), dtype=np.float32)
+        self.excess = np.empty((sample_count, self.channels), dtype=np.float32)
+        self.output = np.empty((sample_count, self.channels), dtype='<i2')
+
+    def process(self, audio_data, gain):
+        """音声データにゲインとリミッタを適用する
+
+        Args:
+            audio_data (bytes): 16bit signed integer形式の音声データ(複数チャンネルはインターリーブ)
+            gain (float): このブロックの目標ゲイン
+
+        Returns:
+            memoryview: 処理後の音声データ(次の呼び出しで上書きされる)
+        """
+        samples = np.frombuffer(audio_data, dtype='<i2', count=len(audio_data) // 2).reshape(-1, self.channels)
+        count = len(samples)
+        if count > self.capacity:
+            self._allocate(count)
+        if count != len(self.ramp):
+            # ブロック長が変わっても最後のサンプルで目標ゲインに到達するように作り直す
+            self.ramp = (np.arange(1, count + 1, dtype=np.float32) / count)[:, None]
+        if self.previous_gain is None:
+            self.previous_gain = gain
+
+        gains = self.gains[:count]
+        work = self.work[:count]
+        excess = self.excess[:count]
+        output = self.output[:count]
+
+        # ゲインを前回値から今回値へブロック内で滑らかに変化させる
+        start = self.previous_gain * self.volume
+        np.multiply(self.ramp, gain * self.volume - start, out=gains)
+        gains += start
+        np.multiply(samples, gains, out=work)
+        self.previous_gain = gain
+
+        # ソフトリミッタ: 音量を掛ける前の振幅でmax_amplitudeを超えた分だけlimiter_ratioで圧縮する
+        # (1/7のように絞った音量の後の振幅と比べるとリミッタが効かないので, しきい値の方に音量を掛ける)
+        np.abs(work, out=excess)
+        excess -= self.max_amplitude * abs(self.volume)
+        np.maximum(excess, 0, out=excess)
+        excess *= 1 - self.limiter_ratio
+        np.copysign(excess, work, out=excess)
+        work -= excess
+
+        # 16bitの範囲で飽和させて書き出す
+        np.clip(work, -32768, 32767, out=work)
+        np.copyto(output, work, casting='unsafe')
+        return memoryview(output).cast('B')
@@ -0,0 +1,215 @@
+import threading
+import time
+
+import numpy as np
+
+from clock_drift import DriftEstimator
+
+
+class JitterBuffer:
+    """受信フレームをシーケンス番号順に並べ直し, 一定のペースで再生に渡す適応ジッタバッファ
+
+    受信スレッドが put() でフレームを入れ, 再生スレッドが1フレーム周期ごとに get() で取り出す.
+    到着間隔の揺らぎ(RFC 3550のジッタ)から目標の深さを決め, 溜まりすぎたら
+    2フレームを1フレームにクロスフェードして縮め, 足りなければ補間フレームを挟んで伸ばす.
+
+    相手の録音と自分の再生のクロックのずれは, タイムスタンプから推定したドリフトと
+    平均の深さの目標とのずれから playout_ratio() で再生側のレート変換の比として返す.
+    再生側がその比で変換して取り出す速さを合わせれば, 深さは一定のままで間引きや挿入は起きない.
+    """
+
+    def __init__(self, frame_samples, sample_rate, min_delay_s=0.02, max_delay_s=0.2,
+                 jitter_factor=3.0, hysteresis_frames=2, depth_settle_s=30.0, max_correction_ppm=1000.0):
+        self.frame_samples = frame_samples
+        self.sample_rate = sample_rate
+        self.frame_duration = frame_samples / sample_rate
+        self.min_frames = max(1, round(min_delay_s / self.frame_duration))
+        self.max_frames = max(self.min_frames, round(max_delay_s / self.frame_duration))
+        self.jitter_factor = jitter_factor
+        self.hysteresis_frames = hysteresis_frames
+
+        self.lock = threading.Lock()
+        self.frames = {}             # 拡張シーケンス番号 → 16bit PCM
+        self.next_sequence = None    # 次に再生する拡張シーケンス番号
+        self.highest_sequence = None
+        self.last_arrival = None
+        self.last_timestamp = None
+        self.jitter = 0.0            # 到着ジッタ(秒)
+        self.last_played = np.zeros(frame_samples)
+        self.stretched = False       # 直前に伸ばすフレームを挟んだか
+        self.closed = False
+        self.fade = np.linspace(0.0, 1.0, frame_samples)
+
+        # クロックのずれ: 推定したドリフトと, 深さの目標とのずれを depth_settle_s 秒で戻す分
+        self.drift = DriftEstimator(sample_rate)
+        self.depth_settle_s = depth_settle_s
+        self.max_correction = max_correction_ppm * 1e-6
+        self.average_depth = None  # 再生のたびに平滑化した深さ(フレーム)
+
+        # 統計
+        self.received = 0
+        self.late = 0        # 再生済みの位置より後に届いて捨てたフレーム
+        self.duplicated = 0
+        self.lost = 0        # 再生時刻までに届かず補間したフレーム
+        self.dropped = 0     # 縮めるために捨てたフレーム
+        self.inserted = 0    # 伸ばすために挟んだフレーム
+        self.underruns = 0   # 空になって補間したフレーム
+
+    def _extend(self, sequence):
+        """16bitのシーケンス番号を, これまでの最大値に最も近い拡張番号に直す"""
+        if self.highest_sequence is None:
+            return sequence
+        delta = (sequence - self.highest_sequence) & 0xFFFF
+        if delta >= 0x8000:
+            delta -= 0x10000
+        return self.highest_sequence + delta
+
+    def put(self, frame, arrival=None):
+        """受信したMediaFrameを入れる"""
+        if arrival is None:
+            arrival = time.monotonic()
+        with self.lock:
+            self.received += 1
+            sequence = self._extend(frame.sequence)
+
+            # 到着間隔とタイムスタンプ間隔の差からジッタを更新する(RFC 3550)
+            if self.last_arrival is not None:
+                elapsed = ((frame.timestamp - self.last_timestamp + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+                difference = (arrival - self.last_arrival) - elapsed / self.sample_rate
+                self.jitter += (abs(difference) - self.jitter) / 16
+            self.last_arrival = arrival
+            self.last_timestamp = frame.timestamp
+            self.drift.observe(frame.timestamp, arrival)
+
+            if self.next_sequence is not None and sequence < self.next_sequence:
+                self.late += 1
+                return
+            if sequence in self.frames:
+                self.duplicated += 1
+                return
+            self.frames[sequence] = frame.payload
+            if self.highest_sequence is None or sequence > self.highest_sequence:
+                self.highest_sequence = sequence
+
+            # バースト到着などで上限の2倍を超えたら古いものから捨てる
+            while self.next_sequence is not None and self.depth() > 2 * self.max_frames:
+                if self.frames.pop(self.next_sequence, None) is not None:
+                    self.dropped += 1
+                self.next_sequence += 1
+
+    def depth(self):
+        """再生待ちのフレーム数(欠けている番号も含む)"""
+        if self.next_sequence is None or self.highest_sequence is None:
+            return len(self.frames)
+        return max(0, self.highest_sequence - self.next_sequence + 1)
+
+    def target_frames(self):
+        """ジッタから決めた目標の深さ(フレーム数)"""
+        frames = int(np.ceil(self.jitter_factor * self.jitter / self.frame_duration)) + 1
+        return min(max(frames, self.min_frames), self.max_frames)
+
+    def get(self):
+        """1フレーム分の再生データ(16bit PCMのbytes)を返す"""
+        with self.lock:
+            if self.next_sequence is None:
+                # 最初は目標の深さまで溜まるのを待つ(その間は無音)
+                if len(self.frames) < self.target_frames():
+                    return bytes(self.frame_samples * 2)
+                self.next_sequence = min(self.frames)
+
+            depth = self.depth()
+            target = self.target_frames()
+            current = self.frames.get(self.next_sequence)
+            if self.average_depth is None:
+                self.average_depth = float(depth)
+            self.average_depth += (depth - self.average_depth) / 64
+
+            if current is None:
+                # 届いていない: 後続があれば損失として飛ばし, なければ(枯渇)待つ
+                if depth > 0:
+                    self.lost += 1
+                    self.next_sequence += 1
+                else:
+                    self.underruns += 1
+                return self._conceal()
+
+            following = self.frames.get(self.next_sequence + 1)
+            if depth > target + self.hysteresis_frames and following is not None:
+                # 溜まりすぎ: 2フレームをクロスフェードして1フレームにする
+                del self.frames[self.next_sequence]
+                del self.frames[self.next_sequence + 1]
+                self.next_sequence += 2
+                self.dropped += 1
+                return self._output(self._samples(current) * (1 - self.fade) + self._samples(following) * self.fade)
+
+            if depth < target - self.hysteresis_frames and not self.stretched:
+                # 足りない: 直前の再生から次のフレームへつなぐフレームを挟む(次のフレームは消費しない)
+                # 続けて挟むと同じ音が繰り返されるので, 1フレームおきにする
+                self.inserted += 1
+                output = self._output(self.last_played * (1 - self.fade) + self._samples(current) * self.fade)
+                self.stretched = True
+                return output
+
+            del self.frames[self.next_sequence]
+            self.next_sequence += 1
+            if len(current) != 2 * self.frame_samples:
+                # 最後の短いフレームは無音で埋めて1フレームにする
+                return self._output(self._samples(current))
+            self.stretched = False
+            self.last_played = self._samples(current)
+            return current
+
+    def correction(self):
+        """取り出す速さを何割速めるか(相手のクロックのドリフト + 深さを目標に戻す分)
+
+        深さは到着と取り出しの位相で目標から1フレームほど揺れるので, それを超えた分だけ戻す.
+        """
+        if self.average_depth is None:
+            return 0.0
+        excess = self.average_depth - self.target_frames()
+        excess_s = np.sign(excess) * max(abs(excess) - 1, 0) * self.frame_duration
+        correction = self.drift.drift + excess_s / self.depth_settle_s
+        return float(np.clip(correction, -self.max_correction, self.max_correction))
+
+    def playout_ratio(self):
+        """再生側のレート変換の比(出力サンプル数 / 取り出したサンプル数)"""
+        return 1.0 / (1.0 + self.correction())
+
+    def _samples(self, payload):
+        """PCMをフレーム長の配列にする(最後の短いフレームは無音で埋める)"""
+        samples = np.zeros(self.frame_samples)
+        data = np.frombuffer(payload, dtype='<i2', count=min(len(payload) // 2, self.frame_samples))
+        samples[:len(data)] = data
+        return samples
+
+    def _output(self, samples):
+        self.last_played = samples
+        self.stretched = False
+        return np.clip(samples, -32768, 32767).astype('<i2').tobytes()
+
+    def _conceal(self):
+        """直前のフレームを半分ずつ減衰させながら繰り返して欠けたフレームを補う"""
+        samples = self.last_played * 0.5
+        self.last_played = samples
+        return np.clip(samples, -32768, 32767).astype('<i2').tobytes()
+
+    def close(self):
+        self.closed = True
+
+    def stats(self):
+        """現在の深さと損失の統計"""
+        with self.lock:
+            return {
+                'depth_ms': self.depth() * self.frame_duration * 1000,
+                'target_ms': self.target_frames() * self.frame_duration * 1000,
+                'jitter_ms': self.jitter * 1000,
+                'received': self.received,
+                'late': self.late,
+                'duplicated': self.duplicated,
+                'lost': self.lost,
+                'dropped': self.dropped,
+                'inserted': self.inserted,
+                'underruns': self.underruns,
+                'drift_ppm': self.drift.ppm,
+                'correction_ppm': self.correction() * 1e6,
+            }
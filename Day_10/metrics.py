@@ -0,0 +1,167 @@
+"""実行中の計測値(遅延推定, 相関, ゲイン, ダブルトーク, RMS, バッファの深さ)を機械で読める形で書き出す
+
+emit()は値をキューに積むだけで, ファイルやソケットへの書き込みは別スレッドでまとめて行う.
+出力先(--metrics)の拡張子で形式を選ぶ.
+- *.jsonl:      1行1レコードのJSON {"t": 時刻, "kind": 種類, 項目: 値, ...}
+- *.bin:        先頭に MAGIC と項目名のJSONを1行ずつ書き, 以降は固定長のレコード
+                (種類の番号 uint8 + 予約7バイト, 時刻 float64, 値 float64 x 最大項目数. 足りない項目はNaN)
+- udp://host:port: JSONLの行をデータグラムで送る
+--dashboard を付けると, 同じ計測値を dashboard.py のリアルタイム表示にも送る.
+読み込みは Preprocess/metrics_reader.py で行う.
+"""
+import argparse
+import collections
+import json
+import socket
+import struct
+import threading
+import time
+
+MAGIC = b'INTERNET_PHONE_METRICS 1\n'
+
+# 種類ごとの項目
+METRIC_FIELDS = {
+    'delay': ('delay_samples', 'delay_s', 'correlation', 'gain', 'confidence', 'raw_delay_samples',
+              'reference_ppm'),
+    'rms': ('rms',),
+    'jitter': ('depth_ms', 'target_ms', 'jitter_ms', 'received', 'late', 'lost', 'dropped', 'inserted', 'underruns',
+               'drift_ppm', 'correction_ppm'),
+    'double_talk': ('active', 'ratio', 'ncc', 'erle_db', 'skipped', 'far_silent'),
+}
+
+
+class MetricsWriter:
+    """計測値を別スレッドでまとめて書き出す"""
+
+    def __init__(self, destination, fields=METRIC_FIELDS, flush_interval=0.5):
+        self.fields = dict(fields)
+        self.kinds = list(self.fields)
+        self.width = max(len(names) for names in self.fields.values())
+        self.record = struct.Struct(f'<B7xd{self.width}d')
+        self.flush_interval = flush_interval
+        self.pending = collections.deque()
+        self.stopped = threading.Event()
+
+        self.sock = None
+        if destination.startswith('udp://'):
+            host, port = destination[len('udp://'):].rsplit(':', 1)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.address = (host, int(port))
+            self.binary = False
+        else:
+            self.binary = destination.endswith('.bin')
+            self.file = open(destination, 'wb')
+            if self.binary:
+                self.file.write(MAGIC)
+                self.file.write(json.dumps({'fields': self.fields}).encode() + b'\n')
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def emit(self, kind, *values):
+        """計測値を積む(音声スレッドから呼んでも書き込みを待たない). valuesはMETRIC_FIELDSの順"""
+        self.pending.append((kind, time.time(), values))
+
+    def emit_mapping(self, kind, mapping):
+        """辞書(JitterBuffer.stats()など)から項目名で値を取り出して積む"""
+        self.emit(kind, *(mapping[name] for name in self.fields[kind]))
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        records = []
+        while self.pending:
+            records.append(self.pending.popleft())
+        if not records:
+            return
+        if self.binary:
+            self.file.write(b''.join(self._pack(*record) for record in records))
+            self.file.flush()
+            return
+        lines = [self._format(*record) for record in records]
+        if self.sock is None:
+            self.file.write(b''.join(lines))
+            self.file.flush()
+            return
+        # データグラムが大きくなりすぎないよう, 行をまとめて小分けに送る
+        batch = b''
+        for line in lines:
+            if len(batch) + len(line) > 1400:
+                self._send(batch)
+                batch = b''
+            batch += line
+        self._send(batch)
+
+    def _pack(self, kind, timestamp, values):
+        padded = tuple(values) + (float('nan'),) * (self.width - len(values))
+        return self.record.pack(self.kinds.index(kind), timestamp, *padded)
+
+    def _format(self, kind, timestamp, values):
+        record = {'t': timestamp, 'kind': kind}
+        record.update(zip(self.fields[kind], values))
+        return json.dumps(record).encode() + b'\n'
+
+    def _send(self, data):
+        if not data:
+            return
+        try:
+            self.sock.sendto(data, self.address)
+        except OSError:
+            pass
+
+    def close(self):
+        """残りを書き出して閉じる"""
+        self.stopped.set()
+        self.thread.join()
+        if self.sock is not None:
+            self.sock.close()
+        else:
+            self.file.close()
+
+
+class MetricsTee:
+    """複数の出力先に同じ計測値を渡す"""
+
+    def __init__(self, writers):
+        self.writers = writers
+
+    def emit(self, kind, *values):
+        for writer in self.writers:
+            writer.emit(kind, *values)
+
+    def emit_mapping(self, kind, mapping):
+        for writer in self.writers:
+            writer.emit_mapping(kind, mapping)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def parse_metrics_options(argv):
+    """コマンドライン引数から計測値の出力先を取り出し, (残りの引数, オプション)を返す"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--metrics', help="計測値の出力先(*.jsonl, *.bin, udp://host:port)")
+    parser.add_argument('--dashboard', action='store_true', help="通話中にRMS, 遅延, 相関, ゲインを別プロセスの窓で表示する")
+    parser.add_argument('--dashboard-refresh', type=float, default=0.2, help="表示を更新する間隔(秒)")
+    options, rest = parser.parse_known_args(argv)
+    return rest, options
+
+
+def open_metrics(options):
+    """出力先が指定されていればMetricsWriterやLiveDashboardを作る(なければNone)"""
+    writers = []
+    if options.metrics:
+        writers.append(MetricsWriter(options.metrics))
+    if options.dashboard:
+        # matplotlibを読み込むのは表示のプロセスだけ
+        from dashboard import LiveDashboard
+        writers.append(LiveDashboard(refresh=options.dashboard_refresh))
+    if not writers:
+        return None
+    if len(writers) == 1:
+        return writers[0]
+    return MetricsTee(writers)
@@ -0,0 +1,163 @@
+"""NumPyのブロック単位で動くポリフェーズのサンプルレート変換
+
+通話の相手とデバイスのサンプルレートが違っても(44.1kHzと48kHzなど), ハンドシェイクで決めた
+伝送路のレートとの間で変換して音程がずれないようにする. e.pyではエコー除去と遅延推定を
+低いレート(--dsp-rate 16000)で動かすのにも使う.
+"""
+import argparse
+from math import gcd
+
+import numpy as np
+
+
+class PolyphaseResampler:
+    """input_rate から output_rate へのレート変換(ブロックをまたいで状態を保つ)
+
+    up倍に補間してdown分の1に間引くFIRを, 出力サンプルごとに使う係数の組(位相)に分けておき,
+    1ブロック分の出力をまとめて「入力の窓 x その位相の係数」の1回の配列演算で求める.
+    フィルタはカイザー窓をかけたsincで, 遮断周波数は低い方のレートのナイキスト周波数の cutoff 倍.
+    遅延は約 taps_per_phase/2 入力サンプル. レートが同じなら何もしない.
+    channels > 1 なら (サンプル数, channels) の配列を全チャンネル同じ係数でまとめて変換する.
+    """
+
+    def __init__(self, input_rate, output_rate, taps_per_phase=16, cutoff=0.9, beta=8.0, channels=1):
+        self.input_rate = input_rate
+        self.output_rate = output_rate
+        self.channels = channels
+        divisor = gcd(input_rate, output_rate)
+        self.up = output_rate // divisor
+        self.down = input_rate // divisor
+        self.passthrough = self.up == self.down
+
+        # 間引くときは間引く比の分だけフィルタを長くする
+        length = taps_per_phase * max(self.up, self.down)
+        self.taps = -(-length // self.up)  # 1位相あたりのタップ数
+        length = self.taps * self.up
+        n = np.arange(length) - (length - 1) / 2
+        fc = cutoff * 0.5 / max(self.up, self.down)
+        prototype = 2 * fc * np.sinc(2 * fc * n) * np.kaiser(length, beta)
+        prototype *= self.up / prototype.sum()
+        # phases[p, j]: 位相pの出力に窓のj番目(古い順)の入力を掛ける係数
+        self.phases = prototype.reshape(self.taps, self.up).T[:, ::-1].copy()
+
+        self.history = np.zeros((self.taps - 1,) + ((channels,) if channels > 1 else ()))
+        # 次の出力の位置(補間したレートで, 次のブロックの先頭から数える)
+        self.position = 0
+
+    def output_count(self, sample_count):
+        """sample_count サンプルを入れたときに出てくるサンプル数"""
+        if self.passthrough:
+            return sample_count
+        return max(0, -(-(sample_count * self.up - self.position) // self.down))
+
+    def process(self, samples):
+        """1ブロックを変換する. 出力の長さはブロックごとに揺れる(平均で入力 x up/down)"""
+        if self.passthrough:
+            return np.asarray(samples, dtype=np.float64)
+        count = len(samples)
+        buffer = np.concatenate((self.history, samples))
+        outputs = self.output_count(count)
+        positions = self.position + np.arange(outputs) * self.down
+        windows = np.lib.stride_tricks.sliding_window_view(buffer, self.taps, axis=0)
+        result = np.einsum('i...j,ij->i...', windows[positions // self.up], self.phases[positions % self.up])
+
+        self.position += outputs * self.down - count * self.up
+        self.history = buffer[len(buffer) - len(self.history):]
+        return result
+
+    def process_bytes(self, data):
+        """16bit PCM(複数チャンネルはインターリーブ)のbytesを変換する"""
+        if self.passthrough:
+            return data
+        samples = np.frombuffer(data, dtype='<i2', count=len(data) // 2)
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels)
+        result = np.rint(self.process(samples))
+        return np.clip(result, -32768, 32767).astype('<i2').tobytes()
+
+
+class FractionalResampler:
+    """変換比をブロックごとに少しずつ変えられる分数比のレート変換(クロックのずれの補正用)
+
+    ratio は 出力サンプル数 / 入力サンプル数 で, 1から数百ppmずれる程度を想定する.
+    出力の位置の端数を phases 段階に刻み, 段階ごとのカイザー窓sincの係数表から選ぶ.
+    フィルタの遅延(taps/2 入力サンプル)は差し引いてあるので, 出力の位置は入力の位置と揃う
+    (先読みの分, 変換を始めたブロックだけ taps/2 サンプル短くなる). ratio を変えても出力は途切れない.
+    ratio が1で出力の位置が整数なら, PolyphaseResampler と同じく変換せずに入力をそのまま返す.
+    """
+
+    def __init__(self, ratio=1.0, taps=16, phases=512, cutoff=0.95, beta=8.0):
+        self.ratio = ratio
+        self.taps = taps
+        self.phase_count = phases
+        # table[k, j]: 端数 k/phases の位置の出力に, 窓のj番目の入力を掛ける係数
+        offsets = np.arange(phases)[:, None] / phases + (taps // 2 - 1) - np.arange(taps)[None, :]
+        window = np.i0(beta * np.sqrt(np.clip(1 - (offsets / (taps / 2)) ** 2, 0, None))) / np.i0(beta)
+        table = cutoff * np.sinc(cutoff * offsets) * window
+        self.table = table / table.sum(axis=1, keepdims=True)
+
+        self.history = np.zeros(taps - 1)
+        # 次の出力の窓の先頭(入力のサンプル単位. history の先頭から数える).
+        # 窓の中心は先頭から taps/2 - 1 なので, 最初の出力が最初の入力になるよう taps/2 から始める
+        self.position = float(taps // 2)
+
+    def process(self, samples):
+        """1ブロックを今の ratio で変換する"""
+        buffer = np.concatenate((self.history, samples))
+        step = 1.0 / self.ratio
+        end = len(buffer) - self.taps + 1  # 窓の先頭はこれより前
+        outputs = max(0, int(np.ceil((end - self.position) / step)))
+        if self.ratio == 1.0 and self.position.is_integer():
+            # 次の出力の位置(窓の中心)から最後の入力までをそのまま出力し, 次のブロックの先頭から続ける
+            center = int(self.position) + self.taps // 2 - 1
+            self.position = float(self.taps // 2)
+            self.history = buffer[len(buffer) - len(self.history):]
+            return buffer[center:]
+        positions = self.position + np.arange(outputs) * step
+        starts = np.floor(positions).astype(np.int64)
+        phases = ((positions - starts) * self.phase_count).astype(np.int64)
+        windows = np.lib.stride_tricks.sliding_window_view(buffer, self.taps)
+        result = np.einsum('ij,ij->i', windows[starts], self.table[phases])
+
+        self.position += outputs * step - len(samples)
+        self.history = buffer[len(buffer) - len(self.history):]
+        return result
+
+    def process_bytes(self, data):
+        """16bit PCMのbytesを変換する"""
+        samples = np.frombuffer(data, dtype='<i2', count=len(data) // 2)
+        result = np.rint(self.process(samples))
+        return np.clip(result, -32768, 32767).astype('<i2').tobytes()
+
+
+class Reframer:
+    """長さの揃わない16bit PCMを frame_samples サンプル(各チャンネル)ずつのフレームに詰め直す"""
+
+    def __init__(self, frame_samples, channels=1):
+        self.frame_bytes = frame_samples * 2 * channels
+        self.pending = bytearray()
+
+    def push(self, data):
+        """データを足し, 揃ったフレームのリストを返す(余りは次に回す)"""
+        if not self.pending and len(data) == self.frame_bytes:
+            return [bytes(data)]
+        self.pending += data
+        count = len(self.pending) // self.frame_bytes * self.frame_bytes
+        frames = [bytes(self.pending[i:i + self.frame_bytes]) for i in range(0, count, self.frame_bytes)]
+        del self.pending[:count]
+        return frames
+
+
+def block_size_for(sample_rate, base_rate, base_block_size):
+    """base_rate での base_block_size と同じ時間以上になる2の累乗のブロック長"""
+    samples = base_block_size * sample_rate / base_rate
+    return 1 << max(0, int(np.ceil(np.log2(samples))))
+
+
+def parse_rate_options(argv):
+    """コマンドライン引数から信号処理のサンプルレートを取り出し, (残りの引数, オプション)を返す"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--dsp-rate', type=int, default=None,
+                        help="エコー除去と遅延推定のサンプルレート(省略時はデバイスと同じ)")
+    options, rest = parser.parse_known_args(argv)
+    return rest, options
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class RingBuffer:
+    """事前確保したNumPy配列による音声サンプルのリングバッファ
+
+    同じデータを前半と後半の2か所に書き込む(ミラーリング)ことで,
+    どの位置の窓もコピーなしの連続したビューとして読み出せる.
+    読み出したビューは以降の書き込みで上書きされるため,
+    別スレッドで長く使う場合はコピーすること.
+    """
+
+    def __init__(self, capacity, dtype=np.int16):
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.buffer = np.zeros(capacity * 2, dtype=self.dtype)
+        self.position = 0  # 次に書き込む位置
+        self.total = 0     # これまでに書き込んだ総サンプル数
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def write(self, data):
+        """サンプルを追加する(bytesの場合は16bit little endianとして解釈)"""
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = np.frombuffer(data, dtype='<i2')
+        capacity = self.capacity
+        position = self.position
+        written = count = len(data)
+        if count > capacity:
+            # 容量を超える分は捨て, 書き込み位置を通算位置と揃えておく
+            position = (position + count - capacity) % capacity
+            data = data[-capacity:]
+            count = capacity
+
+        first = min(count, capacity - position)
+        self.buffer[position:position + first] = data[:first]
+        self.buffer[position + capacity:position + capacity + first] = data[:first]
+        rest = count - first
+        if rest:
+            self.buffer[:rest] = data[first:]
+            self.buffer[capacity:capacity + rest] = data[first:]
+        self.position = (position + count) % capacity
+        # 書き込み完了後に総数を進める(別スレッドの読み手が未書き込み領域を見ないように)
+        self.total += written
+
+    def latest(self, count, offset=0):
+        """最新からoffsetサンプル前で終わるcountサンプルの窓をビューで返す"""
+        if count + offset > len(self):
+            raise ValueError("バッファに十分なサンプルがありません")
+        end = self.position + self.capacity - offset
+        return self.buffer[end - count:end]
+
+    def read(self, start, count):
+        """通算位置startからcountサンプルをビューで返す"""
+        if start < self.total - self.capacity or start + count > self.total:
+            raise ValueError("指定範囲はバッファに残っていません")
+        index = start % self.capacity
+        return self.buffer[index:index + count]
@@ -0,0 +1,233 @@
+"""通話の音声をそのまま残すセッションレコーダ(--record <ディレクトリ>)
+
+マイク(mic), 送信した音声(sent), 受信した音声(received), 再生した音声(played)を,
+ストリームごとに事前確保したメモリマップのファイルへ追記する.
+- <名前>.raw:   16bit PCM(複数チャンネルはインターリーブ). 最初に上限の大きさで確保する(疎なファイル)
+- <名前>.index: パケットごとの固定長の行(INDEX_DTYPE). 到着/書き込みの時刻, ストリーム上の位置と
+                サンプル数, メディアタイムスタンプ(受信はRTPのタイムスタンプ, ほかは通算位置), シーケンス番号
+- recording.json: ストリームごとのサンプルレートとチャンネル数. 閉じたときにサンプル数とパケット数を足し,
+                  ファイルを書いた分だけに切り詰める
+パケットごとの書き込みはマップ済みの領域へのコピーだけで, バッファを伸ばしたり作ったりしない.
+ストリームは1つのスレッドだけが書くので, ロックは使わない.
+
+open_session()はこれらをNumPyのmemmapとして開く(解析もコピーもしない). 閉じずに終わった録音は,
+索引から書けた分の長さを求めて開く. simulate.py --session で同じ入力のままエコーキャンセラを再生できる.
+"""
+import argparse
+import json
+import mmap
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+HEADER_NAME = 'recording.json'
+FORMAT = 'internet_phone_recording 1'
+INDEX_DTYPE = np.dtype([('wall_time', '<f8'), ('position', '<i8'), ('samples', '<i4'),
+                        ('media_timestamp', '<u4'), ('sequence', '<u2'), ('pad', 'V6')])
+# 索引の行数は, パケットが平均でこのサンプル数より短くならない前提で確保する
+MIN_PACKET_SAMPLES = 32
+
+# open_session()が返すストリーム. samples は (サンプル数,) か (サンプル数, channels) のmemmap
+Recording = namedtuple('Recording', ['samples', 'index', 'sample_rate', 'channels'])
+
+
+class RecordedStream:
+    """1つのストリームを事前確保したファイルに追記する"""
+
+    def __init__(self, directory, name, sample_rate, channels, max_duration_s):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_bytes = 2 * channels
+        capacity_frames = int(max_duration_s * sample_rate)
+        self.capacity = capacity_frames * self.frame_bytes
+
+        self.data_path = os.path.join(directory, f'{name}.raw')
+        self.index_path = os.path.join(directory, f'{name}.index')
+        with open(self.data_path, 'w+b') as f:
+            f.truncate(self.capacity)
+            self.data_map = mmap.mmap(f.fileno(), self.capacity)
+        self.data = memoryview(self.data_map)
+        self.index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='w+',
+                               shape=(capacity_frames // MIN_PACKET_SAMPLES + 1,))
+        # 行ごとの代入で構造体を作らないよう, 列のビューに書く
+        self.wall_times = self.index['wall_time']
+        self.positions = self.index['position']
+        self.sample_counts = self.index['samples']
+        self.media_timestamps = self.index['media_timestamp']
+        self.sequences = self.index['sequence']
+        # 最初のページへの書き込み(ファイルの割り当て)は通話の前に済ませておく
+        self.data[:1] = b'\x00'
+        self.sequences[0] = 0
+
+        self.end = 0      # 書いたバイト数
+        self.frames = 0   # 書いたサンプル数(1チャンネルあたり)
+        self.packets = 0
+        self.full = False
+        self.full_reported = False
+
+    def append(self, data, media_timestamp=None, sequence=0):
+        """1パケットを追記する. 上限に達したら以後は書かずにFalseを返す"""
+        size = len(data)
+        if self.full or self.end + size > self.capacity or self.packets >= len(self.index):
+            self.full = True
+            return False
+        self.data[self.end:self.end + size] = data
+        row = self.packets
+        self.wall_times[row] = time.time()
+        self.positions[row] = self.frames
+        self.sample_counts[row] = size // self.frame_bytes
+        self.media_timestamps[row] = (self.frames if media_timestamp is None else media_timestamp) & 0xFFFFFFFF
+        self.sequences[row] = sequence
+        self.end += size
+        self.frames += size // self.frame_bytes
+        self.packets += 1
+        return True
+
+    def close(self):
+        """マップを閉じ, ファイルを書いた分だけに切り詰める"""
+        self.data.release()
+        self.data_map.close()
+        self.index.flush()
+        # 索引のmemmapは参照がなくなると閉じる
+        del self.index, self.wall_times, self.positions, self.sample_counts, self.media_timestamps, self.sequences
+        os.truncate(self.data_path, self.end)
+        os.truncate(self.index_path, self.packets * INDEX_DTYPE.itemsize)
+
+
+class SessionRecorder:
+    """通話の各ストリームを directory に記録する"""
+
+    def __init__(self, directory, max_duration_s=3600.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_duration_s = max_duration_s
+        self.streams = {}
+        self.created = time.time()
+        self.closed = False
+
+    def add_stream(self, name, sample_rate, channels=1):
+        self.streams[name] = RecordedStream(self.directory, name, sample_rate, channels, self.max_duration_s)
+        self._write_header()
+
+    def append(self, name, data, media_timestamp=None, sequence=0):
+        """ストリーム name に1パケットを追記する(上限に達したら最初の1回だけ知らせる)"""
+        stream = self.streams[name]
+        if not stream.append(data, media_timestamp, sequence) and not stream.full_reported:
+            stream.full_reported = True
+            print(f"録音の上限({self.max_duration_s:g}秒)に達したので {name} の記録を止めます")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for stream in self.streams.values():
+            stream.close()
+        self._write_header()
+
+    def _write_header(self):
+        streams = {}
+        for name, stream in self.streams.items():
+            info = {'sample_rate': stream.sample_rate, 'channels': stream.channels}
+            if self.closed:
+                info.update(frames=stream.frames, packets=stream.packets)
+            streams[name] = info
+        header = {'format': FORMAT, 'created': self.created, 'index_dtype': INDEX_DTYPE.descr, 'streams': streams}
+        with open(os.path.join(self.directory, HEADER_NAME), 'w') as f:
+            json.dump(header, f, indent=1)
+
+
+def open_recorder(options, device_rate, capture_channels, channel):
+    """--record が指定されていれば, 4つのストリームを持つSessionRecorderを作る(なければNone)
+
+    mic と played はデバイスのレート, sent と received は伝送路のレートとチャンネル数で記録する.
+    """
+    if not options.record:
+        return None
+    recorder = SessionRecorder(options.record, options.record_max_duration)
+    recorder.add_stream('mic', device_rate, capture_channels)
+    recorder.add_stream('sent', channel.sample_rate, channel.channels)
+    recorder.add_stream('received', channel.sample_rate, channel.peer_channels)
+    recorder.add_stream('played', device_rate, 1)
+    print(f"通話の音声を {options.record} に記録します")
+    return recorder
+
+
+def is_recording(directory):
+    return os.path.exists(os.path.join(directory, HEADER_NAME))
+
+
+def open_session(directory):
+    """録音したセッションを {ストリーム名: Recording} として開く(読み取り専用のmemmap. コピーしない)"""
+    with open(os.path.join(directory, HEADER_NAME)) as f:
+        header = json.load(f)
+    if header.get('format') != FORMAT:
+        raise ValueError(f"{directory}: 録音の形式が違います: {header.get('format')!r}")
+
+    session = {}
+    for name, info in header['streams'].items():
+        channels = info['channels']
+        index_path = os.path.join(directory, f'{name}.index')
+        rows = os.path.getsize(index_path) // INDEX_DTYPE.itemsize
+        index = np.memmap(index_path, dtype=INDEX_DTYPE, mode='r', shape=(rows,)) if rows else np.zeros(0, INDEX_DTYPE)
+        packets = info.get('packets')
+        if packets is None:
+            # 閉じずに終わった録音: 索引の書けた行(サンプル数が0でない行)までを使う
+            packets = int(np.count_nonzero(index['samples']))
+        index = index[:packets]
+        frames = info.get('frames')
+        if frames is None:
+            frames = int(index['position'][-1] + index['samples'][-1]) if packets else 0
+        shape = (frames, channels) if channels > 1 else (frames,)
+        if frames:
+            samples = np.memmap(os.path.join(directory, f'{name}.raw'), dtype='<i2', mode='r', shape=shape)
+        else:
+            samples = np.zeros(shape, dtype='<i2')
+        session[name] = Recording(samples, index, info['sample_rate'], channels)
+    return session
+
+
+def stream_offset(reference, target):
+    """target の先頭と同じ時刻の, reference 上の位置(サンプル数)を索引の時刻から求める"""
+    if len(reference.index) == 0 or len(target.index) == 0:
+        return 0
+    # 時刻は各パケットを書き終えた時点なので, パケットの先頭の時刻に直してから比べる
+    start = lambda recording: (recording.index['wall_time'][0]
+                               - recording.index['samples'][0] / recording.sample_rate)
+    return int(round((start(target) - start(reference)) * reference.sample_rate))
+
+
+def parse_record_options(argv):
+    """コマンドライン引数から録音のオプションを取り出し, (残りの引数, オプション)を返す"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--record', metavar='DIR', help="マイク, 送信, 受信, 再生の音声を記録するディレクトリ")
+    parser.add_argument('--record-max-duration', type=float, default=3600.0,
+                        help="記録する長さの上限(秒). この分のファイルを最初に確保する")
+    options, rest = parser.parse_known_args(argv)
+    return rest, options
+
+
+def main():
+    import sys
+    if len(sys.argv) < 2:
+        print(f"使い方: python {sys.argv[0]} <録音のディレクトリ>")
+        return
+    session = open_session(sys.argv[1])
+    for name, recording in session.items():
+        index = recording.index
+        duration = len(recording.samples) / recording.sample_rate
+        print(f"[{name}] {recording.sample_rate}Hz {recording.channels}ch {duration:.2f}秒 パケット {len(index)}個")
+        if len(index) > 1:
+            intervals = np.diff(index['wall_time']) * 1000
+            print(f"  パケット間隔: 平均 {intervals.mean():.2f}ms 最大 {intervals.max():.2f}ms")
+            peak = np.abs(recording.samples).max()
+            print(f"  最大振幅: {peak}")
+    if 'mic' in session and 'played' in session:
+        offset = stream_offset(session['mic'], session['played'])
+        print(f"再生の開始はマイクの {offset}サンプル目")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+"""e.pyの処理系をファイル入力で実時間より速く回すオフラインシミュレーション
+
+使い方:
+    python simulate.py [--far far.wav] [--near near.wav] [--delay 0.12] [--rt60 0.2] ...
+
+遠端(受信)音声を合成した室内インパルス応答で畳み込んでエコーを作り,
+近端(話者)音声と足したものをマイク入力として, e.pyと同じ順序で処理する.
+--channels 2 以上ではマイクごとに少しずつ違うインパルス応答でマイクアレイを作り, まとめて処理する.
+ERLE, 遅延推定の誤差, ダブルトークと判定した割合, 1ブロックあたりの処理時間を表示する.
+
+    python simulate.py --session <録音のディレクトリ>
+
+e.py/d.py --record で記録した通話の 再生した音声 とマイク音声を, そのまま同じ処理系に通し直す.
+"""
+import argparse
+import json
+import os
+import time
+import wave
+
+import numpy as np
+
+import e
+from audio_io import deinterleave
+from gain_stage import GainStage
+from resampler import FractionalResampler, PolyphaseResampler, block_size_for
+from session_recorder import open_session, stream_offset
+
+# e.SAMPLE_RATE でのブロック長. 他のレートでは同じ時間以上の2の累乗にする(e.py --dsp-rate と同じ)
+BLOCK_SIZE = 256
+
+
+def load_audio(path, sample_rate):
+    """WAV(16bit)またはraw(16bit little endian mono)を読み込み, -1〜1のfloat配列で返す(WAVはsample_rateに変換する)"""
+    if path.lower().endswith('.wav'):
+        with wave.open(path, 'rb') as f:
+            if f.getsampwidth() != 2:
+                raise ValueError(f"{path}: 16bitのWAVのみ対応しています")
+            file_rate = f.getframerate()
+            channels = f.getnchannels()
+            samples = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+        # 複数チャンネルの場合は先頭のチャンネルだけを使う
+        samples = samples[::channels]
+        if file_rate != sample_rate:
+            samples = PolyphaseResampler(file_rate, sample_rate).process(samples)
+    else:
+        samples = np.fromfile(path, dtype='<i2')
+    return samples / 32768.0
+
+
+def save_audio(path, samples, sample_rate):
+    """-1〜1のfloat配列(複数チャンネルは (channels, サンプル数))を16bit WAVで保存する"""
+    samples = np.atleast_2d(samples)
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(len(samples))
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(to_pcm(samples.T))
+
+
+def save_session(path, far, results, sample_rate):
+    """シミュレーションの入力を sweep.py のセッション(far.wav, mic.wav, echo.wav, session.json)として保存する"""
+    os.makedirs(path, exist_ok=True)
+    save_audio(os.path.join(path, 'far.wav'), far[:results['mic'].shape[-1]], sample_rate)
+    save_audio(os.path.join(path, 'mic.wav'), results['mic'], sample_rate)
+    save_audio(os.path.join(path, 'echo.wav'), results['echo'], sample_rate)
+    with open(os.path.join(path, 'session.json'), 'w') as f:
+        json.dump({'sample_rate': sample_rate, 'delay_samples': results['true_delay']}, f)
+
+
+def to_pcm(samples):
+    """-1〜1のfloat配列を16bit PCMのbytesに変換する(範囲外は飽和)"""
+    return np.clip(samples * 32768.0, -32768, 32767).astype('<i2').tobytes()
+
+
+def synthetic_room_response(sample_rate, delay_s=0.05, rt60_s=0.2, echo_gain=0.5, drr_db=10.0, seed=0):
+    """直接音の遅延と指数減衰する残響からなる合成インパルス応答を作る
+
+    drr_dbは直接音と残響のエネルギー比.
+    """
+    rng = np.random.default_rng(seed)
+    delay = int(delay_s * sample_rate)
+    tail_length = int(rt60_s * sample_rate)
+    response = np.zeros(delay + tail_length + 1)
+    response[delay] = echo_gain
+    # RT60で60dB(振幅で1/1000)減衰する残響
+    t = np.arange(1, tail_length + 1) / sample_rate
+    tail = rng.standard_normal(tail_length) * np.exp(-6.9 * t / rt60_s)
+    tail *= echo_gain * 10 ** (-drr_db / 20) / np.sqrt(np.sum(tail ** 2))
+    response[delay + 1:] = tail
+    return response
+
+
+def synthetic_speech(duration_s, sample_rate, seed=0):
+    """話し声の代わりに使う, 有声/無声区間を持つ色付き雑音を作る"""
+    rng = np.random.default_rng(seed)
+    n = int(duration_s * sample_rate)
+    spectrum = np.fft.rfft(rng.standard_normal(n))
+    freqs = np.fft.rfftfreq(n, 1 / sample_rate)
+    # 低域寄りのスペクトルにして, 300Hz〜3.4kHz付近を強調する
+    spectrum /= np.maximum(freqs, 300) / 300
+    spectrum[freqs > 4000] *= 0.1
+    signal = np.fft.irfft(spectrum, n)
+    signal /= np.max(np.abs(signal)) + 1e-12
+
+    # 1.5秒話して0.5秒黙る
+    envelope = (np.arange(n) / sample_rate % 2.0) < 1.5
+    return signal * envelope * 0.3
+
+
+def convolve(signal, response):
+    """FFTによる線形畳み込み(長さはsignalに揃える)"""
+    n = len(signal) + len(response) - 1
+    fft_size = 2 ** int(np.ceil(np.log2(n)))
+    result = np.fft.irfft(np.fft.rfft(signal, fft_size) * np.fft.rfft(response, fft_size), fft_size)
+    return result[:len(signal)]
+
+
+def erle_db(echo, residual):
+    """エコー除去量(ERLE)をdBで返す"""
+    return 10 * np.log10((np.sum(echo ** 2) + 1e-12) / (np.sum(residual ** 2) + 1e-12))
+
+
+def process_streams(far_pcm, mic_pcm, sample_rate, block_size, channels=1, canceller_options=None,
+                    reference_lead=0, arrival_jitter=0, seed=0):
+    """16bit PCMの受信音声とマイク音声(インターリーブ)を, e.pyと同じ順序でブロックごとに処理する
+
+    far_pcm, mic_pcm は bytes のほか memoryview やNumPy配列(共有メモリ上のものなど)でもよく,
+    ブロックはコピーせずに切り出して渡す. 長さは短い方のブロックの倍数に切り詰める.
+    既定では受信とマイクを1ブロックずつ交互に入れる. 実際の通話では2つのスレッドが別々に動くので,
+    reference_lead ブロックだけ受信音声を先に入れ, arrival_jitter ブロックの範囲でマイクに対する
+    受信音声の届き方をランダムに揺らすと, エコーキャンセラの参照のFIFOに溜まる量が変わる場合を再現できる.
+
+    Returns:
+        dict: エコーキャンセラ, エコー除去後と送信の信号((channels, サンプル数), -1〜1),
+              ブロックごとと解析ごとの処理時間(秒), 公開された推定の(時刻, DelayEstimate)のリスト,
+              推定ごとの参照の対応のずれ(受信とマイクが同時に届いた場合より受信が何サンプル先にあるか.
+              推定の遅延は真の遅延にこれを足した値になる)
+    """
+    far_pcm = memoryview(far_pcm).cast('B')
+    mic_pcm = memoryview(mic_pcm).cast('B')
+    n = min(len(far_pcm) // 2, len(mic_pcm) // (2 * channels)) // block_size * block_size
+
+    options = dict(sample_rate=sample_rate, block_size=block_size, verbose=False, channels=channels)
+    options.update(canceller_options or {})
+    canceller = e.EchoCanceller(**options)
+    stage = GainStage(volume=e.OUTPUT_VOLUME, block_size=block_size, channels=channels)
+
+    cancelled = np.empty((channels, n))
+    sent = np.empty((channels, n))
+    block_times = []
+    analysis_times = []
+    estimates = []
+    reference_shifts = []
+    rng = np.random.default_rng(seed)
+    far_blocks = len(far_pcm) // (2 * block_size)
+    fed = 0  # 入れた受信音声のブロック数
+
+    for index, start in enumerate(range(0, n, block_size)):
+        mic_range = slice(start * 2 * channels, (start + block_size) * 2 * channels)
+        begin = time.perf_counter()
+        # 受信スレッド → 送信スレッドの順に処理する(受信はこのマイクのブロックまでに届いた分)
+        target = index + 1 + reference_lead
+        if arrival_jitter:
+            target += int(rng.integers(-arrival_jitter, arrival_jitter + 1))
+        while fed < min(target, far_blocks):
+            canceller.process_received_audio(far_pcm[fed * block_size * 2:(fed + 1) * block_size * 2])
+            fed += 1
+        cancelled_data, sent_data = e.process_captured_audio(mic_pcm[mic_range], canceller, stage)
+        block_times.append(time.perf_counter() - begin)
+
+        # 解析ワーカーの代わりに, 依頼があったらその場で実行する
+        if canceller.analysis_request.is_set():
+            canceller.analysis_request.clear()
+            begin = time.perf_counter()
+            previous = canceller.estimate
+            canceller.analyze()
+            analysis_times.append(time.perf_counter() - begin)
+            if canceller.estimate is not previous:
+                estimates.append((start / sample_rate, canceller.estimate))
+                reference_shifts.append(canceller.reference_offset + canceller.arrival_margin)
+
+        cancelled[:, start:start + block_size] = deinterleave(cancelled_data, channels) / 32768.0
+        sent[:, start:start + block_size] = deinterleave(sent_data, channels) / 32768.0
+
+    return {
+        'canceller': canceller,
+        'cancelled': cancelled,
+        'sent': sent,
+        'block_times': np.array(block_times),
+        'analysis_times': np.array(analysis_times),
+        'estimates': estimates,
+        'reference_shifts': np.array(reference_shifts, dtype=np.int64),
+    }
+
+
+def run_simulation(far, near, sample_rate, room_response, noise_level=1e-4,
+                   canceller_options=None, skip_s=1.0, seed=0, clock_drift_ppm=0.0,
+                   reference_lead=0, arrival_jitter=0):
+    """受信音声farと近端音声nearからマイク入力を合成し, e.pyと同じ処理系で処理する
+
+    room_response が (channels, 長さ) の配列ならマイクごとのインパルス応答として, 複数チャンネルで処理する.
+    clock_drift_ppm はマイクのクロックがスピーカーより速い割合で, エコーは再生音声をその分伸ばして作る.
+    reference_lead, arrival_jitter は受信音声をマイクとずらして入れるブロック数(process_streams).
+
+    Returns:
+        dict: ERLE, 遅延推定誤差, 処理時間などの結果
+    """
+    rng = np.random.default_rng(seed)
+    block_size = block_size_for(sample_rate, e.SAMPLE_RATE, BLOCK_SIZE)
+    n = min(len(far), len(near)) // block_size * block_size
+    far, near = far[:n], near[:n]
+    played = far
+    if clock_drift_ppm:
+        played = FractionalResampler(1 + clock_drift_ppm * 1e-6).process(np.concatenate((far, np.zeros(1024))))[:n]
+    responses = np.atleast_2d(room_response)
+    channels = len(responses)
+    echo = np.stack([convolve(played, response) for response in responses])
+    noise = rng.standard_normal((channels, n)) * noise_level
+    mic = near + echo + noise
+    true_delay = int(np.argmax(np.abs(responses[0])))
+
+    processed = process_streams(to_pcm(far), to_pcm(mic.T), sample_rate, block_size, channels, canceller_options,
+                                reference_lead, arrival_jitter, seed)
+    canceller = processed['canceller']
+    cancelled, sent = processed['cancelled'], processed['sent']
+    estimates = processed['estimates']
+    block_times, analysis_times = processed['block_times'], processed['analysis_times']
+
+    # エコー除去後の信号から近端音声と雑音を引いた残りが残留エコー
+    residual = cancelled - near - noise
+    skip = int(skip_s * sample_rate)
+    per_second = [erle_db(echo[:, i:i + sample_rate], residual[:, i:i + sample_rate])
+                  for i in range(0, n - sample_rate + 1, sample_rate)]
+    delay_errors = np.array([estimate.delay_samples for _, estimate in estimates]) - true_delay
+    delay_errors = delay_errors - processed['reference_shifts']
+
+    return {
+        'erle_db': erle_db(echo[:, skip:], residual[:, skip:]),
+        'erle_per_channel': np.array([erle_db(echo[c, skip:], residual[c, skip:]) for c in range(channels)]),
+        'erle_per_second': np.array(per_second),
+        'true_delay': true_delay,
+        'block_size': block_size,
+        'estimates': estimates,
+        'delay_errors': delay_errors,
+        'block_times': block_times,
+        'analysis_times': analysis_times,
+        'double_talk_ratio': canceller.double_talk.double_talk_blocks / max(canceller.double_talk.blocks, 1),
+        'far_silent_ratio': canceller.double_talk.far_silent_blocks / max(canceller.double_talk.blocks, 1),
+        'bulk_delay': canceller.bulk_delay,
+        'rejected_estimates': canceller.delay_state.rejected,
+        'clock_drift_ppm': canceller.echo_drift.ppm,
+        'realtime_factor': (block_times.sum() + analysis_times.sum()) / (n / sample_rate),
+        # モノラルなら1次元で返す
+        'mic': mic[0] if channels == 1 else mic,
+        'echo': echo[0] if channels == 1 else echo,
+        'cancelled': cancelled[0] if channels == 1 else cancelled,
+        'sent': sent[0] if channels == 1 else sent,
+    }
+
+
+def replay_session(path, canceller_options=None, skip_s=1.0):
+    """録音した通話の 再生した音声(played) とマイク音声(mic) を, 記録したレートのまま処理し直す
+
+    memmapからブロックを切り出して渡すので, 音声は読み込まずコピーもしない.
+    再生が始まる前のマイク音声は索引の時刻から求めた分だけ飛ばし, 2つの先頭を揃える.
+    エコーだけの信号はないので, ERLEは マイク音声/エコー除去後 のパワー比(近端の声も含むので低めに出る).
+    """
+    session = open_session(path)
+    mic, played = session['mic'], session['played']
+    if mic.sample_rate != played.sample_rate:
+        raise ValueError(f"{path}: マイク({mic.sample_rate}Hz)と再生({played.sample_rate}Hz)のレートが違います")
+    sample_rate, channels = mic.sample_rate, mic.channels
+    offset = stream_offset(mic, played)
+    mic_samples = mic.samples[max(offset, 0):]
+    played_samples = played.samples[max(-offset, 0):]
+
+    block_size = block_size_for(sample_rate, e.SAMPLE_RATE, BLOCK_SIZE)
+    processed = process_streams(played_samples, mic_samples, sample_rate, block_size, channels, canceller_options)
+    canceller = processed['canceller']
+    cancelled = processed['cancelled']
+    block_times, analysis_times = processed['block_times'], processed['analysis_times']
+    n = cancelled.shape[1]
+    captured = mic_samples[:n].reshape(n, channels).T / 32768.0
+
+    skip = int(skip_s * sample_rate)
+    per_second = [erle_db(captured[:, i:i + sample_rate], cancelled[:, i:i + sample_rate])
+                  for i in range(0, n - sample_rate + 1, sample_rate)]
+    return {
+        'erle_db': erle_db(captured[:, skip:], cancelled[:, skip:]),
+        'erle_per_channel': np.array([erle_db(captured[c, skip:], cancelled[c, skip:]) for c in range(channels)]),
+        'erle_per_second': np.array(per_second),
+        'sample_rate': sample_rate,
+        'offset': offset,
+        'block_size': block_size,
+        'estimates': processed['estimates'],
+        'block_times': block_times,
+        'analysis_times': analysis_times,
+        'double_talk_ratio': canceller.double_talk.double_talk_blocks / max(canceller.double_talk.blocks, 1),
+        'far_silent_ratio': canceller.double_talk.far_silent_blocks / max(canceller.double_talk.blocks, 1),
+        'bulk_delay': canceller.bulk_delay,
+        'rejected_estimates': canceller.delay_state.rejected,
+        'clock_drift_ppm': canceller.echo_drift.ppm,
+        'realtime_factor': (block_times.sum() + analysis_times.sum()) / (n / sample_rate),
+        'cancelled': cancelled[0] if channels == 1 else cancelled,
+        'sent': processed['sent'][0] if channels == 1 else processed['sent'],
+    }
+
+
+def print_replay_report(results):
+    """録音した通話を処理し直した結果を表示する"""
+    sample_rate = results['sample_rate']
+    print(f"再生の開始: マイクの {results['offset']}サンプル目 ({results['offset'] / sample_rate * 1000:.1f}ms)")
+    print(f"ERLE(マイク/エコー除去後): {results['erle_db']:.1f} dB")
+    if len(results['erle_per_channel']) > 1:
+        print("ERLE(チャンネルごと): " + " ".join(f"{v:.1f}" for v in results['erle_per_channel']))
+    print("ERLE(1秒ごと): " + " ".join(f"{v:.1f}" for v in results['erle_per_second']))
+    delays = [estimate.delay_samples for _, estimate in results['estimates']]
+    if delays:
+        print(f"遅延推定: {len(delays)}回, 中央値 {np.median(delays):.0f}サンプル "
+              f"({np.median(delays) / sample_rate * 1000:.2f}ms)")
+    else:
+        print("遅延推定: 推定結果なし")
+    print(f"参照の遅延: {results['bulk_delay']}サンプル, 捨てた推定 {results['rejected_estimates']}回, "
+          f"クロックのずれの補正 {results['clock_drift_ppm']:+.1f}ppm")
+    print(f"ダブルトーク判定: {results['double_talk_ratio'] * 100:.1f}% のブロック "
+          f"(遠端の無音: {results['far_silent_ratio'] * 100:.1f}%)")
+    print_timing(results, sample_rate)
+
+
+def print_report(results, sample_rate):
+    """シミュレーション結果を表示する"""
+    print(f"ERLE: {results['erle_db']:.1f} dB")
+    if len(results['erle_per_channel']) > 1:
+        print("ERLE(チャンネルごと): " + " ".join(f"{v:.1f}" for v in results['erle_per_channel']))
+    print("ERLE(1秒ごと): " + " ".join(f"{v:.1f}" for v in results['erle_per_second']))
+
+    errors = results['delay_errors']
+    if len(errors):
+        errors_ms = np.abs(errors) / sample_rate * 1000
+        print(f"遅延推定: 真値 {results['true_delay']}サンプル, 推定 {len(errors)}回, "
+              f"誤差 中央値 {np.median(errors_ms):.2f}ms 最大 {np.max(errors_ms):.2f}ms")
+    else:
+        print("遅延推定: 推定結果なし")
+    print(f"参照の遅延: {results['bulk_delay']}サンプル, 捨てた推定 {results['rejected_estimates']}回, "
+          f"クロックのずれの補正 {results['clock_drift_ppm']:+.1f}ppm")
+
+    print(f"ダブルトーク判定: {results['double_talk_ratio'] * 100:.1f}% のブロック "
+          f"(遠端の無音: {results['far_silent_ratio'] * 100:.1f}%)")
+    print_timing(results, sample_rate)
+
+
+def print_timing(results, sample_rate):
+    """1ブロックあたりと解析1回あたりの処理時間, 実時間比を表示する"""
+    block_ms = results['block_times'] * 1000
+    budget_ms = results['block_size'] / sample_rate * 1000
+    print(f"処理時間/ブロック: p50 {np.percentile(block_ms, 50):.3f}ms "
+          f"p99 {np.percentile(block_ms, 99):.3f}ms 最大 {np.max(block_ms):.3f}ms "
+          f"(予算 {budget_ms:.2f}ms)")
+    if len(results['analysis_times']):
+        print(f"解析時間/回: p50 {np.median(results['analysis_times']) * 1000:.3f}ms")
+    print(f"実時間比: {results['realtime_factor']:.3f} ({1 / results['realtime_factor']:.1f}倍速)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="エコーキャンセラのオフラインシミュレーション")
+    parser.add_argument('--far', help="遠端(受信)音声ファイル(WAVまたはraw). 省略時は合成音声")
+    parser.add_argument('--near', help="近端(話者)音声ファイル(WAVまたはraw). 省略時は無音")
+    parser.add_argument('--rate', type=int, default=48000, help="サンプルレート")
+    parser.add_argument('--duration', type=float, default=20.0, help="合成音声の長さ(秒)")
+    parser.add_argument('--delay', type=float, default=0.05, help="エコーの遅延(秒)")
+    parser.add_argument('--rt60', type=float, default=0.2, help="残響時間(秒)")
+    parser.add_argument('--echo-gain', type=float, default=0.5, help="エコーの大きさ")
+    parser.add_argument('--drr', type=float, default=10.0, help="直接音と残響のエネルギー比(dB)")
+    parser.add_argument('--noise', type=float, default=1e-4, help="マイク雑音の大きさ")
+    parser.add_argument('--channels', type=int, default=1, help="マイクのチャンネル数")
+    parser.add_argument('--clock-drift', type=float, default=0.0, help="マイクのクロックがスピーカーより速い割合(ppm)")
+    parser.add_argument('--reference-lead', type=int, default=0,
+                        help="受信音声をマイクより何ブロック先に入れるか(参照のFIFOに溜まる量)")
+    parser.add_argument('--arrival-jitter', type=int, default=0,
+                        help="受信音声の届き方をマイクに対して揺らすブロック数(0なら1ブロックずつ交互)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="送信音声をWAVで保存するパス")
+    parser.add_argument('--save-session', metavar='DIR',
+                        help="受信音声, マイク音声, エコーと真の遅延を sweep.py のセッションとして保存するディレクトリ")
+    parser.add_argument('--session', metavar='DIR',
+                        help="e.py/d.py --record で記録した通話を処理し直す(合成のオプションは使わない)")
+    args = parser.parse_args()
+
+    if args.session:
+        results = replay_session(args.session)
+        print_replay_report(results)
+        if args.output:
+            save_audio(args.output, results['sent'], results['sample_rate'])
+            print(f"送信音声を保存しました: {args.output}")
+        return
+
+    rate = args.rate
+    far = load_audio(args.far, rate) if args.far else synthetic_speech(args.duration, rate, args.seed)
+    near = load_audio(args.near, rate) if args.near else np.zeros(len(far))
+    if len(near) < len(far):
+        near = np.concatenate((near, np.zeros(len(far) - len(near))))
+
+    # マイクごとに, 直接音が約3cm(0.1ms)ずつ遅れて少しずつ小さく, 残響の細部が違うインパルス応答にする
+    responses = [synthetic_room_response(rate, args.delay + 1e-4 * c, args.rt60, args.echo_gain * (1 - 0.1 * c),
+                                         args.drr, args.seed + c)
+                 for c in range(args.channels)]
+    response = responses[0] if args.channels == 1 else np.stack(
+        [np.pad(r, (0, max(map(len, responses)) - len(r))) for r in responses])
+    results = run_simulation(far, near, rate, response, noise_level=args.noise, seed=args.seed,
+                             clock_drift_ppm=args.clock_drift, reference_lead=args.reference_lead,
+                             arrival_jitter=args.arrival_jitter)
+    print_report(results, rate)
+
+    if args.output:
+        save_audio(args.output, results['sent'], rate)
+        print(f"送信音声を保存しました: {args.output}")
+    if args.save_session:
+        save_session(args.save_session, far, results, rate)
+        print(f"セッションを保存しました: {args.save_session}")
+
+
+if __name__ == '__main__':
+    main()
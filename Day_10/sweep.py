@@ -0,0 +1,287 @@
+"""録音したセッションに対するエコーキャンセラのパラメータの総当たり評価
+
+使い方:
+    python sweep.py <セッションのディレクトリ> --grid grid.json [--workers 32] [--output results.csv]
+
+grid.json は EchoCanceller の引数名から候補のリストへの辞書で, 全部の組み合わせを試す.
+    {"delay_smoothing": [0.9, 0.95, 0.98], "num_partitions": [8, 16], "analysis_interval": [5, 10, 20]}
+
+セッションは far.wav(受信して再生した音声)と mic.wav(マイク音声)を持つディレクトリ
+(指定したディレクトリ自身か, その直下のディレクトリ). あれば次も使う.
+- echo.wav: マイク音声に含まれるエコーだけの信号. あればERLEを残留エコーから求め,
+  なければ マイク音声/エコー除去後 のパワー比(近端の声も含むので低めに出る)で代用する
+- session.json: {"delay_samples": 真のエコーの遅延} があれば遅延推定の誤差を出す
+simulate.py --save-session で合成したセッションを作れる.
+e.py/d.py --record で記録した通話のディレクトリもセッションとして使える(再生した音声を far, マイクの
+先頭のチャンネルを mic にし, 索引の時刻で先頭を揃える. echo.wav と真の遅延はない).
+
+(セッション x パラメータの組) ごとのジョブをプロセスプールで並列に処理する. 音声は最初に
+1つの共有メモリに16bit PCMで読み込み, 各ワーカーはそれをコピーせずに参照する.
+結果は組ごとに(ERLE, 遅延推定の誤差, 相関から求めたゲイン, 実時間比)の表にし, --output でジョブごとの行をCSVに保存する.
+実時間比は全コアが埋まった状態で測るので, 1通話だけのときより大きめに出る.
+"""
+import argparse
+import csv
+import inspect
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import e
+from resampler import PolyphaseResampler, block_size_for
+from session_recorder import is_recording, open_session, stream_offset
+from simulate import BLOCK_SIZE, erle_db, load_audio, process_streams
+
+STREAMS = ('far', 'mic', 'echo')
+# グリッドで変えられない引数(セッションと処理系で決まる)
+FIXED_OPTIONS = ('sample_rate', 'block_size', 'channels', 'verbose')
+
+# ワーカーごとの共有メモリとセッション(attach_sessionsで設定する)
+_memory = None
+_sessions = None
+_settings = None
+
+
+def find_sessions(path):
+    """far.wav と mic.wav を持つディレクトリか通話の録音(path自身か直下)を名前順に返す"""
+    def is_session(directory):
+        return (all(os.path.exists(os.path.join(directory, name)) for name in ('far.wav', 'mic.wav'))
+                or is_recording(directory))
+
+    if is_session(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if is_session(os.path.join(path, name)))
+
+
+def load_recording(path, sample_rate):
+    """通話の録音から far(再生した音声)と mic(マイクの先頭のチャンネル)を, 先頭を揃えて sample_rate で読み込む"""
+    session = open_session(path)
+    mic, played = session['mic'], session['played']
+    offset = stream_offset(mic, played)
+    samples = mic.samples if mic.channels == 1 else mic.samples[:, 0]
+    streams = {'far': played.samples[max(-offset, 0):], 'mic': samples[max(offset, 0):]}
+    for stream, recording in (('far', played), ('mic', mic)):
+        if recording.sample_rate != sample_rate:
+            streams[stream] = PolyphaseResampler(recording.sample_rate, sample_rate).process(streams[stream])
+        streams[stream] = streams[stream] / 32768.0
+    return streams
+
+
+def load_sessions(paths, sample_rate):
+    """セッションを読み込み, 全部の音声を1つの共有メモリに並べる
+
+    Returns:
+        tuple: (SharedMemory, セッションごとの 名前, 長さ, 各音声の共有メモリ上の位置, 真の遅延 の辞書のリスト)
+    """
+    loaded = []
+    for path in paths:
+        if is_recording(path):
+            loaded.append((path, load_recording(path, sample_rate), {}))
+            continue
+        streams = {}
+        for stream in STREAMS:
+            file = os.path.join(path, f'{stream}.wav')
+            if os.path.exists(file):
+                streams[stream] = load_audio(file, sample_rate)
+        info_path = os.path.join(path, 'session.json')
+        info = {}
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                info = json.load(f)
+        loaded.append((path, streams, info))
+
+    total = sum(len(samples) for _, streams, _ in loaded for samples in streams.values())
+    memory = shared_memory.SharedMemory(create=True, size=max(2 * total, 1))
+    pcm = np.ndarray(total, dtype='<i2', buffer=memory.buf)
+    layout = []
+    position = 0
+    for path, streams, info in loaded:
+        length = min(len(samples) for samples in streams.values())
+        offsets = {}
+        for stream, samples in streams.items():
+            pcm[position:position + length] = np.clip(samples[:length] * 32768.0, -32768, 32767)
+            offsets[stream] = position
+            position += length
+        delay = info.get('delay_samples')
+        if delay is not None and info.get('sample_rate', sample_rate) != sample_rate:
+            delay = round(delay * sample_rate / info['sample_rate'])
+        layout.append({'name': os.path.basename(os.path.normpath(path)), 'length': length,
+                       'offsets': offsets, 'delay_samples': delay})
+    del pcm
+    return memory, layout
+
+
+def attach_sessions(memory_name, layout, settings):
+    """ワーカーの初期化: 共有メモリにつなぎ, セッションごとの音声のビューを作る"""
+    global _memory, _sessions, _settings
+    _memory = shared_memory.SharedMemory(name=memory_name)
+    pcm = np.ndarray(_memory.size // 2, dtype='<i2', buffer=_memory.buf)
+    _sessions = []
+    for session in layout:
+        length = session['length']
+        views = {stream: pcm[offset:offset + length] for stream, offset in session['offsets'].items()}
+        _sessions.append(dict(session, **views))
+    _settings = settings
+
+
+def evaluate(session_index, config):
+    """1つのセッションを1組のパラメータで処理し, 結果の1行(辞書)を返す"""
+    session = _sessions[session_index]
+    sample_rate = _settings['sample_rate']
+    block_size = block_size_for(sample_rate, e.SAMPLE_RATE, BLOCK_SIZE)
+    begin = time.perf_counter()
+    processed = process_streams(session['far'], session['mic'], sample_rate, block_size,
+                                canceller_options=config)
+    elapsed = time.perf_counter() - begin
+
+    cancelled = processed['cancelled'][0]
+    n = len(cancelled)
+    skip = int(_settings['skip_s'] * sample_rate)
+    mic = session['mic'][:n] / 32768.0
+    if 'echo' in session:
+        # マイク音声からエコーを除いた残り(近端の声と雑音)を引くと残留エコーになる
+        echo = session['echo'][:n] / 32768.0
+        erle = erle_db(echo[skip:], cancelled[skip:] - (mic[skip:] - echo[skip:]))
+    else:
+        erle = erle_db(mic[skip:], cancelled[skip:])
+
+    estimates = processed['estimates']
+    final_delay = estimates[-1][1].delay_samples if estimates else None
+    delay_error_ms = None
+    true_delay = session['delay_samples']
+    if estimates and true_delay is not None:
+        errors = np.array([estimate.delay_samples for _, estimate in estimates]) - true_delay
+        errors = errors - processed['reference_shifts']
+        delay_error_ms = float(np.median(np.abs(errors)) / sample_rate * 1000)
+    # シグモイドで相関の強さから決めたゲイン(参考値. 送信音声には掛けない)の平均
+    mean_gain = float(np.mean([estimate.gain for _, estimate in estimates])) if estimates else None
+    busy = processed['block_times'].sum() + processed['analysis_times'].sum()
+
+    return dict(session=session['name'], **config, erle_db=float(erle), delay_error_ms=delay_error_ms,
+                final_delay=final_delay, estimates=len(estimates), mean_gain=mean_gain,
+                realtime_factor=float(busy / (n / sample_rate)), elapsed_s=elapsed)
+
+
+def make_configs(grid):
+    """グリッド(引数名 → 候補のリスト)の全部の組み合わせを辞書のリストにする"""
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def check_grid(grid):
+    """グリッドの引数名が EchoCanceller で変えられるものか確かめ, 問題があればメッセージを返す"""
+    if not isinstance(grid, dict) or not grid:
+        return "グリッドは 引数名 → 候補のリスト の辞書にしてください"
+    parameters = inspect.signature(e.EchoCanceller).parameters
+    for name, values in grid.items():
+        if name not in parameters or name in FIXED_OPTIONS:
+            return f"EchoCancellerのこの引数は変えられません: {name}"
+        if not isinstance(values, list) or not values:
+            return f"{name}の候補はリストにしてください"
+    return None
+
+
+def summarize(rows, names):
+    """パラメータの組ごとに, セッション全体の平均ERLE, 遅延誤差の中央値, 平均の送信ゲイン, 最大の実時間比をまとめる(ERLEの高い順)"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row[name] for name in names), []).append(row)
+    summary = []
+    for key, group in groups.items():
+        errors = [row['delay_error_ms'] for row in group if row['delay_error_ms'] is not None]
+        gains = [row['mean_gain'] for row in group if row['mean_gain'] is not None]
+        summary.append(dict(zip(names, key),
+                            erle_db=float(np.mean([row['erle_db'] for row in group])),
+                            min_erle_db=float(min(row['erle_db'] for row in group)),
+                            delay_error_ms=float(np.median(errors)) if errors else None,
+                            mean_gain=float(np.mean(gains)) if gains else None,
+                            realtime_factor=float(max(row['realtime_factor'] for row in group)),
+                            sessions=len(group)))
+    summary.sort(key=lambda row: row['erle_db'], reverse=True)
+    return summary
+
+
+def print_table(summary, names):
+    """まとめた結果を表にして表示する"""
+    columns = list(names) + ['erle_db', 'min_erle_db', 'delay_error_ms', 'mean_gain', 'realtime_factor', 'sessions']
+    cells = [[format_cell(row[column]) for column in columns] for row in summary]
+    widths = [max(len(column), *(len(row[i]) for row in cells)) for i, column in enumerate(columns)]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def format_cell(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+
+def write_csv(path, rows):
+    """ジョブごとの結果をCSVに保存する"""
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="録音したセッションに対するエコーキャンセラのパラメータの総当たり評価")
+    parser.add_argument('sessions', help="セッションのディレクトリ(またはセッションを並べたディレクトリ)")
+    parser.add_argument('--grid', required=True, help="EchoCancellerの引数名 → 候補のリスト のJSONファイル")
+    parser.add_argument('--rate', type=int, default=e.SAMPLE_RATE, help="処理するサンプルレート(音声は変換して読む)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="ワーカープロセスの数")
+    parser.add_argument('--skip', type=float, default=1.0, help="ERLEの計算から除く先頭の秒数")
+    parser.add_argument('--output', help="ジョブごとの結果を保存するCSVファイル")
+    args = parser.parse_args()
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+    problem = check_grid(grid)
+    if problem:
+        parser.error(problem)
+    paths = find_sessions(args.sessions)
+    if not paths:
+        parser.error(f"{args.sessions} に far.wav と mic.wav を持つセッションか通話の録音がありません")
+
+    configs = make_configs(grid)
+    names = sorted(grid)
+    jobs = [(index, config) for index in range(len(paths)) for config in configs]
+    print(f"セッション {len(paths)}件 x パラメータ {len(configs)}組 = {len(jobs)}ジョブを"
+          f"{args.workers}プロセスで実行します")
+
+    memory, layout = load_sessions(paths, args.rate)
+    settings = {'sample_rate': args.rate, 'skip_s': args.skip}
+    rows = []
+    begin = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(args.workers, initializer=attach_sessions,
+                                 initargs=(memory.name, layout, settings)) as executor:
+            futures = [executor.submit(evaluate, index, config) for index, config in jobs]
+            for done, future in enumerate(as_completed(futures), 1):
+                row = future.result()
+                rows.append(row)
+                print(f"[{done}/{len(jobs)}] {row['session']} "
+                      + " ".join(f"{name}={row[name]}" for name in names)
+                      + f" ERLE {row['erle_db']:.1f}dB")
+    finally:
+        memory.close()
+        memory.unlink()
+    print(f"経過時間: {time.perf_counter() - begin:.1f}秒")
+
+    print_table(summarize(rows, names), names)
+    if args.output:
+        rows.sort(key=lambda row: (row['session'], [row[name] for name in names]))
+        write_csv(args.output, rows)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Day_10のモジュールは平置きなので, テストからも `from codec import ...` の形で読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,87 @@
+import numpy as np
+
+from adaptive_filter import PartitionedBlockFilter
+from simulate import synthetic_speech
+
+
+def echo_path(block_size, num_partitions, seed=0):
+    """フィルタ長に収まる, 遅延と減衰のあるエコー経路"""
+    rng = np.random.default_rng(seed)
+    response = np.zeros(block_size * num_partitions)
+    response[300:300 + 200] = rng.standard_normal(200) * np.exp(-np.arange(200) / 40) * 0.3
+    return response
+
+
+def run(filter_, reference, captured):
+    block_size = filter_.block_size
+    blocks = len(reference) // block_size
+    output = np.empty((blocks, block_size) if captured.ndim == 1 else (blocks, len(captured), block_size))
+    for i in range(blocks):
+        span = slice(i * block_size, (i + 1) * block_size)
+        output[i] = filter_.process(reference[span], captured[..., span])
+    return output
+
+
+def erle_db(echo, residual):
+    return 10 * np.log10(np.sum(echo ** 2) / np.sum(residual ** 2))
+
+
+def test_converges_on_known_echo_path():
+    """既知のエコー経路のエコーを, 収束後は30dB以上消す"""
+    block_size, num_partitions = 128, 8
+    reference = np.random.default_rng(1).standard_normal(block_size * 400) * 0.1
+    echo = np.convolve(reference, echo_path(block_size, num_partitions))[:len(reference)]
+    filter_ = PartitionedBlockFilter(block_size, num_partitions)
+    residual = run(filter_, reference, echo).ravel()
+    tail = slice(len(reference) * 3 // 4, None)
+    assert erle_db(echo[tail], residual[tail]) > 30
+
+
+def test_channels_converge_independently():
+    block_size, num_partitions = 128, 8
+    reference = np.random.default_rng(2).standard_normal(block_size * 400) * 0.1
+    echoes = np.stack([np.convolve(reference, echo_path(block_size, num_partitions, seed))[:len(reference)]
+                       for seed in (3, 4)])
+    filter_ = PartitionedBlockFilter(block_size, num_partitions, channels=2)
+    residual = run(filter_, reference, echoes).transpose(1, 0, 2).reshape(2, -1)
+    tail = slice(len(reference) * 3 // 4, None)
+    for channel in range(2):
+        assert erle_db(echoes[channel, tail], residual[channel, tail]) > 30
+
+
+def test_no_adaptation_keeps_weights():
+    filter_ = PartitionedBlockFilter(64, 4)
+    filter_.adapt = False
+    reference = np.random.default_rng(5).standard_normal(64)
+    filter_.process(reference, reference)
+    assert not filter_.weights.any()
+
+
+def test_early_steps_do_not_diverge_on_coloured_input():
+    """話の途中から学習を始めても(通話中のリセット), 色付きの参照で最初の1秒にエコーを増やさない"""
+    block_size, num_partitions, sample_rate = 128, 16, 16000
+    far = synthetic_speech(4.0, sample_rate)
+    echo = np.convolve(far, echo_path(block_size, num_partitions))[:len(far)]
+    for start in (4000, 8000, 16000):
+        span = slice(start, start + sample_rate)
+        filter_ = PartitionedBlockFilter(block_size, num_partitions)
+        residual = run(filter_, far[span], echo[span]).ravel()
+        assert erle_db(echo[span], residual) >= 0
+
+
+def test_relearning_before_a_pause_keeps_reference_power():
+    """参照をずらして学習し直した直後に遠端が黙っても, パワーの推定を残せば再開時にエコーを増やさない"""
+    block_size, num_partitions, sample_rate = 128, 16, 16000
+    far = synthetic_speech(4.0, sample_rate)
+    echo = np.convolve(far, echo_path(block_size, num_partitions))[:len(far)]
+    # synthetic_speech は1.5秒話して0.5秒黙るので, 黙る直前で学習し直す
+    split = int(1.5 * sample_rate) // block_size * block_size
+    filter_ = PartitionedBlockFilter(block_size, num_partitions)
+    run(filter_, far[:split], echo[:split])
+    power = filter_.power.copy()
+    filter_.reset(keep_power=True)
+    assert not filter_.weights.any()
+    np.testing.assert_array_equal(filter_.power, power)
+    span = slice(split, split + sample_rate)
+    residual = run(filter_, far[span], echo[span]).ravel()
+    assert erle_db(echo[span], residual) >= 0
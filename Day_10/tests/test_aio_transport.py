@@ -0,0 +1,54 @@
+import argparse
+import asyncio
+
+import numpy as np
+import pytest
+
+import aio_transport
+
+FRAME = 256
+
+
+async def handshake(transport, codec):
+    """ループバックでサーバーとクライアントのハンドシェイクをし, (サーバーのチャネル, クライアントのチャネル)を返す"""
+    accepted = asyncio.get_running_loop().create_future()
+
+    async def on_connect(reader, writer):
+        accepted.set_result(await aio_transport.open_channel(reader, writer, True, None, FRAME, 48000))
+
+    server = await asyncio.start_server(on_connect, '127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+    options = argparse.Namespace(transport=transport, codec=codec)
+    client = await aio_transport.open_channel(reader, writer, False, options, FRAME // 3, 16000)
+    channel = await asyncio.wait_for(accepted, 5)
+    server.close()
+    return channel, client
+
+
+@pytest.mark.parametrize('transport', ['tcp', 'udp'])
+def test_handshake_and_frames(transport):
+    async def call():
+        server, client = await handshake(transport, 'ulaw')
+        try:
+            # サーバーは自分のレートとフレーム長に固定し, クライアントが合わせる
+            assert (client.sample_rate, client.frame_samples) == (48000, FRAME)
+            data = (np.arange(FRAME) * 100).astype('<i2').tobytes()
+            await client.send(data)
+            frame = await asyncio.wait_for(server.recv(), 5)
+            np.testing.assert_allclose(np.frombuffer(frame.payload, '<i2'), np.frombuffer(data, '<i2'), atol=800)
+            await server.send(bytes(FRAME * 2))
+            frame = await asyncio.wait_for(client.recv(), 5)
+            assert len(frame.payload) == FRAME * 2
+        finally:
+            client.close()
+            server.close()
+    asyncio.run(call())
+
+
+def test_udp_recv_ends_on_peer_bye():
+    async def call():
+        server, client = await handshake('udp', 'pcm')
+        client.close()
+        assert await asyncio.wait_for(server.recv(), 2) is None
+        server.close()
+    asyncio.run(call())
@@ -0,0 +1,57 @@
+import numpy as np
+
+from amplitude_recorder import AmplitudeRecorder
+
+
+def packet(value, samples=160):
+    return np.full(samples, value, dtype='<i2').tobytes()
+
+
+def test_rms_of_packet():
+    recorder = AmplitudeRecorder()
+    samples = np.array([3, -4] * 80, dtype='<i2')
+    assert np.isclose(recorder.record(samples.tobytes(), 0.0), np.sqrt(12.5))
+    assert recorder.record(b'', 0.02) == 0.0
+
+
+def test_short_call_keeps_every_packet():
+    recorder = AmplitudeRecorder(capacity=64, factor=4, levels=3)
+    for i in range(50):
+        recorder.record(packet(i), i * 0.02)
+    times, lows, highs, means = recorder.series()
+    # 段0に全パケットが残っているので, そのまま返す
+    np.testing.assert_allclose(times, np.arange(50) * 0.02)
+    np.testing.assert_allclose(means, np.arange(50))
+
+
+def test_long_call_covers_whole_call_in_bounded_memory():
+    recorder = AmplitudeRecorder(capacity=64, factor=4, levels=3)
+    sizes = [history.nbytes for history in recorder.history]
+    values = np.arange(1000) % 100
+    values[37] = 3000
+    for i, value in enumerate(values):
+        recorder.record(packet(value), i * 0.02)
+    assert [history.nbytes for history in recorder.history] == sizes
+
+    times, lows, highs, means = recorder.series()
+    # 段0は折り返したので, 通話の始めから残っている粗い段を使う
+    assert times[0] == 0.0
+    assert np.all(np.diff(times) > 0)
+    assert highs.max() == 3000 and lows.min() == 0
+    # 集計中のバケットも個数で重みをつけて足すので, 全体の平均と一致する
+    counts = np.diff(np.append(np.searchsorted(np.arange(1000) * 0.02, times), 1000))
+    assert np.isclose(np.dot(means, counts) / counts.sum(), recorder.mean())
+    assert np.isclose(recorder.mean(), values.mean())
+
+
+def test_series_is_decimated_keeping_extremes():
+    recorder = AmplitudeRecorder(capacity=4096)
+    values = np.zeros(3001)
+    values[1234] = 500
+    values[3000] = 700
+    for i, value in enumerate(values):
+        recorder.record(packet(value), float(i))
+    times, lows, highs, means = recorder.series(max_points=100)
+    assert len(times) <= 100
+    # 最大値と, 最後の半端なグループの値も残る
+    assert 500 in highs and highs[-1] == 700
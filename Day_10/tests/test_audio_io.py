@@ -0,0 +1,75 @@
+import threading
+
+import numpy as np
+import pytest
+
+import audio_io
+from audio_io import CallbackSink, CallbackSource, Loopback
+
+
+class FakeStream:
+    """sounddeviceのRawInputStream/RawOutputStreamの代わり(コールバックをテストから呼ぶ)"""
+
+    def __init__(self, samplerate, blocksize, channels, dtype, latency, callback):
+        self.callback = callback
+        self.active = False
+
+    def start(self):
+        self.active = True
+
+    def stop(self):
+        self.active = False
+
+    def close(self):
+        pass
+
+
+class FakeSounddevice:
+    RawInputStream = FakeStream
+    RawOutputStream = FakeStream
+
+
+@pytest.fixture
+def sounddevice(monkeypatch):
+    monkeypatch.setattr(audio_io, 'import_sounddevice', lambda: FakeSounddevice)
+
+
+def test_callback_source_joins_blocks(sounddevice):
+    source = CallbackSource(16000, block_size=4)
+    for value in range(3):
+        source.stream.callback(np.full(4, value, dtype='<i2').tobytes(), 4, None, None)
+    assert np.frombuffer(source.read(10), '<i2').tolist() == [0, 0, 0, 0, 1]
+    assert np.frombuffer(source.read(14), '<i2').tolist() == [1, 1, 1, 2, 2, 2, 2]
+    source.close()
+
+
+def test_callback_source_read_returns_after_close(sounddevice):
+    source = CallbackSource(16000, block_size=4, max_blocks=1, poll_s=0.01)
+    # キューが満杯で終わりの印が入らなくても, 待っている read() は閉じたら返る
+    source.stream.callback(bytes(8), 4, None, None)
+    result = []
+    reader = threading.Thread(target=lambda: result.append(source.read(64)))
+    reader.start()
+    source.close()
+    reader.join(timeout=1.0)
+    assert not reader.is_alive()
+    assert result == [b'']
+
+
+def test_callback_sink_drops_oldest_beyond_bound(sounddevice):
+    sink = CallbackSink(16000, block_size=4, channels=2, max_blocks=2)
+    for value in range(5):
+        sink.write(np.full(8, value, dtype='<i2').tobytes())
+    assert len(sink.pending) == sink.max_pending == 32
+    out = bytearray(32)
+    sink.stream.callback(out, 4, None, None)
+    assert np.frombuffer(bytes(out), '<i2').tolist() == [3] * 8 + [4] * 8
+    sink.close()
+
+
+def test_loopback_returns_delayed_echo():
+    loopback = Loopback(48000, delay_s=0.001, gain=0.5)
+    loopback.sink.write(np.full(96, 1000, dtype='<i2').tobytes())
+    echoed = np.frombuffer(loopback.source.read(2 * 144), '<i2')
+    assert not echoed[:48].any()
+    assert (echoed[48:] == 500).all()
@@ -0,0 +1,61 @@
+import numpy as np
+
+from clock_drift import DriftEstimator, EchoDriftTracker
+
+SAMPLE_RATE = 48000
+FRAME = 960
+
+
+def observe_call(estimator, drift_ppm, duration_s, start_timestamp=0, jitter_s=0.005, seed=0):
+    """相手の録音クロックが drift_ppm だけ速い通話のフレームを, ネットワークの揺らぎ付きで入れる"""
+    rng = np.random.default_rng(seed)
+    for n in range(int(duration_s * SAMPLE_RATE / FRAME)):
+        arrival = n * FRAME / (SAMPLE_RATE * (1 + drift_ppm * 1e-6)) + rng.uniform(0, jitter_s)
+        estimator.observe((start_timestamp + n * FRAME) & 0xFFFFFFFF, 1000.0 + arrival)
+
+
+def test_drift_estimated_from_timestamps():
+    estimator = DriftEstimator(SAMPLE_RATE)
+    observe_call(estimator, 100, 20)
+    # 観測が min_span_s 秒分たまるまでは補正しない
+    assert estimator.ppm == 0
+    estimator = DriftEstimator(SAMPLE_RATE)
+    observe_call(estimator, 100, 180)
+    assert abs(estimator.ppm - 100) < 10
+
+
+def test_timestamp_wraparound_and_slow_sender():
+    estimator = DriftEstimator(SAMPLE_RATE)
+    # 通話の途中でタイムスタンプが32bitを折り返す
+    observe_call(estimator, -50, 180, start_timestamp=0xFFFFFFFF - SAMPLE_RATE * 60)
+    assert abs(estimator.ppm + 50) < 10
+
+
+def test_drift_limited_to_max_ppm():
+    estimator = DriftEstimator(SAMPLE_RATE, max_ppm=200)
+    observe_call(estimator, 2000, 180)
+    assert np.isclose(estimator.ppm, 200)
+
+
+def test_echo_delay_slope_sets_reference_ratio():
+    """補正した参照で測った遅延の傾きを比に掛けていくと, マイクとスピーカーのずれに落ち着く"""
+    tracker = EchoDriftTracker(SAMPLE_RATE, window_s=10.0)
+    rng = np.random.default_rng(1)
+    step = SAMPLE_RATE // 2
+    delay = 2400.0
+    # マイクのクロックがスピーカーより 80ppm 速いので, 補正しきれない分だけ遅延が増える
+    for position in range(0, SAMPLE_RATE * 120, step):
+        delay += (80 - tracker.ppm) * 1e-6 * step
+        tracker.update(position, delay + rng.normal(0, 0.5), 1.0)
+    assert tracker.corrections >= 5
+    assert abs(tracker.ppm - 80) < 10
+
+
+def test_echo_path_jump_discards_window():
+    tracker = EchoDriftTracker(SAMPLE_RATE, window_s=10.0)
+    for position in range(0, SAMPLE_RATE * 8, SAMPLE_RATE // 2):
+        tracker.update(position, 2400 + 1e-3 * position, 1.0)
+    # エコー経路が変わって遅延が跳んだら, それまでの傾きを使わない
+    for position in range(SAMPLE_RATE * 8, SAMPLE_RATE * 12, SAMPLE_RATE // 2):
+        assert not tracker.update(position, 6000, 1.0)
+    assert tracker.ratio == 1.0 and tracker.corrections == 0
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from codec import CODECS, adpcm_decode, adpcm_encode, get_codec, ulaw_decode, ulaw_encode
+
+
+def speech_like(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.clip(np.cumsum(rng.standard_normal(count)) * 300, -32768, 32767).astype('<i2')
+
+
+@pytest.mark.parametrize('name', CODECS)
+@pytest.mark.parametrize('channels', [1, 2])
+@pytest.mark.parametrize('frames', [1, 235, 256])
+def test_round_trip_keeps_length(name, channels, frames):
+    """符号化して復号すると, 奇数のフレーム長でも同じサンプル数に戻る"""
+    encoder, decoder = get_codec(name, channels), get_codec(name, channels)
+    data = speech_like(frames * channels).tobytes()
+    payload = encoder.encode(data)
+    assert len(payload) == encoder.encoded_size(frames * channels)
+    assert len(decoder.decode(payload)) == len(data)
+
+
+def test_ulaw_error_is_relative():
+    samples = speech_like(4096)
+    decoded = ulaw_decode(ulaw_encode(samples)).astype(np.int32)
+    error = np.abs(decoded - samples)
+    # μ-lawの量子化誤差は振幅のおよそ1/32以内
+    assert np.all(error <= np.abs(samples.astype(np.int32)) / 16 + 8)
+
+
+def test_adpcm_tracks_signal_across_packets():
+    """パケットをまたいで予測値を引き継ぎ, 復号側はヘッダから同じ状態で復号する"""
+    encoder, decoder = get_codec('adpcm'), get_codec('adpcm')
+    samples = speech_like(256 * 8)
+    decoded = np.concatenate([np.frombuffer(decoder.decode(encoder.encode(samples[i:i + 256].tobytes())), '<i2')
+                              for i in range(0, len(samples), 256)])
+    snr = 10 * np.log10(np.sum(samples.astype(float) ** 2) / np.sum((decoded - samples.astype(float)) ** 2))
+    assert snr > 20
+
+
+def test_adpcm_decode_matches_encoder_state():
+    """復号は符号化側が追っている予測値と量子化幅の番号に一致する(16bitの範囲で張り付く信号でも)"""
+    samples = np.tile(np.r_[np.full(200, 32767), np.full(200, -32768), np.zeros(100)].astype(np.int16), 4)
+    codes, predictor, index = adpcm_encode(samples, 0, 0)
+    decoded = adpcm_decode(codes, 0, 0)
+    assert decoded[-1] == predictor
+    assert decoded.min() >= -32768 and decoded.max() <= 32767
+    assert adpcm_decode(codes[:0]).size == 0
@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from codec import get_codec
+from conference import FRAME_SAMPLES, ConferenceMixer, SharedLimiter
+
+
+def participant(value):
+    """ジッタバッファから一定値のフレームを返す参加者の代わり"""
+    frame = np.full(FRAME_SAMPLES, value, dtype='<i2').tobytes()
+    return SimpleNamespace(jitter_buffer=SimpleNamespace(get=lambda: frame),
+                           channel=SimpleNamespace(encoder=get_codec('pcm')))
+
+
+def test_mix_minus_excludes_own_voice():
+    mixer = ConferenceMixer(48000, max_participants=4, executor=None)
+    payloads = mixer.mix([participant(value) for value in (100, 200, 300)])
+    mixes = [np.frombuffer(payload, '<i2') for payload in payloads]
+    for mix, expected in zip(mixes, (500, 400, 300)):
+        assert (mix == expected).all()
+
+
+def test_shared_limiter_keeps_mix_in_range():
+    limiter = SharedLimiter(FRAME_SAMPLES, threshold=20000)
+    mixes = np.full((2, FRAME_SAMPLES), 30000, dtype=np.float32)
+    limiter.process(mixes)
+    # ゲインはフレーム内で補間して下げるので, フレームの終わりにはしきい値まで下がっている
+    assert np.abs(mixes).max() <= 32767
+    assert limiter.gain == 20000 / 30000
+    assert (mixes[:, -1] < 20100).all()
+    # 戻すときはゆっくり戻す
+    quiet = np.full((2, FRAME_SAMPLES), 100, dtype=np.float32)
+    limiter.process(quiet)
+    assert limiter.gain < 0.7
@@ -0,0 +1,50 @@
+import numpy as np
+
+from dashboard import SharedRing
+
+
+class WriteDuringCopy:
+    """行を写している途中で書き込み側が進む様子を再現する"""
+
+    def __init__(self, ring, rows, writes):
+        self.ring = ring
+        self.rows = rows
+        self.writes = writes
+
+    def __getitem__(self, key):
+        if isinstance(key, np.ndarray) and self.writes:
+            head = self.rows[key[:1]]
+            writes, self.writes = self.writes, []
+            for timestamp in writes:
+                self.ring.write(timestamp, [timestamp])
+            return np.concatenate([head, self.rows[key[1:]]])
+        return self.rows[key]
+
+
+def test_read_returns_rows_in_order():
+    ring = SharedRing(width=2, capacity=8)
+    try:
+        for i in range(20):
+            ring.write(float(i), [i, -i])
+        times, values = ring.read()
+        # 上書き中かもしれない最古の1行は読まない
+        np.testing.assert_array_equal(times, np.arange(13, 20))
+        np.testing.assert_array_equal(values[:, 1], -np.arange(13, 20))
+    finally:
+        ring.close()
+
+
+def test_read_retries_when_writer_overtakes_copy():
+    ring = SharedRing(width=1, capacity=4)
+    rows = ring.rows
+    try:
+        for i in range(3):
+            ring.write(float(i), [i])
+        ring.rows = WriteDuringCopy(ring, rows, [3.0, 4.0, 5.0])
+        times, values = ring.read()
+        # 写している間に置き換わった行が混ざらず, 読み直した最新の行を返す
+        np.testing.assert_array_equal(times, [3, 4, 5])
+        np.testing.assert_array_equal(values[:, 0], [3, 4, 5])
+    finally:
+        ring.rows = rows
+        ring.close()
@@ -0,0 +1,53 @@
+import numpy as np
+
+from delay_estimator import CoarseToFineDelayTracker, GccPhatDelayTracker
+
+
+def test_gcc_phat_finds_delay():
+    block_size, delay = 128, 700
+    rng = np.random.default_rng(0)
+    reference = rng.standard_normal(block_size * 120)
+    captured = np.concatenate((np.zeros(delay), reference[:-delay])) * 0.5 + rng.standard_normal(len(reference)) * 0.01
+    tracker = GccPhatDelayTracker(block_size=block_size, max_delay_samples=2048)
+    tracker.update(reference, captured)
+    estimated, strength, confidence = tracker.estimate()
+    assert estimated == delay
+    assert confidence > 0.5
+
+
+def test_no_estimate_before_enough_reference():
+    tracker = GccPhatDelayTracker(block_size=128, max_delay_samples=2048)
+    block = np.random.default_rng(1).standard_normal(128)
+    tracker.update(block, block)
+    assert tracker.estimate() is None
+
+
+def test_block_by_block_matches_batched_update():
+    """ブロックごとに渡しても, まとめて渡しても同じ相互スペクトルになる"""
+    block_size = 64
+    rng = np.random.default_rng(2)
+    reference = rng.standard_normal(block_size * 40)
+    captured = np.roll(reference, 150)
+    batched = GccPhatDelayTracker(block_size=block_size, max_delay_samples=512)
+    batched.update(reference, captured)
+    incremental = GccPhatDelayTracker(block_size=block_size, max_delay_samples=512)
+    for start in range(0, len(reference), block_size):
+        incremental.update(reference[start:start + block_size], captured[start:start + block_size])
+    np.testing.assert_allclose(incremental.cross_spectra, batched.cross_spectra, rtol=1e-9, atol=1e-9)
+    assert incremental.estimate()[0] == batched.estimate()[0] == 150
+
+
+def test_coarse_to_fine_narrows_window_and_follows_delay():
+    block_size, delay = 256, 3000
+    rng = np.random.default_rng(3)
+    reference = rng.standard_normal(block_size * 400)
+    captured = np.concatenate((np.zeros(delay), reference[:-delay])) * 0.5 + rng.standard_normal(len(reference)) * 0.01
+    tracker = CoarseToFineDelayTracker(block_size=block_size, max_delay_samples=8192)
+    estimates = []
+    for start in range(0, len(reference), block_size * 20):
+        tracker.update(reference[start:start + block_size * 20], captured[start:start + block_size * 20])
+        estimates.append(tracker.estimate())
+    # 粗い探索であたりをつけた後は, 遅延の周りの細かい探索だけで正確に当てる
+    assert abs(estimates[-1][0] - delay) <= 2
+    assert tracker.fine.window_partitions < tracker.fine.num_partitions
+    assert tracker.fine.first_partition * block_size <= delay
@@ -0,0 +1,64 @@
+import numpy as np
+
+from double_talk import DoubleTalkDetector
+
+BLOCK = 256
+
+
+def run(detector, blocks, near_gain, far_gain=1.0, seed=0):
+    """遠端の参照信号を0.3倍のエコーにし, 近端の声を足したマイク信号で判定する(エコー推定は正確とする)"""
+    rng = np.random.default_rng(seed)
+    results = []
+    for _ in range(blocks):
+        reference = far_gain * rng.standard_normal(BLOCK)
+        echo = 0.3 * reference
+        near = rng.standard_normal((np.size(near_gain), BLOCK)) * np.reshape(near_gain, (-1, 1))
+        captured = echo + near
+        if detector.channels == 1:
+            results.append(detector.update(reference, captured[0], echo))
+        else:
+            results.append(detector.update(reference, captured, np.tile(echo, (detector.channels, 1))).copy())
+    return results
+
+
+def test_echo_only_is_not_double_talk():
+    detector = DoubleTalkDetector(block_size=BLOCK)
+    assert not any(run(detector, 50, 0.0))
+    assert detector.converged.all()
+    assert detector.double_talk_blocks == 0
+
+
+def test_near_end_speech_detected_with_hangover():
+    detector = DoubleTalkDetector(block_size=BLOCK, hangover_blocks=5)
+    run(detector, 20, 0.0)
+    assert any(run(detector, 10, 2.0))
+    assert detector.active
+    # 近端の声が止んでも hangover_blocks ブロックは適応を止めたまま
+    after = run(detector, 10, 0.0)
+    assert after[0] and not after[-1]
+
+
+def test_not_detected_before_filter_converges():
+    detector = DoubleTalkDetector(block_size=BLOCK)
+    # 最初から近端の声が大きく, ERLEが閾値を超えないので判定しない
+    assert not any(run(detector, 20, 2.0))
+    assert not detector.converged.any()
+
+
+def test_far_end_silence_reported_separately():
+    detector = DoubleTalkDetector(block_size=BLOCK, window_blocks=4)
+    run(detector, 20, 0.0)
+    results = run(detector, 10, 0.01, far_gain=0.0)
+    # 参照信号がエコー経路の長さ分無音になったら遠端無音. 近端の雑音はダブルトークにしない
+    assert detector.far_silent
+    assert not any(results[4:])
+    assert detector.far_silent_blocks >= 6
+
+
+def test_channels_judged_independently():
+    detector = DoubleTalkDetector(block_size=BLOCK, channels=2)
+    run(detector, 20, [0.0, 0.0])
+    results = run(detector, 10, [0.0, 2.0])
+    assert not any(result[0] for result in results)
+    assert any(result[1] for result in results)
+    assert detector.active
@@ -0,0 +1,52 @@
+import numpy as np
+
+import e
+from gain_stage import GainStage
+from simulate import convolve, process_streams, synthetic_room_response, synthetic_speech, to_pcm
+
+
+def test_gain_ramps_to_target():
+    stage = GainStage(volume=1.0, block_size=4)
+    data = np.full(4, 1000, dtype='<i2').tobytes()
+    np.testing.assert_array_equal(np.frombuffer(stage.process(data, 1.0), '<i2'), [1000] * 4)
+    # 前回のゲインから今回のゲインへブロック内で直線的に変わり, 最後のサンプルで到達する
+    output = np.frombuffer(stage.process(data, 0.0), '<i2')
+    np.testing.assert_array_equal(output, [750, 500, 250, 0])
+
+
+def test_limiter_and_saturation():
+    stage = GainStage(volume=4.0, max_amplitude=20000, limiter_ratio=0.5, block_size=8)
+    data = np.array([30000, -30000, 100, 0], dtype='<i2').tobytes()
+    output = np.frombuffer(stage.process(data, 1.0), '<i2')
+    assert output[0] == 32767 and output[1] == -32768
+    assert output[2] == 400
+
+
+def test_interleaved_channels_share_gain():
+    stage = GainStage(volume=0.5, block_size=4, channels=2)
+    data = np.array([1000, -2000, 3000, -4000], dtype='<i2').tobytes()
+    np.testing.assert_array_equal(np.frombuffer(stage.process(data, 1.0), '<i2'), [500, -1000, 1500, -2000])
+
+
+def test_limiter_engages_at_e_py_volume():
+    """e.pyの設定(音量1/7)でも, 音量を掛ける前の振幅がしきい値を超えた分を圧縮する"""
+    stage = GainStage(volume=e.OUTPUT_VOLUME, max_amplitude=20000, limiter_ratio=0.8, block_size=4)
+    data = np.array([30000, -30000, 14000, 0], dtype='<i2').tobytes()
+    output = np.frombuffer(stage.process(data, 1.0), '<i2')
+    limited = (20000 + 10000 * 0.8) * e.OUTPUT_VOLUME
+    np.testing.assert_allclose(output, [limited, -limited, 2000, 0], atol=1)
+
+
+def test_near_end_speech_survives_send_path():
+    """遠端が話している間も, 近端の声がエコー除去後の音量のまま送信される"""
+    sample_rate, block_size = 16000, 128
+    far = synthetic_speech(8.0, sample_rate)
+    near = synthetic_speech(8.0, sample_rate, seed=1) * 0.5
+    near[:4 * sample_rate] = 0
+    echo = convolve(far, synthetic_room_response(sample_rate, delay_s=0.05))[:len(far)]
+    results = process_streams(to_pcm(far), to_pcm(echo + near), sample_rate, block_size)
+    talk = slice(5 * sample_rate, None)
+    sent = results['sent'][0, talk]
+    expected = results['cancelled'][0, talk] * e.OUTPUT_VOLUME
+    assert np.sqrt(np.mean(sent ** 2)) > 0.9 * np.sqrt(np.mean(expected ** 2))
+    assert np.sqrt(np.mean(sent ** 2)) > 0.5 * np.sqrt(np.mean((near[talk] * e.OUTPUT_VOLUME) ** 2))
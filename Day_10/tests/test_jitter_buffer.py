@@ -0,0 +1,45 @@
+import numpy as np
+
+from jitter_buffer import JitterBuffer
+from transport import MediaFrame
+
+FRAME = 160
+
+
+def frame(sequence):
+    payload = np.full(FRAME, sequence % 1000, dtype='<i2').tobytes()
+    return MediaFrame(sequence & 0xFFFF, (sequence * FRAME) & 0xFFFFFFFF, payload)
+
+
+def first_sample(data):
+    return int(np.frombuffer(data, dtype='<i2')[0])
+
+
+def test_reorders_by_sequence():
+    """順番が入れ替わって届いても, シーケンス番号順に取り出す"""
+    buffer = JitterBuffer(FRAME, 8000, min_delay_s=0.06)
+    for sequence in (1, 0, 3, 2):
+        buffer.put(frame(sequence), arrival=sequence * 0.02)
+    assert [first_sample(buffer.get()) for _ in range(4)] == [0, 1, 2, 3]
+
+
+def test_late_frames_are_dropped_and_losses_concealed():
+    buffer = JitterBuffer(FRAME, 8000, min_delay_s=0.04)
+    for sequence in (0, 1, 3):
+        buffer.put(frame(sequence), arrival=sequence * 0.02)
+    assert first_sample(buffer.get()) == 0
+    assert first_sample(buffer.get()) == 1
+    buffer.get()  # 2 は届いていないので補間する
+    assert buffer.stats()['lost'] == 1
+    buffer.put(frame(2), arrival=0.1)
+    assert buffer.stats()['late'] == 1
+    assert first_sample(buffer.get()) == 3
+
+
+def test_sequence_wraparound():
+    buffer = JitterBuffer(FRAME, 8000, min_delay_s=0.04)
+    sequences = (0xFFFE, 0x10000, 0xFFFF, 0x10001)
+    for sequence in sequences:
+        buffer.put(frame(sequence), arrival=0.0)
+    # 16bitで折り返した番号 0, 1 は 0xFFFF の後として並べる
+    assert [first_sample(buffer.get()) for _ in range(4)] == [sequence % 1000 for sequence in sorted(sequences)]
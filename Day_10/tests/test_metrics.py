@@ -0,0 +1,61 @@
+import os
+import socket
+import sys
+
+import numpy as np
+import pytest
+
+import d
+import e
+import metrics
+from metrics import MetricsWriter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'Preprocess'))
+from metrics_reader import load_metrics  # noqa: E402
+
+
+@pytest.mark.parametrize('suffix', ['jsonl', 'bin'])
+def test_written_metrics_load_back(tmp_path, suffix):
+    path = str(tmp_path / f'metrics.{suffix}')
+    writer = MetricsWriter(path, flush_interval=0.01)
+    for i in range(3):
+        writer.emit('delay', 2400 + i, 0.05, 0.9, 0.5, 0.8, 2400, 1.5)
+        writer.emit('rms', 100.0 * i)
+    writer.emit_mapping('double_talk', {'active': 1, 'ratio': 0.4, 'ncc': 0.7, 'erle_db': 12.0, 'skipped': 0,
+                                        'far_silent': 0})
+    writer.emit('jitter', 20.0, 40.0)
+    writer.close()
+
+    loaded = load_metrics(path)
+    np.testing.assert_array_equal(loaded['delay']['delay_samples'], [2400, 2401, 2402])
+    np.testing.assert_array_equal(loaded['rms']['rms'], [0.0, 100.0, 200.0])
+    assert loaded['double_talk']['active'][0] == 1 and loaded['double_talk']['erle_db'][0] == 12.0
+    assert loaded['jitter']['target_ms'][0] == 40.0
+    assert np.all(np.diff(loaded['rms']['t']) >= 0)
+
+
+class RecordingMetrics:
+    closed = False
+
+    def emit(self, kind, *values):
+        pass
+
+    def emit_mapping(self, kind, mapping):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize('module', [e, d])
+def test_metrics_closed_when_client_cannot_connect(monkeypatch, module):
+    """接続に失敗して途中で返っても, 計測値の出力先を閉じる"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    sink = RecordingMetrics()
+    monkeypatch.setattr(module, 'open_metrics', lambda options: sink)
+    monkeypatch.setattr(sys, 'argv', [module.__name__, 'client', '127.0.0.1', str(port), '--backend', 'loopback'])
+    module.main()
+    assert sink.closed
@@ -0,0 +1,67 @@
+import numpy as np
+
+from resampler import FractionalResampler, PolyphaseResampler, Reframer, block_size_for
+
+
+def test_polyphase_passthrough_and_length():
+    samples = (np.random.default_rng(2).standard_normal(4800) * 1000).astype('<i2')
+    same = PolyphaseResampler(48000, 48000)
+    assert same.process_bytes(samples.tobytes()) == samples.tobytes()
+    down = PolyphaseResampler(48000, 16000)
+    output = down.process(samples.astype(np.float64))
+    assert abs(len(output) - 1600) <= 1
+
+
+def test_polyphase_keeps_pitch_across_blocks():
+    """44.1kHzの1kHzの正弦波を48kHzにしても1kHzのまま. ブロックの継ぎ目で途切れない"""
+    t = np.arange(44100) / 44100
+    tone = np.sin(2 * np.pi * 1000 * t)
+    resampler = PolyphaseResampler(44100, 48000)
+    output = np.concatenate([resampler.process(tone[i:i + 441]) for i in range(0, len(tone), 441)])
+    assert abs(len(output) - 48000) <= 1
+    spectrum = np.abs(np.fft.rfft(output[:48000] * np.hanning(len(output[:48000]))))
+    assert abs(np.argmax(spectrum) * 48000 / len(output[:48000]) - 1000) <= 1
+    # 立ち上がりの遅延の後は振幅が揃っている(継ぎ目での欠けや重複がない)
+    steady = output[1000:-1000]
+    assert np.abs(steady).max() < 1.01
+    assert np.isclose(np.sqrt(np.mean(steady ** 2)), np.sqrt(0.5), atol=0.01)
+
+
+def test_polyphase_stereo_matches_mono():
+    rng = np.random.default_rng(3)
+    left, right = rng.standard_normal(960), rng.standard_normal(960)
+    stereo = PolyphaseResampler(48000, 16000, channels=2).process(np.stack((left, right), axis=1))
+    np.testing.assert_allclose(stereo[:, 0], PolyphaseResampler(48000, 16000).process(left))
+    np.testing.assert_allclose(stereo[:, 1], PolyphaseResampler(48000, 16000).process(right))
+
+
+def test_reframer_regroups_bytes():
+    reframer = Reframer(4)
+    assert reframer.push(b'\x00' * 6) == []
+    frames = reframer.push(b'\x01' * 12)
+    assert [len(frame) for frame in frames] == [8, 8]
+
+
+def test_block_size_covers_same_duration():
+    assert block_size_for(48000, 48000, 256) == 256
+    assert block_size_for(16000, 48000, 256) == 128
+    assert block_size_for(44100, 48000, 256) == 256
+
+
+def test_fractional_identity_at_ratio_one():
+    """比が1の間は入力をそのまま返す(遅延も長さの増減もない)"""
+    resampler = FractionalResampler(1.0)
+    samples = np.random.default_rng(0).standard_normal(256 * 8)
+    output = np.concatenate([resampler.process(samples[i:i + 256]) for i in range(0, len(samples), 256)])
+    np.testing.assert_array_equal(output, samples)
+
+
+def test_fractional_ratio_changes_length_without_delay():
+    samples = np.random.default_rng(1).standard_normal(48000)
+    resampler = FractionalResampler(1.001)
+    output = np.concatenate([resampler.process(samples[i:i + 256]) for i in range(0, len(samples), 256)])
+    # 出力は入力の ratio 倍の長さ(フィルタの先読みの分だけ短い)
+    assert abs(len(output) - len(samples) * 1.001) <= resampler.taps
+    # ずれが溜まる前の最初の部分は, 入力と位置が揃っている
+    lags = [np.dot(output[20:300], samples[20 + lag:300 + lag]) for lag in (-1, 0, 1)]
+    assert np.argmax(lags) == 1
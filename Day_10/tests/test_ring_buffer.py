@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from ring_buffer import RingBuffer
+
+
+def test_wraparound_reads_contiguous_views():
+    """書き込みが末尾で折り返しても, どの窓も連続したビューで読める"""
+    buffer = RingBuffer(10)
+    buffer.write(np.arange(7, dtype=np.int16))
+    buffer.write(np.arange(7, 13, dtype=np.int16))
+    assert buffer.total == 13
+    assert len(buffer) == 10
+    np.testing.assert_array_equal(buffer.latest(10), np.arange(3, 13))
+    np.testing.assert_array_equal(buffer.read(5, 6), np.arange(5, 11))
+    np.testing.assert_array_equal(buffer.latest(4, offset=2), np.arange(7, 11))
+
+
+def test_write_larger_than_capacity_keeps_newest():
+    buffer = RingBuffer(8)
+    buffer.write(np.arange(3, dtype=np.int16))
+    buffer.write(np.arange(100, 120, dtype=np.int16))
+    assert buffer.total == 23
+    np.testing.assert_array_equal(buffer.latest(8), np.arange(112, 120))
+    np.testing.assert_array_equal(buffer.read(15, 8), np.arange(112, 120))
+
+
+def test_bytes_are_little_endian_int16():
+    buffer = RingBuffer(4)
+    buffer.write(np.array([1, -2], dtype='<i2').tobytes())
+    np.testing.assert_array_equal(buffer.latest(2), [1, -2])
+
+
+def test_read_outside_buffer_raises():
+    buffer = RingBuffer(4)
+    buffer.write(np.arange(6, dtype=np.int16))
+    with pytest.raises(ValueError):
+        buffer.read(1, 2)
+    with pytest.raises(ValueError):
+        buffer.read(4, 3)
@@ -0,0 +1,70 @@
+import numpy as np
+
+from session_recorder import SessionRecorder, open_session, stream_offset
+
+
+def pcm(values):
+    return np.asarray(values, dtype='<i2').tobytes()
+
+
+def test_recorded_streams_open_as_memmaps(tmp_path):
+    recorder = SessionRecorder(str(tmp_path), max_duration_s=1.0)
+    recorder.add_stream('mic', 16000, 2)
+    recorder.add_stream('received', 8000)
+    mic = np.arange(2 * 480, dtype='<i2').reshape(-1, 2)
+    for start in range(0, len(mic), 160):
+        recorder.append('mic', mic[start:start + 160].tobytes())
+    recorder.append('received', pcm([1, 2, 3]), media_timestamp=0xFFFFFFFE, sequence=65535)
+    recorder.append('received', pcm([4, 5]), media_timestamp=1, sequence=0)
+    recorder.close()
+
+    session = open_session(str(tmp_path))
+    np.testing.assert_array_equal(session['mic'].samples, mic)
+    assert session['mic'].channels == 2 and session['mic'].sample_rate == 16000
+    assert list(session['mic'].index['position']) == [0, 160, 320]
+    received = session['received']
+    np.testing.assert_array_equal(received.samples, [1, 2, 3, 4, 5])
+    assert list(received.index['media_timestamp']) == [0xFFFFFFFE, 1]
+    assert list(received.index['sequence']) == [65535, 0]
+    # 閉じたら書いた分だけに切り詰める
+    assert (tmp_path / 'received.raw').stat().st_size == 10
+
+
+def test_unclosed_recording_opens_written_part(tmp_path):
+    recorder = SessionRecorder(str(tmp_path), max_duration_s=1.0)
+    recorder.add_stream('played', 8000)
+    recorder.append('played', pcm(range(100)))
+    recorder.append('played', pcm(range(100, 150)))
+    # 落ちたときと同じく閉じずに開く. 索引から書けた分の長さを求める
+    recorder.streams['played'].index.flush()
+    session = open_session(str(tmp_path))
+    np.testing.assert_array_equal(session['played'].samples, np.arange(150))
+    assert len(session['played'].index) == 2
+    recorder.close()
+
+
+def test_recording_stops_at_capacity(tmp_path, capsys):
+    recorder = SessionRecorder(str(tmp_path), max_duration_s=0.01)
+    recorder.add_stream('sent', 8000)
+    for _ in range(3):
+        recorder.append('sent', pcm(np.ones(40)))
+    recorder.close()
+    # 80サンプル分の上限に収まる2パケットだけを残し, 知らせるのは1回だけ
+    assert len(open_session(str(tmp_path))['sent'].samples) == 80
+    assert capsys.readouterr().out.count("録音の上限") == 1
+
+
+def test_stream_offset_from_index_times(tmp_path):
+    recorder = SessionRecorder(str(tmp_path))
+    recorder.add_stream('mic', 8000)
+    recorder.add_stream('played', 8000)
+    recorder.append('mic', pcm(np.zeros(80)))
+    recorder.append('played', pcm(np.zeros(80)))
+    recorder.close()
+    session = open_session(str(tmp_path))
+    # 索引の時刻を書き換えて, 再生がマイクの0.5秒後に始まったことにする
+    mic, played = session['mic'], session['played']
+    mic_index, played_index = mic.index.copy(), played.index.copy()
+    mic_index['wall_time'] = 100.0
+    played_index['wall_time'] = 100.5
+    assert stream_offset(mic._replace(index=mic_index), played._replace(index=played_index)) == 4000
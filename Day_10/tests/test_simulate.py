@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from simulate import run_simulation, synthetic_room_response, synthetic_speech
+
+SAMPLE_RATE = 16000
+
+
+def test_lockstep_simulation_cancels_echo_faster_than_real_time():
+    """受信とマイクを1ブロックずつ交互に入れると, 実時間より速くエコーを消し, 真の遅延を当てる"""
+    far = synthetic_speech(6.0, SAMPLE_RATE)
+    near = np.zeros_like(far)
+    response = synthetic_room_response(SAMPLE_RATE, delay_s=0.05)
+    results = run_simulation(far, near, SAMPLE_RATE, response, skip_s=3.0)
+    assert results['erle_db'] > 15
+    assert len(results['delay_errors'])
+    assert np.all(np.abs(results['delay_errors']) <= 8)
+    assert results['realtime_factor'] < 1
+
+
+@pytest.mark.parametrize('reference_lead, arrival_jitter', [(0, 0), (0, 3), (4, 0)])
+def test_echo_cancelled_when_reference_arrives_unevenly(reference_lead, arrival_jitter):
+    """受信音声がマイクと1ブロックずつ交互に届かなくても, 遅延を正しく推定してエコーを消す"""
+    far = synthetic_speech(8.0, SAMPLE_RATE)
+    near = np.zeros_like(far)
+    response = synthetic_room_response(SAMPLE_RATE, delay_s=0.05)
+    results = run_simulation(far, near, SAMPLE_RATE, response, skip_s=4.0,
+                             reference_lead=reference_lead, arrival_jitter=arrival_jitter)
+    assert results['erle_db'] > 15
+    assert len(results['delay_errors'])
+    assert np.all(np.abs(results['delay_errors']) <= 8)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import sweep
+from simulate import run_simulation, save_session, synthetic_room_response, synthetic_speech
+
+SAMPLE_RATE = 16000
+
+
+@pytest.fixture
+def shared_session(tmp_path):
+    """simulate.pyで合成したセッションを共有メモリに読み込み, ワーカーと同じように参照する"""
+    far = synthetic_speech(6.0, SAMPLE_RATE)
+    response = synthetic_room_response(SAMPLE_RATE, delay_s=0.05)
+    results = run_simulation(far, np.zeros_like(far), SAMPLE_RATE, response)
+    save_session(str(tmp_path / 'room'), far, results, SAMPLE_RATE)
+    paths = sweep.find_sessions(str(tmp_path))
+    memory, layout = sweep.load_sessions(paths, SAMPLE_RATE)
+    sweep.attach_sessions(memory.name, layout, {'sample_rate': SAMPLE_RATE, 'skip_s': 3.0})
+    yield layout
+    sweep._sessions = None
+    sweep._memory.close()
+    memory.close()
+    memory.unlink()
+
+
+def test_evaluate_session_from_shared_memory(shared_session):
+    assert [session['name'] for session in shared_session] == ['room']
+    assert shared_session[0]['delay_samples'] == round(0.05 * SAMPLE_RATE)
+    configs = sweep.make_configs({'num_partitions': [8, 16], 'delay_smoothing': [0.95]})
+    assert configs == [{'delay_smoothing': 0.95, 'num_partitions': 8}, {'delay_smoothing': 0.95, 'num_partitions': 16}]
+    rows = [sweep.evaluate(0, config) for config in configs]
+    for row in rows:
+        assert row['session'] == 'room'
+        assert row['erle_db'] > 15
+        assert row['delay_error_ms'] < 1
+    summary = sweep.summarize(rows, ['delay_smoothing', 'num_partitions'])
+    assert len(summary) == 2 and summary[0]['erle_db'] >= summary[1]['erle_db']
+
+
+def test_check_grid_rejects_fixed_and_unknown_options():
+    assert sweep.check_grid({'num_partitions': [8, 16]}) is None
+    assert sweep.check_grid({'sample_rate': [16000]}) is not None
+    assert sweep.check_grid({'no_such_option': [1]}) is not None
+    assert sweep.check_grid({'num_partitions': 8}) is not None
+    assert sweep.check_grid({}) is not None
@@ -0,0 +1,70 @@
+import argparse
+import socket
+import threading
+
+import numpy as np
+import pytest
+
+from codec import get_codec
+from transport import open_channel
+
+FRAME = 160
+
+
+def connected_pair():
+    """ループバックでつないだ(サーバー側, クライアント側)のTCPソケット"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    return server, client
+
+
+def handshake(transport, codec, server_rate=16000, client_rate=16000, client_channels=1):
+    """サーバーをスレッドで動かしてハンドシェイクし, (サーバーのチャネル, クライアントのチャネル)を返す"""
+    server_sock, client_sock = connected_pair()
+    result = {}
+    server = threading.Thread(target=lambda: result.setdefault(
+        'channel', open_channel(server_sock, True, None, FRAME, server_rate)))
+    server.start()
+    options = argparse.Namespace(transport=transport, codec=codec)
+    client = open_channel(client_sock, False, options, FRAME * client_rate // server_rate, client_rate,
+                          channels=client_channels)
+    server.join(timeout=5)
+    return result['channel'], client
+
+
+@pytest.mark.parametrize('transport', ['tcp', 'udp'])
+def test_handshake_agrees_and_frames_arrive(transport):
+    server, client = handshake(transport, 'ulaw', server_rate=16000, client_rate=48000, client_channels=2)
+    try:
+        # 低い方のレートと, サーバー側のフレーム長に揃う
+        assert (client.sample_rate, client.frame_samples) == (server.sample_rate, server.frame_samples) == (16000, FRAME)
+        assert (client.channels, server.peer_channels) == (2, 2)
+        data = (np.arange(FRAME * 2) * 50).astype('<i2').tobytes()
+        client.send(data)
+        frame = server.recv()
+        np.testing.assert_allclose(np.frombuffer(frame.payload, '<i2'), np.frombuffer(data, '<i2'), atol=300)
+        server.send(bytes(FRAME * 2))
+        assert len(client.recv().payload) == FRAME * 2
+    finally:
+        client.close()
+        server.close()
+
+
+def test_udp_recv_returns_none_after_peer_bye():
+    server, client = handshake('udp', 'pcm')
+    client.close()
+    assert server.recv() is None
+    server.close()
+
+
+def test_unknown_proposal_falls_back_to_tcp_pcm():
+    server, client = handshake('sctp', 'opus')
+    try:
+        assert type(server).__name__ == type(client).__name__ == 'StreamChannel'
+        assert server.encoder.payload_type == client.decoder.payload_type == get_codec('pcm').payload_type
+    finally:
+        client.close()
+        server.close()
@@ -0,0 +1,280 @@
+"""音声データの伝送路(メディアチャネル)
+
+TCPで接続したあと, そのソケットを制御チャネルとして1行のJSONでハンドシェイクし,
+音声はクライアントが選んだ伝送路で送る.
+- tcp: 制御と同じTCPソケットに固定長のフレームとして流す(部分受信でサンプルがずれない)
+- udp: RTPと同じ形の12バイトのヘッダ(シーケンス番号, メディアタイムスタンプ, SSRC)を付けた
+       データグラムで送る. 再送しないので, パケットロスがあっても遅延が積み上がらない
+ハンドシェイクではコーデック(codec.py)と伝送路のサンプルレートも決める. チャネルは送信時に符号化し,
+受信したフレームは復号してから返すので, 呼び出し側は常に16bit PCMを扱う.
+伝送路のレートが自分と違う側は resampler.py で変換して送受信する(チャネルの sample_rate, frame_samples が伝送路の値).
+チャンネル数も互いに通知し, 各側はマイクのチャンネルをインターリーブしたまま送る(向きごとに数が違ってよい).
+サーバーが受け付けないチャンネル数はモノラルにしてもらう(チャネルの channels が送る数, peer_channels が受け取る数).
+"""
+import argparse
+import json
+import random
+import select
+import socket
+import struct
+from collections import namedtuple
+
+from codec import CODECS, get_codec
+
+TRANSPORTS = ('tcp', 'udp')
+
+# RTPヘッダ: V=2, ペイロードタイプ, シーケンス番号, タイムスタンプ, SSRC
+RTP_HEADER = struct.Struct('!BBHII')
+RTP_VERSION = 0x80
+MAX_DATAGRAM = 65536
+# 受け付けるマイクのチャンネル数の上限
+MAX_CHANNELS = 8
+
+# 受信したフレーム. sequenceは16bit, timestampは32bitで折り返す
+MediaFrame = namedtuple('MediaFrame', ['sequence', 'timestamp', 'payload'])
+
+
+def send_message(sock, message):
+    """制御チャネルにJSONを1行送る"""
+    sock.sendall(json.dumps(message).encode() + b'\n')
+
+
+def recv_message(sock):
+    """制御チャネルからJSONを1行受け取る(1バイトずつ読んで, 音声データを読みすぎないようにする)"""
+    line = bytearray()
+    while True:
+        byte = sock.recv(1)
+        if not byte:
+            raise ConnectionError("ハンドシェイク中に接続が切れました")
+        if byte == b'\n':
+            return json.loads(line)
+        line += byte
+
+
+def pack_rtp(payload_type, sequence, timestamp, ssrc, payload):
+    """RTP形式のヘッダを付けたパケットを作る"""
+    return RTP_HEADER.pack(RTP_VERSION, payload_type, sequence, timestamp, ssrc) + payload
+
+
+def parse_rtp(packet, peer_ssrc, payload_type):
+    """RTP形式のパケットをMediaFrame(ペイロードは符号化されたまま)にする. 別の送り手や壊れたパケットはNone"""
+    if len(packet) < RTP_HEADER.size:
+        return None
+    flags, received_type, sequence, timestamp, ssrc = RTP_HEADER.unpack_from(packet)
+    if flags & 0xC0 != RTP_VERSION or ssrc != peer_ssrc or received_type & 0x7F != payload_type:
+        return None
+    return MediaFrame(sequence, timestamp, packet[RTP_HEADER.size:])
+
+
+def make_hello(udp_port, ssrc, sample_rate, channels=1):
+    """ハンドシェイクで送る自分の情報(channels は送りたいチャンネル数)"""
+    return {'type': 'hello', 'udp_port': udp_port, 'ssrc': ssrc, 'sample_rate': sample_rate, 'channels': channels}
+
+
+def choose_media(request):
+    """サーバー側: クライアントの提案から(伝送路, コーデック)を決める(知らないものは tcp, pcm にする)"""
+    transport = request.get('transport', 'tcp')
+    if transport not in TRANSPORTS:
+        transport = 'tcp'
+    codec_name = request.get('codec', 'pcm')
+    if codec_name not in CODECS:
+        codec_name = 'pcm'
+    return transport, codec_name
+
+
+def choose_sample_rate(request, sample_rate):
+    """サーバー側: 伝送路のサンプルレートを決める. 低い方に合わせ, 高い側が送る前に変換する"""
+    peer_rate = request.get('sample_rate', sample_rate)
+    if not isinstance(peer_rate, int) or peer_rate <= 0:
+        raise ValueError(f"不正なサンプルレートです: {peer_rate!r}")
+    return min(peer_rate, sample_rate)
+
+
+def choose_channels(request, max_channels=MAX_CHANNELS):
+    """サーバー側: 相手が送るチャンネル数を決める. max_channels を超えるならモノラルにしてもらう"""
+    channels = request.get('channels', 1)
+    if not isinstance(channels, int) or channels < 1:
+        raise ValueError(f"不正なチャンネル数です: {channels!r}")
+    return channels if channels <= max_channels else 1
+
+
+def wire_frame_samples(frame_samples, sample_rate, wire_rate):
+    """自分のフレームと同じ時間になる伝送路のフレームのサンプル数"""
+    return max(1, round(frame_samples * wire_rate / sample_rate))
+
+
+def media_parameters(reply, sample_rate, frame_samples):
+    """クライアント側: サーバーが決めた伝送路の(サンプルレート, フレームのサンプル数)"""
+    wire_rate = reply.get('wire_rate', sample_rate)
+    return wire_rate, reply.get('frame_samples', wire_frame_samples(frame_samples, sample_rate, wire_rate))
+
+
+class StreamChannel:
+    """TCPソケットで固定長のフレームを送受信する"""
+
+    def __init__(self, sock, frame_samples, sample_rate, codec_name='pcm', channels=1, peer_channels=1):
+        self.sock = sock
+        self.frame_samples = frame_samples
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.peer_channels = peer_channels
+        self.encoder = get_codec(codec_name, channels)
+        self.decoder = get_codec(codec_name, peer_channels)
+        self.frame_size = self.decoder.encoded_size(frame_samples * peer_channels)
+        self.sequence = 0
+        self.timestamp = 0
+        self.closed = False
+
+    def send(self, data):
+        self.sock.sendall(self.encoder.encode(data))
+
+    def recv(self):
+        """1フレームを受け取る(接続が切れたらNone)"""
+        # MSG_WAITALLで1フレーム分が揃うまで待つので, フレームの途中で返らない
+        data = self.sock.recv(self.frame_size, socket.MSG_WAITALL)
+        if len(data) < self.frame_size:
+            return None
+        frame = MediaFrame(self.sequence, self.timestamp, self.decoder.decode(data))
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.timestamp = (self.timestamp + self.frame_samples) & 0xFFFFFFFF
+        return frame
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+class DatagramChannel:
+    """RTP形式のヘッダを付けたUDPデータグラムで送受信する. 制御用のTCPソケットも保持する"""
+
+    def __init__(self, control, media, peer, ssrc, peer_ssrc, frame_samples, sample_rate, codec_name='pcm',
+                 timeout=3.0, channels=1, peer_channels=1):
+        self.control = control
+        self.media = media
+        self.peer = peer
+        self.ssrc = ssrc
+        self.peer_ssrc = peer_ssrc
+        self.frame_samples = frame_samples
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.peer_channels = peer_channels
+        self.encoder = get_codec(codec_name, channels)
+        self.decoder = get_codec(codec_name, peer_channels)
+        self.sequence = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+        self.closed = False
+        # 相手が送ってこなくなったら(音声は無音でも常に流れる)切断とみなす
+        self.timeout = timeout
+        self.media.settimeout(timeout)
+
+    def send(self, data, sample_count=None):
+        if sample_count is None:
+            sample_count = self.frame_samples
+        packet = pack_rtp(self.encoder.payload_type, self.sequence, self.timestamp, self.ssrc,
+                          self.encoder.encode(data))
+        self.media.sendto(packet, self.peer)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.timestamp = (self.timestamp + sample_count) & 0xFFFFFFFF
+
+    def recv(self):
+        """1パケットを受け取る(相手が終了(bye)したか, 相手から届かなくなったらNone)"""
+        while True:
+            try:
+                # 音声と一緒に制御チャネルも見て, 相手の終了の通知をすぐに受け取る
+                readable, _, _ = select.select([self.media, self.control], [], [], self.timeout)
+                if not readable:
+                    return None
+                if self.control in readable and self._peer_left():
+                    return None
+                if self.media not in readable:
+                    continue
+                packet, address = self.media.recvfrom(MAX_DATAGRAM)
+            except (OSError, ValueError):
+                # タイムアウトか, このチャネルを閉じた(ファイル記述子が無効になった)
+                return None
+            frame = parse_rtp(packet, self.peer_ssrc, self.decoder.payload_type)
+            if frame is None:
+                continue
+            return frame._replace(payload=self.decoder.decode(frame.payload))
+
+    def _peer_left(self):
+        """制御チャネルに届いた1行を読み, 相手の終了(byeか切断)ならTrueを返す"""
+        try:
+            message = recv_message(self.control)
+        except ConnectionError:
+            return True
+        except ValueError:
+            return False
+        return message.get('type') == 'bye'
+
+    def close(self):
+        self.closed = True
+        try:
+            send_message(self.control, {'type': 'bye'})
+        except OSError:
+            pass
+        self.media.close()
+        self.control.close()
+
+
+def parse_transport_options(argv):
+    """コマンドライン引数から伝送路のオプションを取り出し, (残りの引数, オプション)を返す"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--transport', choices=TRANSPORTS, default='tcp',
+                        help="音声の伝送路(クライアント側の指定が使われる)")
+    parser.add_argument('--codec', choices=CODECS, default='pcm',
+                        help="音声の圧縮方式(クライアント側の指定が使われる)")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="送受信を1本のasyncioのイベントループで行う(e.pyのみ. 録音と再生はexecutorのスレッド)")
+    options, rest = parser.parse_known_args(argv)
+    return rest, options
+
+
+def open_channel(control, is_server, options, frame_samples, sample_rate, channels=1):
+    """制御チャネルでハンドシェイクし, 音声用のチャネルを返す
+
+    クライアントが伝送路とコーデックを提案し, サーバーはそれに従う(知らないものは tcp, pcm にする).
+    サンプルレートは互いに通知し, サーバーが伝送路のレートとフレームの長さを決める.
+    frame_samples, sample_rate は自分(デバイス側)の値で, 返すチャネルは伝送路の値を持つ.
+    channels はマイクのチャンネル数で, 返すチャネルの channels が実際に送るチャンネル数(1か channels).
+    """
+    media = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    media.bind((control.getsockname()[0], 0))
+    ssrc = random.getrandbits(32)
+    hello = make_hello(media.getsockname()[1], ssrc, sample_rate, channels)
+
+    try:
+        if is_server:
+            request = recv_message(control)
+            transport, codec_name = choose_media(request)
+            wire_rate = choose_sample_rate(request, sample_rate)
+            wire_frames = wire_frame_samples(frame_samples, sample_rate, wire_rate)
+            peer_channels = choose_channels(request)
+            send_message(control, dict(hello, transport=transport, codec=codec_name, wire_rate=wire_rate,
+                                       frame_samples=wire_frames, accepted_channels=peer_channels))
+            reply = request
+        else:
+            send_message(control, dict(hello, transport=options.transport, codec=options.codec))
+            reply = recv_message(control)
+            transport = reply['transport']
+            codec_name = reply.get('codec', 'pcm')
+            wire_rate, wire_frames = media_parameters(reply, sample_rate, frame_samples)
+            # チャンネル数を知らないサーバーにはモノラルで送る
+            channels = reply.get('accepted_channels', 1)
+            peer_channels = reply.get('channels', 1)
+    except (ConnectionError, ValueError):
+        media.close()
+        raise
+    converted = f" (こちらは{sample_rate}Hz, 変換して送受信)" if wire_rate != sample_rate else ""
+    print(f"コーデック: {codec_name}, サンプルレート: {wire_rate}Hz{converted}")
+    if channels != 1 or peer_channels != 1:
+        print(f"チャンネル数: 送信 {channels}, 受信 {peer_channels}")
+
+    if transport == 'tcp':
+        media.close()
+        return StreamChannel(control, wire_frames, wire_rate, codec_name, channels, peer_channels)
+
+    peer = (control.getpeername()[0], reply['udp_port'])
+    print(f"UDPで音声を送受信します: {media.getsockname()} <-> {peer}")
+    return DatagramChannel(control, media, peer, ssrc, reply['ssrc'], wire_frames, wire_rate, codec_name,
+                           channels=channels, peer_channels=peer_channels)
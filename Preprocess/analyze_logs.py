@@ -0,0 +1,171 @@
+"""Data/ のコンソールログをまとめて解析する
+
+使い方:
+    python analyze_logs.py ../Data/*.txt [--compare echo_max_4 no_echo_max_4] [--output summary.png]
+
+推定結果の行(`推定遅延(FFT): 0.177s (7809サンプル) 相関: 0.287 [ゲイン: ...] [信頼度: ...]`)と,
+同じ行の先頭にあるSoXの経過時間(`In:0.00% 00:00:02.39`)を, コンパイル済みの正規表現で取り出す.
+ファイルは一定の大きさずつ読みながら処理するので, 数GBのログでもメモリに載せきらない.
+セッション(ファイル名)ごとに 時刻, 遅延, サンプル数, 相関, ゲイン, 信頼度 の列(NumPyの配列)を作り,
+全セッションの要約統計と比較のグラフを1回で出す.
+解析結果はファイルの大きさと更新時刻をキーに .npz で保存し, 次回はログを読まずに使う.
+"""
+import argparse
+import hashlib
+import os
+import re
+
+import numpy as np
+
+COLUMNS = ('time', 'delay', 'samples', 'correlation', 'gain', 'confidence')
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.log_cache')
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# 行の先頭のSoXの経過時間は省略されていてもよい. ゲインと信頼度は版によってない
+# 行頭に固定すると, 推定結果のない位置で照合を試す回数が減る
+ESTIMATE_PATTERN = re.compile(
+    r'^(?:In:\S+\s+(\d+):(\d+):(\d+(?:\.\d+)?))?[^\n]*?'
+    r'推定遅延\(FFT\):\s*(-?\d+(?:\.\d+)?)s\s*\((-?\d+)サンプル\)\s*相関:\s*(-?\d+(?:\.\d+)?)'
+    r'(?:\s*ゲイン:\s*([-+\d.eE]+))?'
+    r'(?:\s*信頼度:\s*(-?\d+(?:\.\d+)?))?'.encode(), re.MULTILINE)
+
+
+def parse_log(path, chunk_size=CHUNK_SIZE):
+    """ログを少しずつ読みながら推定結果の行を取り出し, {列名: 配列} を返す"""
+    parts = []
+    remainder = b''
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            data = remainder + chunk
+            if chunk:
+                # 行の途中で切れないよう, 最後の改行より後は次に回す
+                end = data.rfind(b'\n') + 1
+                data, remainder = data[:end], data[end:]
+            matches = ESTIMATE_PATTERN.findall(data)
+            if matches:
+                parts.append(to_columns(np.array(matches, dtype='S32')))
+            if not chunk:
+                break
+    if not parts:
+        return {name: np.empty(0) for name in COLUMNS}
+    return {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+
+
+def to_columns(fields):
+    """正規表現のグループ(バイト列の2次元配列)を数値の列にまとめて変換する"""
+    def number(column):
+        values = np.full(len(column), np.nan)
+        present = column != b''
+        values[present] = column[present].astype(np.float64)
+        return values
+
+    hours, minutes, seconds = number(fields[:, 0]), number(fields[:, 1]), number(fields[:, 2])
+    return {
+        'time': hours * 3600 + minutes * 60 + seconds,
+        'delay': number(fields[:, 3]),
+        'samples': number(fields[:, 4]),
+        'correlation': number(fields[:, 5]),
+        'gain': number(fields[:, 6]),
+        'confidence': number(fields[:, 7]),
+    }
+
+
+def cache_path(path, cache_dir):
+    """ファイルの場所・大きさ・更新時刻から決まるキャッシュの場所"""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + '.npz')
+
+
+def load_session(path, cache_dir=CACHE_DIR, use_cache=True):
+    """キャッシュがあればそれを, なければログを解析して保存する"""
+    if not use_cache:
+        return parse_log(path)
+    cached = cache_path(path, cache_dir)
+    if os.path.exists(cached):
+        with np.load(cached) as data:
+            return {name: data[name] for name in COLUMNS}
+    session = parse_log(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(cached, **session)
+    return session
+
+
+def summarize(sessions):
+    """セッションごとの要約統計を表示する"""
+    print(f"{'セッション':<24}{'件数':>6}{'遅延平均(s)':>12}{'遅延中央(s)':>12}{'遅延標準偏差':>12}"
+          f"{'相関平均':>10}{'相関中央':>10}{'相関>0.2':>10}{'ゲイン平均':>10}")
+    for name, session in sessions.items():
+        delay = session['delay']
+        correlation = session['correlation']
+        if len(delay) == 0:
+            print(f"{name:<24}{0:>6}")
+            continue
+        gain = session['gain']
+        gain_mean = np.nanmean(gain) if np.isfinite(gain).any() else float('nan')
+        print(f"{name:<24}{len(delay):>6}{delay.mean():>12.3f}{np.median(delay):>12.3f}{delay.std():>12.3f}"
+              f"{correlation.mean():>10.3f}{np.median(correlation):>10.3f}{(correlation > 0.2).mean():>10.2f}"
+              f"{gain_mean:>10.3f}")
+
+
+def plot_sessions(sessions, output=None):
+    """遅延と相関の箱ひげ図と, 相関の時間変化を全セッション並べて描く"""
+    import matplotlib.pyplot as plt
+
+    names = [name for name, session in sessions.items() if len(session['delay'])]
+    fig, axes = plt.subplots(1, 3, figsize=(16, 5))
+    axes[0].boxplot([sessions[name]['delay'] for name in names])
+    axes[0].set_xticks(range(1, len(names) + 1), names, rotation=30, ha='right')
+    axes[0].set_ylabel('delay time[s]')
+    axes[0].grid(True)
+    axes[1].boxplot([sessions[name]['correlation'] for name in names])
+    axes[1].set_xticks(range(1, len(names) + 1), names, rotation=30, ha='right')
+    axes[1].set_ylabel('correlation')
+    axes[1].set_ylim(0, 1)
+    axes[1].grid(True)
+    for name in names:
+        session = sessions[name]
+        order = np.argsort(session['time'], kind='stable')
+        axes[2].plot(session['time'][order], session['correlation'][order], marker='.', label=name)
+    axes[2].set_xlabel('Time (s)')
+    axes[2].set_ylabel('correlation')
+    axes[2].set_ylim(0, 1)
+    axes[2].legend()
+    axes[2].grid(True)
+    plt.tight_layout()
+    if output:
+        plt.savefig(output, dpi=150, bbox_inches='tight')
+        print(f"グラフを保存しました: {output}")
+    else:
+        plt.show()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Data/ のログをまとめて解析する")
+    parser.add_argument('logs', nargs='+', help="ログファイル")
+    parser.add_argument('--compare', nargs='+', help="グラフに並べるセッション名(省略時はすべて)")
+    parser.add_argument('--output', help="グラフの保存先(省略時は画面に表示)")
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help="解析結果のキャッシュの置き場所")
+    parser.add_argument('--no-cache', action='store_true', help="キャッシュを使わずに解析し直す")
+    parser.add_argument('--no-plot', action='store_true', help="グラフを描かない")
+    args = parser.parse_args()
+
+    sessions = {}
+    for path in args.logs:
+        name = os.path.splitext(os.path.basename(path))[0]
+        sessions[name] = load_session(path, args.cache_dir, not args.no_cache)
+
+    summarize(sessions)
+    if args.no_plot:
+        return
+    if args.compare:
+        missing = [name for name in args.compare if name not in sessions]
+        if missing:
+            parser.error(f"セッションがありません: {', '.join(missing)}")
+        sessions = {name: sessions[name] for name in args.compare}
+    plot_sessions(sessions, args.output)
+
+
+if __name__ == '__main__':
+    main()
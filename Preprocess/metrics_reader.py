@@ -0,0 +1,95 @@
+"""d.py, e.pyの --metrics で書き出した計測値をNumPyの配列として読み込む
+
+使い方:
+    python metrics_reader.py <metrics.jsonl|metrics.bin>
+
+load_metrics()は {種類: {項目: 配列}} を返す(時刻は 't'). 形式は Day_10/metrics.py を参照.
+"""
+import json
+import sys
+
+import numpy as np
+
+MAGIC = b'INTERNET_PHONE_METRICS 1\n'
+
+
+def load_metrics(path):
+    """計測値のファイルを種類ごとの列(NumPyの配列)にする"""
+    with open(path, 'rb') as f:
+        head = f.read(len(MAGIC))
+    if head == MAGIC:
+        return load_binary(path)
+    return load_jsonl(path)
+
+
+def load_binary(path):
+    """固定長レコードの形式を読み込む(レコード全体を1回でNumPyの構造化配列にする)"""
+    with open(path, 'rb') as f:
+        f.readline()
+        fields = json.loads(f.readline())['fields']
+        offset = f.tell()
+    width = max(len(names) for names in fields.values())
+    dtype = np.dtype([('kind', 'u1'), ('pad', 'V7'), ('t', '<f8'), ('values', '<f8', (width,))])
+    records = np.memmap(path, dtype=dtype, mode='r', offset=offset)
+
+    result = {}
+    for number, (kind, names) in enumerate(fields.items()):
+        selected = records[records['kind'] == number]
+        columns = {'t': np.array(selected['t'])}
+        for i, name in enumerate(names):
+            columns[name] = np.array(selected['values'][:, i])
+        result[kind] = columns
+    return result
+
+
+def load_jsonl(path):
+    """1行1レコードのJSONを読み込む"""
+    rows = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            rows.setdefault(record.pop('kind'), []).append(record)
+
+    result = {}
+    for kind, records in rows.items():
+        names = list(records[0])
+        result[kind] = {name: np.array([record.get(name, np.nan) for record in records], dtype=float)
+                        for name in names}
+    return result
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"使い方: python {sys.argv[0]} <metrics.jsonl|metrics.bin>")
+        return
+    metrics = load_metrics(sys.argv[1])
+    for kind, columns in metrics.items():
+        print(f"[{kind}] {len(columns['t'])}件")
+        for name, values in columns.items():
+            if name == 't' or len(values) == 0:
+                continue
+            print(f"  {name:<14} 平均: {np.nanmean(values):.4f} 最小: {np.nanmin(values):.4f} 最大: {np.nanmax(values):.4f}")
+
+    delay = metrics.get('delay')
+    if delay is None or len(delay['t']) == 0:
+        return
+    import matplotlib.pyplot as plt
+    elapsed = delay['t'] - delay['t'][0]
+    fig, axes = plt.subplots(2, 1, sharex=True, figsize=(10, 6))
+    axes[0].plot(elapsed, delay['delay_s'], marker='o')
+    axes[0].set_ylabel('delay time[s]')
+    axes[0].grid(True)
+    axes[1].plot(elapsed, delay['correlation'], marker='o', label='correlation')
+    axes[1].plot(elapsed, delay['gain'], label='gain')
+    axes[1].set_xlabel('Time (s)')
+    axes[1].set_ylim(0, 1)
+    axes[1].legend()
+    axes[1].grid(True)
+    plt.tight_layout()
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()